@@ -98,7 +98,7 @@ done
 
 # 5.1) Rearrange and rename bundle files and bundle stats to match qsirecon conventions
 # 5.2) Convert trk.gz to tck.gz
-python3 ${PYTHON_HELPER_SCRIPT_2} "${PWD}/ss3t_atk_data" "${subid}" "${PWD}/preprocessed_data/${subid}/ses-PNC1/dwi"
+python3 ${PYTHON_HELPER_SCRIPT_2} "${PWD}/ss3t_atk_data" "${subid}" "${PWD}/preprocessed_data/${subid}/ses-PNC1/dwi" --workers "${SLURM_CPUS_PER_TASK}"
 
 # 6) Copy to output directory
 mkdir -p "${OUTPUTS}/${subid}/ses-PNC1/dwi"
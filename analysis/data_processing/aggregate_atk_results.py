@@ -4,9 +4,18 @@ import os
 import pandas as pd
 import shutil
 import gzip
+import struct
 import nibabel as nb
 import numpy as np
 import glob
+from nibabel.streamlines import Field, TckFile, TrkFile
+from nibabel.streamlines.trk import get_affine_trackvis_to_rasmm
+from concurrent.futures import ProcessPoolExecutor
+
+# Number of trk bytes that are converted at once (see convert_trk_to_tck)
+CHUNK_SIZE = 2**24
+# The streamlines of a trk file start right after its header, whose size is fixed (hdr_size)
+TRK_HEADER_SIZE = TrkFile.HEADER_SIZE
 
 
 def stat_txt_to_df(stat_txt_file: str, bundle_name: str):
@@ -36,51 +45,174 @@ def stat_txt_to_df(stat_txt_file: str, bundle_name: str):
     return bundle_stats
 
 
-def convert_trk_to_tck(preprocessed_dwi: str, trk_file: str):
-    """ This function converts the trk bundle files that are output from 
-    DSIStudio to tck files and saves the converted file with the same
-    name the original file had.
-    --- Adapted from qsirecon v 0.23.2 ---
+def load_dwi_geometry(preprocessed_dwi: str):
+    """ Reads the shape and affine of the pre-processed dwi image from its header.
+    The image data itself is never loaded.
 
     Args:
         preprocessed_dwi: link to the pre-processed dwi image
-        trk_file: link to the trk file
-    """
-    if trk_file.endswith(".gz"):
-        with gzip.open(trk_file, "r") as trkf:
-            dsi_trk = nb.streamlines.load(trkf)
-    else:
-        dsi_trk = nb.streamlines.load(trk_file)
 
-    # load preprocessed dwi image
+    Returns:
+        Tuple of the image shape and the voxel to RAS+ mm affine
+    """
     dwi_img = nb.load(preprocessed_dwi)
+    return dwi_img.shape, dwi_img.affine
+
 
+def get_trk_to_tck_affine(trk_header: dict, dwi_shape: tuple, dwi_affine: np.ndarray) -> np.ndarray:
+    """ Combines all coordinate transforms of the trk to tck conversion into one affine:
+    trackvis voxmm -> RAS+ mm of the trk (as applied by nibabel), -> DSIStudio voxel
+    coordinates, flip of the first two axes, -> RAS+ mm of the pre-processed dwi image.
+
+    Args:
+        trk_header: header of the trk file (see nb.streamlines.TrkFile)
+        dwi_shape: shape of the pre-processed dwi image (see load_dwi_geometry)
+        dwi_affine: affine of the pre-processed dwi image (see load_dwi_geometry)
+
+    Returns:
+        4x4 affine mapping the points stored in the trk file to the points of the tck file
+    """
+    trk_to_rasmm = get_affine_trackvis_to_rasmm(trk_header).astype(np.float64)
     # convert to voxel coordinates
-    pts = dsi_trk.streamlines._data
-    zooms = np.abs(np.diag(dsi_trk.header["voxel_to_rasmm"])[:3])
-    voxel_coords = pts / zooms
-    voxel_coords[:, 0] = dwi_img.shape[0] - voxel_coords[:, 0]
-    voxel_coords[:, 1] = dwi_img.shape[1] - voxel_coords[:, 1]
-
-    # create new tck
-    new_data = nb.affines.apply_affine(dwi_img.affine, voxel_coords)
-    dsi_trk.tractogram.streamlines._data = new_data
-    tck = nb.streamlines.TckFile(dsi_trk.tractogram)
-    if trk_file.endswith('.gz'):
-        tck_file = trk_file.strip('.gz')
-        tck_file = tck_file.strip('.trk') + '.tck'
-    else:
-        tck_file = trk_file.strip('.trk') + '.tck'
+    zooms = np.abs(np.diag(trk_header[Field.VOXEL_TO_RASMM])[:3])
+    to_voxel = np.diag(np.append(1 / zooms, 1))
+    flip = np.diag([-1., -1., 1., 1.])
+    flip[:2, 3] = dwi_shape[:2]
+    return dwi_affine @ flip @ to_voxel @ trk_to_rasmm
+
 
-    tck.save(tck_file)
+def iter_trk_chunks(trkf, trk_header: dict, chunk_size: int = CHUNK_SIZE):
+    """ Reads the streamlines of an open trk file (positioned at the first streamline)
+    in chunks of about chunk_size bytes. Scalars and properties are skipped.
+
+    Args:
+        trkf: open binary file object of the trk file
+        trk_header: header of the trk file (see nb.streamlines.TrkFile)
+        chunk_size: number of bytes read at once. Streamlines larger than this are
+        read completely before they are yielded.
+
+    Yields:
+        Tuples of the float32 values of the trk data in the chunk, the flat index of
+        the first coordinate of each point in these values and the number of points of
+        each streamline in the chunk
+    """
+    endianness = trk_header[Field.ENDIANNESS]
+    values_per_point = 3 + int(trk_header[Field.NB_SCALARS_PER_POINT])
+    n_properties = int(trk_header[Field.NB_PROPERTIES_PER_STREAMLINE])
+    n_points_format = struct.Struct(endianness + "i")
+    float_dtype = np.dtype(endianness + "f4")
+    buffer = b""
+    while True:
+        data = trkf.read(chunk_size)
+        buffer = buffer + data if buffer else data
+        # Find the complete streamlines in the buffer, each one is stored as its number of
+        # points followed by the point values and the properties
+        offset = 0
+        record_starts = []
+        lengths = []
+        while offset + 4 <= len(buffer):
+            n_points = n_points_format.unpack_from(buffer, offset)[0]
+            record_size = 4 * (1 + n_points * values_per_point + n_properties)
+            if offset + record_size > len(buffer):
+                break
+            record_starts.append(offset // 4 + 1)
+            lengths.append(n_points)
+            offset += record_size
+        if lengths:
+            lengths = np.array(lengths, dtype=np.int64)
+            point_starts = np.repeat(np.array(record_starts, dtype=np.int64), lengths)
+            points_before = np.repeat(np.cumsum(lengths) - lengths, lengths)
+            point_starts += (np.arange(len(point_starts)) - points_before) * values_per_point
+            yield np.frombuffer(buffer, dtype=float_dtype, count=offset // 4), point_starts, lengths
+        buffer = buffer[offset:]
+        if not data:
+            if buffer:
+                raise ValueError("The trk file ends within a streamline")
+            return
+
+
+def open_trk(trk_file: str):
+    """ Opens a (gzip compressed) trk file, reads its header and positions the file
+    at the first streamline. Returns the open file and the header. """
+    trkf = gzip.open(trk_file, "rb") if trk_file.endswith(".gz") else open(trk_file, "rb")
+    # A lazy load only parses the (validated) header and leaves the file at its start
+    trk_header = TrkFile.load(trkf, lazy_load=True).header
+    trkf.seek(TRK_HEADER_SIZE)
+    return trkf, trk_header
+
+
+def convert_trk_to_tck(trk_file: str, tck_file: str, dwi_shape: tuple, dwi_affine: np.ndarray,
+                       compresslevel: int = 6, chunk_size: int = CHUNK_SIZE):
+    """ This function converts a trk bundle file that is output from
+    DSIStudio to a gzip compressed tck file.
+    The streamlines are streamed in chunks (see iter_trk_chunks) and all coordinate
+    transforms are applied as one float32 affine in place (see get_trk_to_tck_affine),
+    so the memory use doesn't depend on the size of the bundle. Each chunk is appended
+    to the compressed tck file, no uncompressed tck file is written.
+    --- Adapted from qsirecon v 0.23.2 ---
+
+    Args:
+        trk_file: link to the trk file
+        tck_file: link to the output tck file (.tck.gz)
+        dwi_shape: shape of the pre-processed dwi image (see load_dwi_geometry)
+        dwi_affine: affine of the pre-processed dwi image (see load_dwi_geometry)
+        compresslevel: gzip compression level of the tck file (1-9)
+        chunk_size: number of trk bytes converted at once
+    """
+    trkf, trk_header = open_trk(trk_file)
+    with trkf:
+        # The tck header needs the number of streamlines up front since the compressed
+        # file can't be rewound. Count them if the trk header doesn't record it
+        count = int(trk_header[Field.NB_STREAMLINES])
+        if count == 0:
+            count = sum(len(lengths) for _, _, lengths in iter_trk_chunks(trkf, trk_header, chunk_size))
+            trkf.seek(TRK_HEADER_SIZE)
+        affine = get_trk_to_tck_affine(trk_header, dwi_shape, dwi_affine).astype(np.float32)
+        rotation = np.ascontiguousarray(affine[:3, :3].T)
+        translation = affine[:3, 3]
+
+        written = 0
+        with gzip.open(tck_file, "wb", compresslevel=compresslevel) as tckf:
+            tckf.write(tck_header(count))
+            for values, point_starts, lengths in iter_trk_chunks(trkf, trk_header, chunk_size):
+                # Points of each streamline followed by a NaN delimiter
+                points = np.full((len(point_starts) + len(lengths), 3), np.nan, dtype="<f4")
+                point_rows = np.arange(len(point_starts)) + np.repeat(np.arange(len(lengths)), lengths)
+                points[point_rows] = values[point_starts[:, None] + np.arange(3)]
+                np.matmul(points, rotation, out=points)
+                points += translation
+                tckf.write(points.data)
+                written += len(lengths)
+            tckf.write(TckFile.EOF_DELIMITER.astype("<f4").tobytes())
+    if written != count:
+        raise ValueError(f"{trk_file} holds {written} streamlines, its header records {count}")
     return
 
 
-def aggregate_atk_results(path_atk_outputs: str, bundles: list, subid: str, path_qsiprep_data: str):
+def tck_header(count: int) -> bytes:
+    """ Returns the header of a tck file with count streamlines, as written by nibabel. """
+    lines = ["mrtrix tracks", f"count: {count:010}", "datatype: Float32LE"]
+    header = "\n".join(lines) + "\nfile: . "
+    # The data offset includes its own digits
+    offset = len(header) + len("\nEND\n")
+    offset += len(str(offset + len(str(offset))))
+    return (header + str(offset) + "\nEND\n").encode("latin-1")
+
+
+def _convert_bundle(job):
+    """ Unpacks a conversion job for the worker pool (see aggregate_atk_results). """
+    convert_trk_to_tck(*job)
+    return job[1]
+
+
+def aggregate_atk_results(path_atk_outputs: str, bundles: list, subid: str, path_qsiprep_data: str,
+                          workers: int = 1, compresslevel: int = 6):
     """
     Loop over all bundles for a given subject and convert the outputs from the DSIStudio format to 
     the qsiprep format. This includes moving the files out of separate folders, renaming them 
     and combining separate stat files into one larger stats file.
+    The header of the pre-processed dwi image of each run is read once and the bundles of both
+    runs are converted concurrently on a pool of worker processes.
     --- Adapted from qsirecon v 0.23.2 ---
 
     Args:
@@ -88,8 +220,11 @@ def aggregate_atk_results(path_atk_outputs: str, bundles: list, subid: str, path
         bundles: list of expected bundles (bundles that were tried to track)
         subid: ID of the considered subjects
         path_qsiprep_data: path to the preprocessed data of this subject (necessary to convert the trk to tck file)
+        workers: number of processes converting the bundles
+        compresslevel: gzip compression level of the tck files (1-9)
 
     """
+    conversion_jobs = []
     for run in ["run-01", "run-02"]:
         stats_rows = []
         found_bundle_files = []
@@ -116,17 +251,26 @@ def aggregate_atk_results(path_atk_outputs: str, bundles: list, subid: str, path
         stats_df = pd.DataFrame(stats_rows)
         stats_df.to_csv(os.path.join(
             path_atk_outputs, bundle_file_name_prefix + "_bundlestats.csv"), index=False)
+        if not found_bundle_files:
+            continue
+        # The dwi header is the same for all bundles of a run
+        preprocessed_dwi = os.path.join(
+            path_qsiprep_data, bundle_file_name_prefix + "_desc-preproc_dwi.nii.gz")
+        dwi_shape, dwi_affine = load_dwi_geometry(preprocessed_dwi)
         for bundle_file, bundle_name in zip(found_bundle_files, found_bundle_names):
-            new_bundle_file = os.path.join(path_atk_outputs, bundle_file_name_prefix + "_bundle-" +
-                                           bundle_name.replace("_", "").replace("-", "") + "_streamlines.trk.gz")
-            shutil.move(bundle_file, new_bundle_file)
-            preprocessed_dwi = os.path.join(
-                path_qsiprep_data, bundle_file_name_prefix + "_desc-preproc_dwi.nii.gz")
-            convert_trk_to_tck(preprocessed_dwi, new_bundle_file)
-            new_bundle_file_tck = os.path.join(path_atk_outputs, bundle_file_name_prefix +
-                                               "_bundle-" + bundle_name.replace("_", "").replace("-", "") + "_streamlines.tck")
-            os.system("gzip " + new_bundle_file_tck)
-            os.remove(new_bundle_file)
+            new_bundle_file_tck = os.path.join(path_atk_outputs, bundle_file_name_prefix + "_bundle-" +
+                                               bundle_name.replace("_", "").replace("-", "") + "_streamlines.tck.gz")
+            conversion_jobs.append(
+                (bundle_file, new_bundle_file_tck, dwi_shape, dwi_affine, compresslevel))
+
+    # The trk files are removed together with the bundle folders below
+    if workers > 1:
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            for tck_file in executor.map(_convert_bundle, conversion_jobs):
+                print(f"Converted {os.path.basename(tck_file)}")
+    else:
+        for job in conversion_jobs:
+            print(f"Converted {os.path.basename(_convert_bundle(job))}")
     for bundle in bundles:
         bundle_folder = os.path.join(path_atk_outputs, bundle)
         if os.path.exists(bundle_folder):
@@ -149,7 +293,11 @@ if __name__ == '__main__':
                         help="ID of the subject currently being processed")
     parser.add_argument("path_qsiprep_data", type=str,
                         help="Root of the preprocessed data for one subject")
+    parser.add_argument("--workers", type=int, default=len(os.sched_getaffinity(0)),
+                        help="Num processes converting the bundles")
+    parser.add_argument("--compresslevel", type=int, default=6, choices=range(1, 10),
+                        metavar="{1-9}", help="gzip compression level of the tck files")
     args = parser.parse_args()
 
     aggregate_atk_results(args.path_atk_outputs, bundles,
-                          args.subid, args.path_qsiprep_data)
+                          args.subid, args.path_qsiprep_data, args.workers, args.compresslevel)
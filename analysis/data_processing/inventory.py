@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+import pandas as pd
+
+INVENTORY_PATH = "/cbica/projects/clinical_dmri_benchmark/results/inventory.sqlite"
+OUTPUTS_QSIPREP = "/cbica/projects/clinical_dmri_benchmark/results/qsiprep_outputs"
+OUTPUTS_QSIRECON = "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs"
+RECONSTRUCTIONS = ["GQIautotrack", "SS3Tautotrack", "CSDautotrack"]
+
+# BIDS entities stored as columns. Subject IDs and runs keep their prefix ("sub-<id>", "run-<run>")
+# as everywhere else in this repository, all other entities are stored as bare values
+ENTITY_COLUMNS = {"sub": "subject_id", "ses": "session", "acq": "acq", "run": "run",
+                  "space": "space", "bundle": "bundle", "desc": "desc"}
+FILE_COLUMNS = ["directory", "name"] + list(ENTITY_COLUMNS.values()) + ["suffix", "extension"]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS directories (
+    root TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT,
+    mtime_ns INTEGER NOT NULL,
+    PRIMARY KEY (root, path)
+);
+CREATE TABLE IF NOT EXISTS files (
+    root TEXT NOT NULL,
+    directory TEXT NOT NULL,
+    name TEXT NOT NULL,
+    subject_id TEXT,
+    session TEXT,
+    acq TEXT,
+    run TEXT,
+    space TEXT,
+    bundle TEXT,
+    desc TEXT,
+    suffix TEXT,
+    extension TEXT
+);
+CREATE INDEX IF NOT EXISTS files_directory ON files (root, directory);
+CREATE INDEX IF NOT EXISTS files_subject ON files (root, subject_id);
+CREATE INDEX IF NOT EXISTS files_bundle ON files (root, bundle);
+"""
+
+
+def parse_bids_name(name: str) -> dict:
+    """Parses the BIDS entities, suffix and extension of a file name.
+
+    Args:
+      name: File name, e.g. "sub-1_ses-PNC1_run-01_space-T1w_bundle-CingulumL_streamlines.tck.gz".
+
+    Returns:
+      Dictionary with the columns of ENTITY_COLUMNS (None for missing entities), the suffix
+      (e.g., "streamlines") and the extension including the leading dot (e.g., ".tck.gz").
+    """
+    stem, dot, extension = name.partition(".")
+    parsed = dict.fromkeys(ENTITY_COLUMNS.values())
+    parsed["suffix"] = None
+    parsed["extension"] = dot + extension
+    for part in stem.split("_"):
+        key, dash, value = part.partition("-")
+        if not dash:
+            parsed["suffix"] = part
+        elif key in ENTITY_COLUMNS:
+            parsed[ENTITY_COLUMNS[key]] = part if key in ("sub", "run") else value
+    return parsed
+
+
+def connect(inventory_path: str) -> sqlite3.Connection:
+    """Opens (and if necessary creates) an inventory database."""
+    con = sqlite3.connect(inventory_path)
+    con.executescript(SCHEMA)
+    return con
+
+
+def list_directory(root: str, path: str):
+    """Lists a directory with a single os.scandir. Returns the list of file names and the list
+    of subdirectory paths (relative to root)."""
+    files, subdirectories = [], []
+    with os.scandir(os.path.join(root, path)) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                subdirectories.append(os.path.join(path, entry.name))
+            elif entry.is_file():
+                files.append(entry.name)
+    return files, subdirectories
+
+
+def scan_subtree(root: str, start: str, known_mtimes: dict, known_children: dict):
+    """Walks a directory tree with os.scandir, only listing directories that changed.
+
+    A directory whose modification time equals the one recorded in the inventory has the same
+    entries as before, so it is not listed again. Its known subdirectories are still visited,
+    since changes inside a subdirectory don't change the modification time of its parent.
+
+    Args:
+      root: Root directory of the inventory.
+      start: Path of the directory to start at, relative to root ("" for the root itself).
+      known_mtimes: Dictionary mapping relative directory paths to their recorded mtime (ns).
+      known_children: Dictionary mapping relative directory paths to their recorded subdirectories.
+
+    Returns:
+      A tuple of the list of visited directories and a dictionary mapping each changed directory
+      to a tuple of (parent, mtime, list of file names, list of subdirectories).
+    """
+    visited = []
+    changed = {}
+    stack = [(start, os.path.dirname(start) if start else None)]
+    while stack:
+        path, parent = stack.pop()
+        try:
+            mtime = os.stat(os.path.join(root, path)).st_mtime_ns
+        except FileNotFoundError:
+            continue
+        visited.append(path)
+        if known_mtimes.get(path) == mtime:
+            stack.extend((child, path) for child in known_children.get(path, []))
+            continue
+        files, subdirectories = list_directory(root, path)
+        changed[path] = (parent, mtime, files, subdirectories)
+        stack.extend((child, path) for child in subdirectories)
+    return visited, changed
+
+
+def update_root(con: sqlite3.Connection, root: str, workers: int = 8):
+    """Brings the inventory of one output root up to date.
+
+    The top-level directories (one per subject) are walked in parallel on a thread pool
+    (see scan_subtree). Only the files of directories that changed since the last update are
+    replaced. Directories that no longer exist are removed from the inventory.
+
+    Args:
+      con: Connection to the inventory database.
+      root: Output root, e.g. the qsirecon output directory of one reconstruction.
+      workers: Number of threads used to walk the subject directories.
+
+    Returns:
+      The number of directories that were (re)listed.
+    """
+    root = os.path.abspath(root)
+    known_mtimes, known_children = {}, {}
+    for path, parent, mtime in con.execute(
+            "SELECT path, parent, mtime_ns FROM directories WHERE root = ?", (root,)):
+        known_mtimes[path] = mtime
+        if parent is not None:
+            known_children.setdefault(parent, []).append(path)
+
+    # The root itself is listed first, its subdirectories are walked in parallel
+    visited, changed = [""], {}
+    mtime = os.stat(root).st_mtime_ns
+    if known_mtimes.get("") == mtime:
+        top_level = known_children.get("", [])
+    else:
+        files, top_level = list_directory(root, "")
+        changed[""] = (None, mtime, files, top_level)
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for subtree_visited, subtree_changed in executor.map(
+                lambda start: scan_subtree(root, start, known_mtimes, known_children), top_level):
+            visited += subtree_visited
+            changed.update(subtree_changed)
+
+    removed = set(known_mtimes) - set(visited)
+    with con:
+        for path in removed | set(changed):
+            con.execute("DELETE FROM files WHERE root = ? AND directory = ?", (root, path))
+        con.executemany("DELETE FROM directories WHERE root = ? AND path = ?",
+                        [(root, path) for path in removed])
+        con.executemany(
+            "INSERT OR REPLACE INTO directories (root, path, parent, mtime_ns) VALUES (?, ?, ?, ?)",
+            [(root, path, parent, mtime) for path, (parent, mtime, _, _) in changed.items()])
+        rows = []
+        for path, (_, _, files, _) in changed.items():
+            for name in files:
+                parsed = parse_bids_name(name)
+                rows.append([root, path, name] + [parsed[column] for column in FILE_COLUMNS[2:]])
+        con.executemany(
+            f"INSERT INTO files (root, {', '.join(FILE_COLUMNS)}) VALUES ({', '.join(['?'] * (len(FILE_COLUMNS) + 1))})",
+            rows)
+    print(f"{root}: listed {len(changed)} of {len(visited)} directories, removed {len(removed)}")
+    return len(changed)
+
+
+def update_inventory(inventory_path: str, roots: list, workers: int = 8):
+    """Builds or incrementally updates the inventory of all given output roots."""
+    con = connect(inventory_path)
+    try:
+        for root in roots:
+            update_root(con, root, workers)
+    finally:
+        con.close()
+
+
+def query_files(inventory_path: str, root: str, **entities) -> pd.DataFrame:
+    """Queries the files of one output root.
+
+    Args:
+      inventory_path: Path of the inventory database.
+      root: Output root the files belong to.
+      entities: Optional column values the files have to match, e.g. space="MNI152NLin2009cAsym",
+      suffix="mask" or directory="sub-1/ses-PNC1/dwi".
+
+    Returns:
+      DataFrame with the columns directory, name, the BIDS entities, suffix and extension.
+    """
+    unknown = set(entities) - set(FILE_COLUMNS)
+    if unknown:
+        raise ValueError(f"Unknown inventory columns: {', '.join(sorted(unknown))}")
+    conditions = ["root = ?"] + [f"{column} = ?" for column in entities]
+    con = sqlite3.connect(inventory_path)
+    try:
+        return pd.read_sql_query(
+            f"SELECT {', '.join(FILE_COLUMNS)} FROM files WHERE {' AND '.join(conditions)}",
+            con, params=[os.path.abspath(root)] + list(entities.values()))
+    finally:
+        con.close()
+
+
+def query_subjects(inventory_path: str, root: str) -> list:
+    """Returns the sorted subject folders ("sub-<id>") directly below an output root."""
+    con = sqlite3.connect(inventory_path)
+    try:
+        paths = [path for path, in con.execute(
+            "SELECT path FROM directories WHERE root = ? AND parent = ''", (os.path.abspath(root),))]
+    finally:
+        con.close()
+    return sorted(path for path in paths if path.startswith("sub"))
+
+
+def query_directories(inventory_path: str, root: str) -> set:
+    """Returns the paths (relative to root, e.g. "sub-1/ses-PNC1/dwi") of all directories
+    below an output root."""
+    con = sqlite3.connect(inventory_path)
+    try:
+        return {path for path, in con.execute(
+            "SELECT path FROM directories WHERE root = ?", (os.path.abspath(root),))}
+    finally:
+        con.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inventory of qsiprep and qsirecon outputs")
+    parser.add_argument(
+        "--roots",
+        type=str,
+        nargs="+",
+        default=[OUTPUTS_QSIPREP] + [os.path.join(OUTPUTS_QSIRECON, "qsirecon-" + suffix)
+                                     for suffix in RECONSTRUCTIONS],
+        help="Output roots to index (default: qsiprep outputs and all autotrack reconstructions)",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        default=INVENTORY_PATH,
+        help="Path of the SQLite inventory, updated incrementally if it exists",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Num threads used to walk the subject directories",
+    )
+    args = parser.parse_args()
+
+    update_inventory(args.inventory, args.roots, args.workers)
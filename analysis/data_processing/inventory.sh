@@ -0,0 +1,30 @@
+#!/bin/bash
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=8
+#SBATCH --mem=2G
+#SBATCH --time=08:00:00
+#SBATCH --output=../logs/pnc_inventory-%A_%a.log
+
+[ -z "${JOB_ID}" ] && JOB_ID=TEST
+
+if [[ ! -z "${SLURM_JOB_ID}" ]]; then
+    echo SLURM detected
+    JOB_ID="${SLURM_JOB_ID}"
+    NSLOTS="${SLURM_JOB_CPUS_PER_NODE}"
+fi
+
+# fail whenever something is fishy, use -x to get verbose logfiles
+set -e -u -x
+
+PYTHON_HELPER_SCRIPT="${HOME}/clinical_dmri_benchmark/analysis/data_processing/inventory.py"
+
+source /cbica/projects/clinical_dmri_benchmark/micromamba/etc/profile.d/micromamba.sh
+
+micromamba activate clinical_dmri_benchmark
+
+python3 ${PYTHON_HELPER_SCRIPT} --workers ${SLURM_CPUS_PER_TASK}
+
+micromamba deactivate
+
+echo SUCCESS
@@ -0,0 +1,324 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import re
+import shutil
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+from scipy.sparse import csr_matrix
+
+RUNS = ["run-01", "run-02"]
+MNI_MASK_PATTERN = re.compile(
+    r"^(?P<subject_id>sub-[^_]+)_ses-PNC1(?:_[^_]+)*?_(?P<run>run-\d+)"
+    r"_space-MNI152NLin2009cAsym_bundle-(?P<bundle>[^_]+)_mask\.nii\.gz$"
+)
+VOXEL_DTYPE = np.dtype("<i4")
+# Subdirectory of a mask store holding the fragments of single subjects (see write_fragment)
+FRAGMENT_DIR = "fragments"
+
+
+def scan_mni_masks(mni_dir: str) -> list:
+    """Lists all bundle masks in a subject's MNI directory with a single directory scan
+    and parses the BIDS entities from the file names.
+
+    Args:
+      mni_dir: Path to the "dwi/MNI" directory of one subject.
+
+    Returns:
+      List of (subject_id, run, bundle, path) tuples. Empty if the directory doesn't exist.
+    """
+    if not os.path.isdir(mni_dir):
+        return []
+    found_masks = []
+    with os.scandir(mni_dir) as entries:
+        for entry in entries:
+            match = MNI_MASK_PATTERN.match(entry.name)
+            if match:
+                found_masks.append(
+                    (match["subject_id"], match["run"], match["bundle"], entry.path))
+    return found_masks
+
+
+def get_geometry(image: sitk.Image) -> dict:
+    """Extracts the MNI grid geometry of a SimpleITK image.
+
+    Args:
+      image: SimpleITK image
+
+    Returns:
+      Dictionary with size (x, y, z), origin, spacing and direction of the image.
+    """
+    return {
+        "size": list(image.GetSize()),
+        "origin": list(image.GetOrigin()),
+        "spacing": list(image.GetSpacing()),
+        "direction": list(image.GetDirection()),
+    }
+
+
+def read_geometry(store_root: str) -> dict:
+    """Reads the MNI geometry of a mask store.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+
+    Returns:
+      Dictionary with size (x, y, z), origin, spacing and direction of the MNI grid.
+    """
+    with open(os.path.join(store_root, "geometry.json"), "r") as f:
+        return json.load(f)
+
+
+def get_array_shape(geometry: dict) -> tuple:
+    """Returns the shape of a NumPy array (z, y, x) obtained from an image of the given geometry."""
+    return tuple(reversed(geometry["size"]))
+
+
+def read_bundle_index(store_root: str, bundle: str) -> pd.DataFrame:
+    """Reads the index of a bundle in a mask store.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+      bundle: Bundle name without underscores and dashes (e.g., CommissureCorpusCallosum).
+
+    Returns:
+      DataFrame with columns subject_id, run, start and stop. The flat voxel indices of a
+      scan's mask are stored at voxels[start:stop].
+    """
+    index_path = os.path.join(store_root, bundle + "_index.csv")
+    if not os.path.exists(index_path):
+        return pd.DataFrame(columns=["subject_id", "run", "start", "stop"])
+    return pd.read_csv(index_path)
+
+
+def open_bundle(store_root: str, bundle: str):
+    """Opens a bundle of a mask store without loading the voxel indices into memory.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+      bundle: Bundle name without underscores and dashes.
+
+    Returns:
+      A tuple of the bundle index (see read_bundle_index) and a memory-mapped int32 array
+      holding the sorted flat voxel indices of all masks of this bundle.
+    """
+    bundle_index = read_bundle_index(store_root, bundle)
+    voxel_path = os.path.join(store_root, bundle + ".bin")
+    if not os.path.exists(voxel_path) or os.path.getsize(voxel_path) == 0:
+        return bundle_index, np.zeros(0, dtype=VOXEL_DTYPE)
+    return bundle_index, np.memmap(voxel_path, dtype=VOXEL_DTYPE, mode="r")
+
+
+def get_scan_voxels(store_root: str, bundle: str) -> dict:
+    """Returns the voxel indices of all masks of a bundle.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+      bundle: Bundle name without underscores and dashes.
+
+    Returns:
+      Dictionary with (subject_id, run) tuples as keys and memory-mapped arrays of the sorted
+      flat voxel indices of the corresponding masks as values.
+    """
+    bundle_index, voxels = open_bundle(store_root, bundle)
+    return {
+        (subject_id, run): voxels[start:stop]
+        for subject_id, run, start, stop in bundle_index[
+            ["subject_id", "run", "start", "stop"]].itertuples(index=False)
+    }
+
+
+def voxels_to_csr(voxel_indices: np.ndarray, n_voxels: int) -> csr_matrix:
+    """Converts the flat voxel indices of a mask to a 1 x n_voxels sparse row."""
+    return csr_matrix(
+        (np.ones(len(voxel_indices), dtype=np.uint8),
+         np.asarray(voxel_indices), np.array([0, len(voxel_indices)])),
+        shape=(1, n_voxels),
+    )
+
+
+def voxels_to_array(voxel_indices: np.ndarray, geometry: dict, dtype=np.uint8) -> np.ndarray:
+    """Converts the flat voxel indices of a mask to a dense (z, y, x) mask array."""
+    mask_array = np.zeros(int(np.prod(geometry["size"])), dtype=dtype)
+    mask_array[voxel_indices] = 1
+    return mask_array.reshape(get_array_shape(geometry))
+
+
+def array_to_image(array: np.ndarray, geometry: dict) -> sitk.Image:
+    """Converts a (z, y, x) array to a SimpleITK image on the MNI grid of a mask store."""
+    image = sitk.GetImageFromArray(array)
+    image.SetOrigin(geometry["origin"])
+    image.SetSpacing(geometry["spacing"])
+    image.SetDirection(geometry["direction"])
+    return image
+
+
+def build_mask_store(qsirecon_root: str, store_root: str, bundles: list):
+    """Converts the MNI bundle masks of all subjects of one reconstruction to a mask store.
+
+    For each bundle, the sorted int32 flat voxel indices of all masks are appended to one
+    binary file (<bundle>.bin) and their position is recorded in <bundle>_index.csv.
+    If a scan has several masks of a bundle, only the first one in sorted order is stored.
+    The MNI geometry shared by all masks is written to geometry.json.
+
+    Args:
+      qsirecon_root: Root directory of the qsirecon outputs of one reconstruction.
+      store_root: Output directory of the mask store.
+      bundles: List of bundle names without underscores and dashes.
+    """
+    os.makedirs(store_root, exist_ok=True)
+    subjects = sorted(
+        name
+        for name in os.listdir(qsirecon_root)
+        if os.path.isdir(os.path.join(qsirecon_root, name)) and name.startswith("sub")
+    )
+    voxel_files = {bundle: open(os.path.join(store_root, bundle + ".bin"), "wb")
+                   for bundle in bundles}
+    index_rows = {bundle: [] for bundle in bundles}
+    offsets = {bundle: 0 for bundle in bundles}
+    geometry = None
+    try:
+        for subject in subjects:
+            print(subject)
+            mni_dir = os.path.join(qsirecon_root, subject, "ses-PNC1", "dwi", "MNI")
+            stored = set()
+            for subject_id, run, bundle, mask_path in sorted(scan_mni_masks(mni_dir)):
+                # Keep the first sorted mask of a scan, as the NIfTI based scripts do
+                if bundle not in voxel_files or (run, bundle) in stored:
+                    continue
+                stored.add((run, bundle))
+                mask_image = sitk.ReadImage(mask_path)
+                mask_geometry = get_geometry(mask_image)
+                if geometry is None:
+                    geometry = mask_geometry
+                elif mask_geometry != geometry:
+                    raise ValueError(f"The MNI geometry of {mask_path} differs from the other masks.")
+                voxel_indices = np.flatnonzero(
+                    sitk.GetArrayViewFromImage(mask_image)).astype(VOXEL_DTYPE)
+                voxel_files[bundle].write(voxel_indices.tobytes())
+                start = offsets[bundle]
+                offsets[bundle] += len(voxel_indices)
+                index_rows[bundle].append(
+                    [subject_id, run, start, offsets[bundle]])
+    finally:
+        for voxel_file in voxel_files.values():
+            voxel_file.close()
+
+    for bundle in bundles:
+        pd.DataFrame(index_rows[bundle], columns=["subject_id", "run", "start", "stop"]).to_csv(
+            os.path.join(store_root, bundle + "_index.csv"), index=False)
+    if geometry is not None:
+        with open(os.path.join(store_root, "geometry.json"), "w") as f:
+            json.dump(geometry, f, indent=2)
+    return
+
+
+def write_fragment(store_root: str, subject_id: str, masks: dict, geometry: dict):
+    """Writes the masks of one subject as a fragment of a mask store.
+
+    A fragment is a mask store holding a single subject (in <store_root>/fragments/<subject_id>),
+    so that jobs of different subjects never write to the same file. The fragments are
+    combined with merge_fragments. An existing fragment of the subject is replaced.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+      subject_id: ID of the subject (e.g., sub-1).
+      masks: Dictionary with (run, bundle) tuples as keys and the sorted flat voxel indices
+      of the corresponding masks as values.
+      geometry: MNI geometry of the masks (see get_geometry).
+    """
+    fragment_root = os.path.join(store_root, FRAGMENT_DIR, subject_id)
+    if os.path.exists(fragment_root):
+        shutil.rmtree(fragment_root)
+    os.makedirs(fragment_root)
+    for bundle in sorted({bundle for _, bundle in masks}):
+        index_rows = []
+        offset = 0
+        with open(os.path.join(fragment_root, bundle + ".bin"), "wb") as voxel_file:
+            for run in sorted(run for run, mask_bundle in masks if mask_bundle == bundle):
+                voxel_indices = np.asarray(masks[(run, bundle)], dtype=VOXEL_DTYPE)
+                voxel_file.write(voxel_indices.tobytes())
+                index_rows.append([subject_id, run, offset, offset + len(voxel_indices)])
+                offset += len(voxel_indices)
+        pd.DataFrame(index_rows, columns=["subject_id", "run", "start", "stop"]).to_csv(
+            os.path.join(fragment_root, bundle + "_index.csv"), index=False)
+    with open(os.path.join(fragment_root, "geometry.json"), "w") as f:
+        json.dump(geometry, f, indent=2)
+    return
+
+
+def merge_fragments(store_root: str, bundles: list):
+    """Builds a mask store from the fragments of all subjects (see write_fragment).
+
+    The result is the same as build_mask_store on the corresponding NIfTI masks.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+      bundles: List of bundle names without underscores and dashes.
+    """
+    fragments_root = os.path.join(store_root, FRAGMENT_DIR)
+    subjects = sorted(name for name in os.listdir(fragments_root) if name.startswith("sub"))
+    geometry = None
+    for subject in subjects:
+        fragment_geometry = read_geometry(os.path.join(fragments_root, subject))
+        if geometry is None:
+            geometry = fragment_geometry
+        elif fragment_geometry != geometry:
+            raise ValueError(f"The MNI geometry of the fragment of {subject} differs from the other fragments.")
+
+    for bundle in bundles:
+        index_rows = []
+        offset = 0
+        with open(os.path.join(store_root, bundle + ".bin"), "wb") as voxel_file:
+            for subject in subjects:
+                fragment_index, voxels = open_bundle(os.path.join(fragments_root, subject), bundle)
+                for subject_id, run, start, stop in fragment_index[
+                        ["subject_id", "run", "start", "stop"]].itertuples(index=False):
+                    voxel_file.write(np.asarray(voxels[start:stop]).tobytes())
+                    index_rows.append([subject_id, run, offset, offset + stop - start])
+                    offset += stop - start
+        pd.DataFrame(index_rows, columns=["subject_id", "run", "start", "stop"]).to_csv(
+            os.path.join(store_root, bundle + "_index.csv"), index=False)
+    if geometry is not None:
+        with open(os.path.join(store_root, "geometry.json"), "w") as f:
+            json.dump(geometry, f, indent=2)
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Reconstruction method")
+    parser.add_argument(
+        "--recon_suffix",
+        type=str,
+        required=True,
+        help="Reconstruction method (e.g., GQIautotrack)",
+    )
+    parser.add_argument(
+        "--merge_fragments",
+        action="store_true",
+        help="Build the store from the fragments written by warp_bundles_to_mni.py --mask_store instead of the NIfTI masks",
+    )
+    args = parser.parse_args()
+
+    QSIRECON_SUFFIX = args.recon_suffix
+    ROOT_QSIRECON = (
+        "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs/qsirecon-"
+        + QSIRECON_SUFFIX
+    )
+    STORE_ROOT = (
+        "/cbica/projects/clinical_dmri_benchmark/results/mask_store/"
+        + QSIRECON_SUFFIX
+    )
+    BUNDLE_NAMES = "/cbica/projects/clinical_dmri_benchmark/clinical_dmri_benchmark/data/bundle_names.txt"
+
+    with open(BUNDLE_NAMES, "r") as f:
+        bundles = f.read().splitlines()
+    for i, bundle in enumerate(bundles):
+        bundles[i] = bundle.replace("_", "").replace("-", "")
+
+    if args.merge_fragments:
+        merge_fragments(STORE_ROOT, bundles)
+    else:
+        build_mask_store(ROOT_QSIRECON, STORE_ROOT, bundles)
@@ -0,0 +1,31 @@
+#!/bin/bash
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=1
+#SBATCH --mem=2G
+#SBATCH --time=08:00:00
+#SBATCH --output=../logs/pnc_mask_store-%A_%a.log
+
+[ -z "${JOB_ID}" ] && JOB_ID=TEST
+
+if [[ ! -z "${SLURM_JOB_ID}" ]]; then
+    echo SLURM detected
+    JOB_ID="${SLURM_JOB_ID}"
+    NSLOTS="${SLURM_JOB_CPUS_PER_NODE}"
+fi
+
+# fail whenever something is fishy, use -x to get verbose logfiles
+set -e -u -x
+
+RECON_SUFFIX=$1
+PYTHON_HELPER_SCRIPT="${HOME}/clinical_dmri_benchmark/analysis/data_processing/mask_store.py"
+
+source /cbica/projects/clinical_dmri_benchmark/micromamba/etc/profile.d/micromamba.sh
+
+micromamba activate clinical_dmri_benchmark
+
+python3 ${PYTHON_HELPER_SCRIPT} --recon_suffix ${RECON_SUFFIX}
+
+micromamba deactivate
+
+echo SUCCESS
@@ -0,0 +1,109 @@
+import numpy as np
+import pandas as pd
+
+RUNS = ["run-01", "run-02"]
+SCAN_NAME_PATTERN = r"^(?P<subject_id>.+)_(?P<run>run-\d+)$"
+
+
+class ScanIndex:
+    """
+    Maps scans, identified by (subject_id, run), to integer positions in the rows and columns
+    of a scans x scans matrix (e.g., a Dice matrix).
+
+    Lookups are hash based (O(1) per scan), and aligning several matrices or removing isolates
+    yields integer positions such that every matrix is extracted with a single fancy index.
+
+    Args:
+      subject_ids: Array of subject IDs, one per matrix row.
+      runs: Array of runs (e.g., "run-01"), one per matrix row.
+    """
+
+    def __init__(self, subject_ids, runs):
+        self.subject_ids = np.asarray(subject_ids, dtype=str)
+        self.runs = np.asarray(runs, dtype=str)
+        self.scan_names = np.char.add(np.char.add(self.subject_ids, "_"), self.runs)
+        self._index = pd.Index(self.scan_names)
+        if not self._index.is_unique:
+            raise ValueError("Scans must be unique.")
+
+    @classmethod
+    def from_scan_names(cls, scan_names):
+        """Builds the index from scan names "<subject_id>_<run>" (e.g., the Dice matrix IDs)."""
+        parts = pd.Series(np.asarray(scan_names, dtype=str)).str.extract(SCAN_NAME_PATTERN)
+        if parts.isna().any().any():
+            raise ValueError("Scan names must have the form <subject_id>_run-<run>.")
+        return cls(parts["subject_id"].values, parts["run"].values)
+
+    @classmethod
+    def from_subjects(cls, subject_ids, runs=RUNS):
+        """Builds the index of all runs of the given subjects, ordered by subject and then run."""
+        subject_ids = np.asarray(subject_ids, dtype=str)
+        return cls(np.repeat(subject_ids, len(runs)), np.tile(runs, len(subject_ids)))
+
+    def __len__(self):
+        return len(self.scan_names)
+
+    def position(self, subject_id: str, run: str) -> int:
+        """Returns the position of a scan. Raises a KeyError if the scan is not in the index."""
+        return self._index.get_loc(subject_id + "_" + run)
+
+    def positions(self, scan_names) -> np.ndarray:
+        """Returns the positions of the given scan names, -1 for scans not in the index."""
+        return self._index.get_indexer(np.asarray(scan_names, dtype=str))
+
+    def subset(self, positions) -> "ScanIndex":
+        """Returns the index of the scans at the given positions (or boolean mask), in that order."""
+        return ScanIndex(self.subject_ids[positions], self.runs[positions])
+
+    def intersection(self, *others: "ScanIndex"):
+        """
+        Aligns this index with any number of other indices.
+
+        Returns:
+          A tuple of the index of the scans present in all indices (in the order of this index)
+          and a list with the positions of these scans in this and each other index.
+        """
+        common = np.ones(len(self), dtype=bool)
+        for other in others:
+            common &= other.positions(self.scan_names) >= 0
+        common_index = self.subset(common)
+        return common_index, [np.flatnonzero(common)] + [
+            other.positions(common_index.scan_names) for other in others]
+
+    def isolate_mask(self) -> np.ndarray:
+        """Returns a boolean mask of the scans whose subject has more than one scan in the index."""
+        _, inverse, counts = np.unique(
+            self.subject_ids, return_inverse=True, return_counts=True)
+        return counts[inverse] > 1
+
+    def without_isolates(self):
+        """Returns the index without isolates and the positions of the remaining scans."""
+        keep = np.flatnonzero(self.isolate_mask())
+        return self.subset(keep), keep
+
+
+def extract(matrix: np.ndarray, positions: np.ndarray) -> np.ndarray:
+    """Extracts the rows and columns at the given positions of a square matrix in a single step."""
+    return matrix[np.ix_(positions, positions)]
+
+
+def align_matrices(matrices: list, indices: list, remove_isolates: bool = True):
+    """
+    Restricts scans x scans matrices of different reconstructions to the scans present in all
+    of them, optionally without isolates, with one fancy-index extraction per matrix.
+
+    Args:
+      matrices: List of square matrices.
+      indices: List of the ScanIndex of each matrix. Indices beyond the number of matrices
+      only restrict the common scans.
+      remove_isolates: Also remove scans whose subject has only one remaining scan.
+
+    Returns:
+      A tuple of the list of aligned matrices (rows in the order of the first matrix) and the
+      ScanIndex of their rows.
+    """
+    common_index, positions = indices[0].intersection(*indices[1:])
+    if remove_isolates:
+        common_index, keep = common_index.without_isolates()
+        positions = [position[keep] for position in positions]
+    return [extract(matrix, position) for matrix, position in zip(matrices, positions)], common_index
@@ -1,12 +1,16 @@
 #!/usr/bin/env python
 import argparse
 import os
+import sys
 import logging
 
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from inventory import query_directories, query_subjects  # noqa: E402
+
 logging.basicConfig(level=logging.INFO)
 
 
-def get_reconstructed_subjects(qsirecon_outputs: str, qsirecon_suffix: str):
+def get_reconstructed_subjects(qsirecon_outputs: str, qsirecon_suffix: str, inventory_path: str = None):
     """
     Returns a list of all subject ids that have been reconstructed with
     the speficified method but not yet warped to MNI space
@@ -15,6 +19,8 @@ def get_reconstructed_subjects(qsirecon_outputs: str, qsirecon_suffix: str):
       qsirecon_outputs: Path to folder containing all qsirecon outputs
       qsirecon_suffix: qsirecon suffix to specifiy which reconstruction method we are checking.
       Should be one of 'GQIautotrack', 'SS3Tautotrack', 'CSDautotrack', 'SS3T', 'CSD'
+      inventory_path: Optional inventory of the outputs (see data_processing/inventory.py) to
+      query instead of listing the subject directories. Has to be up to date.
 
     Returns:
       List of subjects that have already been reconstructed with the specified reconstruction method
@@ -42,6 +48,13 @@ def get_reconstructed_subjects(qsirecon_outputs: str, qsirecon_suffix: str):
         )
         return []
 
+    if inventory_path is not None:
+        directories = query_directories(inventory_path, full_path_qsirecon_outputs)
+        return [
+            subid for subid in query_subjects(inventory_path, full_path_qsirecon_outputs)
+            if os.path.join(subid, "ses-PNC1", "dwi", "MNI") not in directories
+        ]
+
     reconstructed_subIDs = [
         f
         for f in os.listdir(full_path_qsirecon_outputs)
@@ -67,6 +80,12 @@ parser.add_argument(
     required=True,
     help="Reconstruction method (e.g., GQIautotrack)",
 )
+parser.add_argument(
+    "--inventory",
+    type=str,
+    default=None,
+    help="Optional inventory of the outputs (data_processing/inventory.py) to query instead of listing directories",
+)
 args = parser.parse_args()
 
 QSIRECON_SUFFIX = args.recon_suffix
@@ -74,7 +93,7 @@ OUTPUTS_QSIRECON = "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_out
 
 
 reconstructed_subjects = get_reconstructed_subjects(
-    OUTPUTS_QSIRECON, QSIRECON_SUFFIX
+    OUTPUTS_QSIRECON, QSIRECON_SUFFIX, args.inventory
 )
 
 
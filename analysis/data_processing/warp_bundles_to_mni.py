@@ -0,0 +1,287 @@
+#!/usr/bin/env python
+import argparse
+import gzip
+import os
+import re
+import numpy as np
+import pandas as pd
+import nibabel as nb
+import SimpleITK as sitk
+from scipy.ndimage import map_coordinates
+
+from mask_store import RUNS, get_geometry, write_fragment
+
+NATIVE_BUNDLE_PATTERN = re.compile(
+    r"^(?P<prefix>(?P<subject_id>sub-[^_]+)_ses-PNC1(?:_[^_]+)*?_(?P<run>run-\d+))"
+    r"_space-T1w_bundle-(?P<bundle>[^_]+)_streamlines\.tck\.gz$"
+)
+# Number of streamline points of several bundles that are warped at once
+BATCH_POINTS = 2**22
+# Segments between streamline points are subdivided into steps of at most this fraction of the
+# MNI voxel size before they are mapped to voxels (as tckmap does by default)
+UPSAMPLE_STEP = 0.1
+
+
+def list_native_bundles(bundles_root: str, run: str, bundles: list) -> list:
+    """Lists the native space streamline files of the given bundles of one run with a single
+    directory scan.
+
+    Args:
+      bundles_root: The "ses-PNC1/dwi" directory of one subject in the qsirecon outputs.
+      run: Run of the bundles (e.g., run-01).
+      bundles: List of bundle names without underscores and dashes.
+
+    Returns:
+      List of (file name prefix, bundle, path) tuples in the order of bundles.
+    """
+    found = {}
+    with os.scandir(bundles_root) as entries:
+        for entry in entries:
+            match = NATIVE_BUNDLE_PATTERN.match(entry.name)
+            if match and match["run"] == run:
+                found[match["bundle"]] = (match["prefix"], match["bundle"], entry.path)
+    return [found[bundle] for bundle in bundles if bundle in found]
+
+
+def load_warp(warp_path: str):
+    """Loads an inverse warp (as created by warpcorrect) mapping native space to MNI space.
+
+    Each voxel of the warp holds the MNI coordinates (RAS+ mm) of its position in native space.
+
+    Returns:
+      A tuple of the list of the three contiguous float32 coordinate volumes and the
+      affine mapping native RAS+ mm to voxel coordinates of the warp.
+    """
+    warp_img = nb.load(warp_path)
+    warp = warp_img.get_fdata(dtype=np.float32).reshape(warp_img.shape[:3] + (3,))
+    components = [np.ascontiguousarray(warp[..., i]) for i in range(3)]
+    return components, np.linalg.inv(warp_img.affine)
+
+
+def read_tck(tck_path: str):
+    """Reads the points and the number of points of each streamline of a (gzip compressed) tck file."""
+    opener = gzip.open if tck_path.endswith(".gz") else open
+    with opener(tck_path, "rb") as tckf:
+        streamlines = nb.streamlines.TckFile.load(tckf).streamlines
+    lengths = np.fromiter((len(streamline) for streamline in streamlines), dtype=np.int64,
+                          count=len(streamlines))
+    return streamlines.get_data(), lengths
+
+
+def warp_points(points: np.ndarray, warp_components: list, ras_to_voxel: np.ndarray) -> np.ndarray:
+    """Warps points with trilinear interpolation of an inverse warp (see load_warp).
+
+    Points outside of the warp or at voxels without a valid warp are set to NaN.
+
+    Args:
+      points: n x 3 array of points in native RAS+ mm.
+      warp_components: The three coordinate volumes of the warp.
+      ras_to_voxel: Affine mapping native RAS+ mm to voxel coordinates of the warp.
+
+    Returns:
+      n x 3 float32 array of the points in MNI RAS+ mm.
+    """
+    coordinates = nb.affines.apply_affine(ras_to_voxel, points).T
+    shape = np.array(warp_components[0].shape)[:, None]
+    # Positions within half a voxel of the outer voxel centers take the value of the outer voxel
+    inside = np.all((coordinates >= -0.5) & (coordinates <= shape - 0.5), axis=0)
+    warped = np.empty((3, len(points)), dtype=np.float32)
+    for i, component in enumerate(warp_components):
+        map_coordinates(component, coordinates, output=warped[i], order=1, mode="nearest")
+    warped[:, ~inside] = np.nan
+    return warped.T
+
+
+def rasterize_streamlines(points: np.ndarray, lengths: np.ndarray, ras_to_voxel: np.ndarray,
+                          shape: tuple, max_step: float) -> np.ndarray:
+    """Maps streamlines to the voxels of a grid they pass through.
+
+    The segments between consecutive points of a streamline are subdivided into steps of at most
+    max_step mm and every step is assigned to the nearest voxel. Segments with a point that is
+    NaN (see warp_points) are skipped.
+
+    Args:
+      points: n x 3 array of the points of all streamlines in RAS+ mm.
+      lengths: Number of points of each streamline.
+      ras_to_voxel: Affine mapping RAS+ mm to voxel coordinates of the grid.
+      shape: Shape of the grid.
+      max_step: Maximum distance in mm between subsequent positions that are mapped.
+
+    Returns:
+      Boolean mask of the grid.
+    """
+    mask = np.zeros(shape, dtype=bool)
+    voxels = nb.affines.apply_affine(ras_to_voxel, points)
+    valid = np.all(np.isfinite(voxels), axis=1)
+    mark_voxels(mask, voxels[valid])
+
+    # Segments from each point to the next one of the same streamline
+    is_last = np.zeros(len(points), dtype=bool)
+    is_last[np.cumsum(lengths)[lengths > 0] - 1] = True
+    starts = np.flatnonzero(~is_last & valid & np.roll(valid, -1))
+    steps = np.linalg.norm(points[starts + 1] - points[starts], axis=1)
+    n_substeps = np.maximum(np.ceil(steps / max_step), 1).astype(np.int64)
+
+    # The positions along the segments are mapped in batches of about BATCH_POINTS positions
+    substeps_before = np.cumsum(n_substeps) - n_substeps
+    batch_start = 0
+    while batch_start < len(starts):
+        batch_end = max(batch_start + 1, np.searchsorted(
+            substeps_before, substeps_before[batch_start] + BATCH_POINTS))
+        segment_starts = starts[batch_start:batch_end]
+        segment_substeps = n_substeps[batch_start:batch_end]
+        segment = np.repeat(np.arange(len(segment_starts)), segment_substeps)
+        substep = np.arange(len(segment)) - np.repeat(
+            substeps_before[batch_start:batch_end] - substeps_before[batch_start], segment_substeps)
+        origin = voxels[segment_starts[segment]]
+        direction = voxels[segment_starts[segment] + 1] - origin
+        mark_voxels(mask, origin + (substep / segment_substeps[segment])[:, None] * direction)
+        batch_start = batch_end
+    return mask
+
+
+def mark_voxels(mask: np.ndarray, positions: np.ndarray):
+    """Sets the voxels of the mask nearest to the given voxel positions that lie within the grid."""
+    indices = np.rint(positions).astype(np.int64)
+    inside = np.all((indices >= 0) & (indices < np.array(mask.shape)), axis=1)
+    mask[tuple(indices[inside].T)] = True
+    return
+
+
+def iter_bundle_batches(native_bundles: list):
+    """Groups bundles into batches of about BATCH_POINTS streamline points.
+
+    Args:
+      native_bundles: List of (file name prefix, bundle, path) tuples (see list_native_bundles).
+
+    Yields:
+      Lists of (file name prefix, bundle, points, lengths) tuples.
+    """
+    batch = []
+    n_points = 0
+    for prefix, bundle, tck_path in native_bundles:
+        points, lengths = read_tck(tck_path)
+        batch.append((prefix, bundle, points, lengths))
+        n_points += len(points)
+        if n_points >= BATCH_POINTS:
+            yield batch
+            batch = []
+            n_points = 0
+    if batch:
+        yield batch
+
+
+def mask_dice(mask_1: np.ndarray, mask_2: np.ndarray) -> float:
+    """Returns the Dice score of two binary masks (NaN if both are empty)."""
+    total = np.count_nonzero(mask_1) + np.count_nonzero(mask_2)
+    if total == 0:
+        return np.nan
+    return 2 * np.count_nonzero(mask_1 & mask_2) / total
+
+
+def warp_subject_bundles(subject_id: str, bundles_root: str, warp_paths: dict, reference_path: str,
+                         bundles: list, store_root: str = None, validation_csv: str = None):
+    """Warps all bundles of a subject to MNI space and maps them to binary masks on the MNI grid.
+
+    This replaces the tcktransform, tckmap and mrthreshold calls per bundle: the inverse warp of
+    each run is loaded once, the points of several bundles are warped together with one trilinear
+    interpolation (see warp_points) and the warped streamlines are mapped directly to masks of the
+    reference grid (see rasterize_streamlines). No MNI space tck or TDI files are written.
+
+    Args:
+      subject_id: ID of the subject (e.g., sub-1).
+      bundles_root: The "ses-PNC1/dwi" directory of the subject in the qsirecon outputs. The masks
+      are written to its "MNI" subdirectory.
+      warp_paths: Dictionary with the path of the corrected inverse warp (NIfTI) of each run.
+      reference_path: MNI reference image defining the grid of the masks.
+      bundles: List of bundle names without underscores and dashes.
+      store_root: Optional directory of the mask store of the reconstruction. If given, the masks
+      are written as a fragment of the store (see mask_store.write_fragment) instead of NIfTI files.
+      validation_csv: Optional csv file. If given, no masks are written. Instead, the Dice score
+      of each mask with the existing mask of the "MNI" subdirectory (created with tcktransform,
+      tckmap and mrthreshold) is saved to it, to check the masks before switching to this script.
+    """
+    reference = nb.load(reference_path)
+    reference_shape = reference.shape[:3]
+    reference_ras_to_voxel = np.linalg.inv(reference.affine)
+    max_step = UPSAMPLE_STEP * min(reference.header.get_zooms()[:3])
+    mni_root = os.path.join(bundles_root, "MNI")
+    if store_root is None and validation_csv is None:
+        os.makedirs(mni_root, exist_ok=True)
+
+    store_masks = {}
+    validation = []
+    for run in RUNS:
+        native_bundles = list_native_bundles(bundles_root, run, bundles)
+        if not native_bundles:
+            print(f"No bundles found for {subject_id} {run}, skipping.")
+            continue
+        warp_components, warp_ras_to_voxel = load_warp(warp_paths[run])
+        for batch in iter_bundle_batches(native_bundles):
+            warped = warp_points(np.concatenate([points for _, _, points, _ in batch]),
+                                 warp_components, warp_ras_to_voxel)
+            offset = 0
+            for prefix, bundle, points, lengths in batch:
+                mask = rasterize_streamlines(warped[offset:offset + len(points)], lengths,
+                                             reference_ras_to_voxel, reference_shape, max_step)
+                offset += len(points)
+                mask_path = os.path.join(
+                    mni_root, f"{prefix}_space-MNI152NLin2009cAsym_bundle-{bundle}_mask.nii.gz")
+                if validation_csv is not None:
+                    if os.path.exists(mask_path):
+                        existing = np.asarray(nb.load(mask_path).dataobj) > 0
+                        validation.append({"subject_id": subject_id, "run": run, "bundle": bundle,
+                                           "dice": mask_dice(mask, existing),
+                                           "voxels": np.count_nonzero(mask),
+                                           "existing_voxels": np.count_nonzero(existing)})
+                    continue
+                if store_root is not None:
+                    # Flat voxel indices of the (z, y, x) array of the mask (see mask_store)
+                    store_masks[(run, bundle)] = np.flatnonzero(mask.ravel(order="F"))
+                    continue
+                mask_img = nb.Nifti1Image(mask.astype(np.uint8), reference.affine, reference.header)
+                mask_img.set_data_dtype(np.uint8)
+                nb.save(mask_img, mask_path)
+            print(f"Warped {', '.join(bundle for _, bundle, _, _ in batch)} of {subject_id} {run}")
+
+    if validation_csv is not None:
+        validation = pd.DataFrame(validation, columns=["subject_id", "run", "bundle", "dice", "voxels",
+                                                       "existing_voxels"])
+        validation.to_csv(validation_csv, index=False)
+        print(f"Median Dice with the existing masks of {subject_id}: {validation['dice'].median()}")
+        return
+    if store_root is not None:
+        write_fragment(store_root, subject_id, store_masks,
+                       get_geometry(sitk.ReadImage(reference_path)))
+    return
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Warp bundles to MNI space and calculate binary masks")
+    parser.add_argument("subid", type=str,
+                        help="ID of the subject currently being processed")
+    parser.add_argument("--recon_suffix", type=str, required=True,
+                        help="Reconstruction method (e.g., GQIautotrack)")
+    parser.add_argument("--mask_store", action="store_true",
+                        help="Write the masks as a fragment of the mask store of the reconstruction instead of "
+                        "NIfTI files (combine the fragments with mask_store.py --merge_fragments)")
+    parser.add_argument("--validation_csv", type=str, default=None,
+                        help="Instead of writing masks, save the Dice score of each mask with the existing "
+                        "(tckmap) mask of the subject to this csv file")
+    args = parser.parse_args()
+
+    MNI_REF_IMG = "/cbica/comp_space/clinical_dmri_benchmark/data/MNI/mni_1mm_t1w_lps_brain.nii"
+    ROOT_PREP = os.path.join("/cbica/projects/clinical_dmri_benchmark/results/qsiprep_outputs", args.subid)
+    ROOT_BUNDLES = os.path.join("/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs",
+                                "qsirecon-" + args.recon_suffix, args.subid, "ses-PNC1", "dwi")
+    STORE_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/mask_store/" + args.recon_suffix
+    BUNDLE_NAMES = "/cbica/projects/clinical_dmri_benchmark/clinical_dmri_benchmark/data/bundle_names.txt"
+
+    with open(BUNDLE_NAMES, "r") as f:
+        bundles = [bundle.replace("_", "").replace("-", "") for bundle in f.read().splitlines()]
+    # Created by warp_bundles_to_mni_and_mask_helper.sh
+    warp_paths = {run: os.path.join(ROOT_PREP, "anat", "mrtrix_transform_files", run,
+                                    "inv_mrtrix_warp_corrected.nii") for run in RUNS}
+
+    warp_subject_bundles(args.subid, ROOT_BUNDLES, warp_paths, MNI_REF_IMG, bundles,
+                         STORE_ROOT if args.mask_store else None, args.validation_csv)
@@ -30,6 +30,10 @@ ROOT_PREP="${HOME}/results/qsiprep_outputs/${subid}"
 ROOT_RECON="${HOME}/results/qsirecon_outputs/qsirecon-${RECON_SUFFIX}"
 BUNDLE_NAMES="${HOME}/clinical_dmri_benchmark/data/bundle_names.txt"
 HELPER_SCRIPT="${HOME}/clinical_dmri_benchmark/analysis/data_processing/warp_bundles_to_mni_and_mask_helper.sh"
+PYTHON_HELPER_SCRIPT="${HOME}/clinical_dmri_benchmark/analysis/data_processing/warp_bundles_to_mni.py"
+# Optional second argument --mask_store to write the masks as a fragment of the mask store instead of NIfTI files,
+# or "--validation_csv <path>" to only compare the masks with the existing tckmap masks of the subject
+MASK_STORE_FLAG="${2:-}"
 
 
 ROOT_BUNDLES="${ROOT_RECON}/${subid}/ses-PNC1/dwi"
@@ -42,3 +46,13 @@ singularity exec --containall -B "${ROOT_BUNDLES}":/root_bundles \
     "${HOME}/images/qsirecon-0.23.2.sif" \
     /bin/bash /img/warp_bundles_to_mni_and_mask_helper.sh "${subid}"
 
+# Warp all bundles with the corrected inverse warps and map them to masks on the MNI grid
+source /cbica/projects/clinical_dmri_benchmark/micromamba/etc/profile.d/micromamba.sh
+
+micromamba activate clinical_dmri_benchmark
+
+python3 ${PYTHON_HELPER_SCRIPT} "${subid}" --recon_suffix "${RECON_SUFFIX}" ${MASK_STORE_FLAG}
+
+micromamba deactivate
+
+echo SUCCESS
@@ -48,44 +48,8 @@ do
         --default-value 2147483647
     done
 
-    # 3. Fix warp
+    # 3. Fix warp. Written as NIfTI such that warp_bundles_to_mni.py can read it to warp and map all bundles
     warpcorrect "${ROOT_MRTRIX_TRANSFORM_FILES_RUN}/inv_mrtrix_warp[].nii" \
-    "${ROOT_MRTRIX_TRANSFORM_FILES_RUN}/inv_mrtrix_warp_corrected.mif" \
+    "${ROOT_MRTRIX_TRANSFORM_FILES_RUN}/inv_mrtrix_warp_corrected.nii" \
     -marker 2147483647 -force
-
-    # Iterate over all bundles to warp them to MNI space and calculate a 3D mask
-    mapfile -t bundle_array < /data/bundle_names.txt
-    for bundle in "${bundle_array[@]}";
-    do
-        BUNDLE=${bundle//[_-]/}
-        bundle_path=/root_bundles/${SUBID}_ses-PNC1*_${run}_space-T1w_bundle-${BUNDLE}_streamlines.tck.gz
-        if compgen -G "${bundle_path}" > /dev/null; then
-            PATH_NATIVE_BUNDLE=$(ls ${bundle_path})
-            file_name=$(basename "$PATH_NATIVE_BUNDLE")
-            file_name_prefix="${file_name%%_space-T1w_*}_space"
-
-            PATH_MNI_BUNDLE="${ROOT_BUNDLES_MNI}/${file_name_prefix}-MNI152NLin2009cAsym_bundle-${BUNDLE}_streamlines.tck"
-        
-            gunzip -f "${PATH_NATIVE_BUNDLE}"
-            # 4. Transform bundle file
-            tcktransform "/root_bundles/${file_name_prefix}-T1w_bundle-${BUNDLE}_streamlines.tck" \
-            "${ROOT_MRTRIX_TRANSFORM_FILES_RUN}/inv_mrtrix_warp_corrected.mif" \
-            "${PATH_MNI_BUNDLE}" -force
-
-            gzip "/root_bundles/${file_name_prefix}-T1w_bundle-${BUNDLE}_streamlines.tck"
-
-            # 5. calculate binary mask of bundle in MNI space
-            tckmap "${PATH_MNI_BUNDLE}" "${ROOT_BUNDLES_MNI}/${file_name_prefix}-MNI152NLin2009cAsym_bundle-${BUNDLE}_mask.nii" --template /mni/ref_image.nii --contrast tdi -force
-
-            mrthreshold -abs 0 -comparison gt "${ROOT_BUNDLES_MNI}/${file_name_prefix}-MNI152NLin2009cAsym_bundle-${BUNDLE}_mask.nii" \
-                "${ROOT_BUNDLES_MNI}/${file_name_prefix}-MNI152NLin2009cAsym_bundle-${BUNDLE}_mask.nii" -force
-
-            gzip "${PATH_MNI_BUNDLE}"
-            gzip "${ROOT_BUNDLES_MNI}/${file_name_prefix}-MNI152NLin2009cAsym_bundle-${BUNDLE}_mask.nii"
-
-            else
-                echo "File ${bundle_path} does not exist, skipping."
-                continue
-            fi
-    done
 done
@@ -1,10 +1,23 @@
 import os
+import sys
 import numpy as np
 import pandas as pd
 import argparse
-import glob
+import zlib
 import SimpleITK as sitk
-from scipy.sparse import csr_matrix
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from scipy.sparse import csr_matrix, vstack
+
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "data_processing"))
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "overlay_maps"))
+from mask_store import get_array_shape, get_scan_voxels, read_geometry, scan_mni_masks, voxels_to_csr  # noqa: E402
+from scan_index import ScanIndex  # noqa: E402
+from bounding_boxes import BoundingBoxError, crop_array, crop_flat_indices, load_bounding_boxes  # noqa: E402
+from dice_matrix import (  # noqa: E402
+    export_dice_csv, get_dice_paths, read_mask_checksums, read_packed_dice_matrix, save_dice_matrix,
+    triu_row_offsets, write_mask_checksums, write_scan_ids)
 
 
 def get_subject_ids(qsirecon_outputs: str, excluded_subjects: str = None) -> list:
@@ -38,92 +51,634 @@ def get_subject_ids(qsirecon_outputs: str, excluded_subjects: str = None) -> lis
     return subjects
 
 
-def load_masks_as_numpy(qsirecon_root, subject_ids, bundle):
+def load_masks_as_numpy(qsirecon_root, subject_ids, bundle, io_workers=1, bounding_box=None):
     """
-    Loads all masks into memory as NumPy arrays and stores them in a dictionary.
+    Loads all masks into memory as sparse NumPy arrays and stores them in a dictionary.
+
+    Each subject's MNI directory is listed with a single directory scan and the masks are
+    decoded on a thread pool (SimpleITK releases the GIL while reading).
 
     Args:
       qsirecon_root: Root directory where subject folders are stored.
       subject_ids: List of subject IDs.
       bundle: The specific bundle name for which masks are loaded.
+      io_workers: Number of threads used to list directories and read masks.
+      bounding_box: Optional (start, stop) bounding box of the bundle in (z, y, x) order
+      (see overlay_maps/bounding_boxes.py). If given, masks are cropped to it when loaded.
+
+    Returns:
+      A dictionary with keys as (subject_id, run) tuples and values as sparse masks.
+    """
+    mask_paths = list_all_bundle_masks(
+        qsirecon_root, subject_ids, io_workers).get(bundle, {})
+    return read_masks(mask_paths, io_workers, bounding_box)
+
+
+def read_mask_as_sparse(mask_path, bounding_box=None):
+    """Reads a NIfTI mask, optionally crops it to a bounding box and returns it flattened
+    as a 1 x voxels sparse row."""
+    mask_image = sitk.ReadImage(mask_path)
+    mask_array = sitk.GetArrayFromImage(mask_image)
+    if bounding_box is not None:
+        mask_array = crop_array(mask_array, bounding_box)
+    return csr_matrix(mask_array.flatten())
+
+
+def read_masks(mask_paths, io_workers=1, bounding_box=None):
+    """
+    Reads NIfTI masks on a thread pool.
+
+    Args:
+      mask_paths: Dictionary mapping (subject_id, run) tuples to mask paths.
+      io_workers: Number of threads used to read masks.
+      bounding_box: Optional bounding box the masks are cropped to.
 
     Returns:
-      A dictionary with keys as (subject_id, run) tuples and values as NumPy arrays of masks.
+      A dictionary with the same keys and sparse masks as values.
     """
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        sparse_masks = list(executor.map(
+            lambda mask_path: read_mask_as_sparse(mask_path, bounding_box), mask_paths.values()))
+    return dict(zip(mask_paths.keys(), sparse_masks))
+
+
+def list_all_bundle_masks(qsirecon_root, subject_ids, io_workers=1):
+    """
+    Lists the MNI masks of all bundles with a single directory scan per subject.
+
+    Args:
+      qsirecon_root: Root directory where subject folders are stored.
+      subject_ids: List of subject IDs.
+      io_workers: Number of threads used to list the subject directories.
+
+    Returns:
+      A dictionary with bundle names as keys and dictionaries mapping (subject_id, run)
+      tuples to mask paths as values.
+    """
+    mni_dirs = [
+        os.path.join(qsirecon_root, subject_id, "ses-PNC1", "dwi", "MNI")
+        for subject_id in subject_ids
+    ]
+    with ThreadPoolExecutor(max_workers=io_workers) as executor:
+        subject_masks = list(executor.map(scan_mni_masks, mni_dirs))
+    mask_paths = {}
+    for subject_id, found_masks in zip(subject_ids, subject_masks):
+        for _, run, bundle, mask_path in sorted(found_masks):
+            mask_paths.setdefault(bundle, {}).setdefault(
+                (subject_id, run), mask_path)
+    return mask_paths
+
+
+def load_masks_from_store(store_root, subject_ids, bundle, bounding_box=None):
+    """
+    Loads all masks of a bundle from a mask store (see data_processing/mask_store.py)
+    instead of decompressing the NIfTI files.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+      subject_ids: List of subject IDs.
+      bundle: The specific bundle name for which masks are loaded.
+      bounding_box: Optional bounding box the masks are cropped to.
+
+    Returns:
+      A dictionary with keys as (subject_id, run) tuples and values as sparse masks.
+    """
+    full_shape = get_array_shape(read_geometry(store_root))
+    if bounding_box is not None:
+        n_voxels = int(np.prod(bounding_box[1] - bounding_box[0]))
+    else:
+        n_voxels = int(np.prod(full_shape))
+    scan_voxels = get_scan_voxels(store_root, bundle)
     masks = {}
     for subject_id in subject_ids:
         for run in ["run-01", "run-02"]:
-            mask_path = glob.glob(
-                f"{qsirecon_root}/{subject_id}/ses-PNC1/dwi/MNI/{subject_id}_ses-PNC1*_{run}_space-MNI152NLin2009cAsym_bundle-{bundle}_mask.nii.gz"
-            )
-            if mask_path:
-                mask_image = sitk.ReadImage(mask_path[0])
-                mask_array = sitk.GetArrayFromImage(mask_image)
-                sparse_mask = csr_matrix(mask_array.flatten())
-                masks[(subject_id, run)] = sparse_mask
+            if (subject_id, run) in scan_voxels:
+                voxel_indices = scan_voxels[(subject_id, run)]
+                if bounding_box is not None:
+                    voxel_indices = crop_flat_indices(
+                        voxel_indices, full_shape, bounding_box)
+                masks[(subject_id, run)] = voxels_to_csr(
+                    voxel_indices, n_voxels)
     return masks
 
 
-def dice_coefficient_numpy(mask1, mask2):
+def get_scan_ids(subject_ids):
+    """Returns the (subject_id, run) tuples of both runs of all subjects in matrix order."""
+    return [
+        (subject_id, run) for subject_id in subject_ids for run in ["run-01", "run-02"]
+    ]
+
+
+def stack_masks(scan_ids, masks):
     """
-    Calculate Dice coefficient between two binary masks in NumPy.
+    Stacks the masks of all scans into one scans x voxels sparse binary matrix.
 
     Args:
-      mask1: NumPy array for the first mask.
-      mask2: NumPy array for the second mask.
+      scan_ids: List of (subject_id, run) tuples defining the row order.
+      masks: Dictionary containing preloaded masks with (subject_id, run) as keys.
 
     Returns:
-      Dice coefficient as a float.
+      A tuple of the stacked CSR matrix (int32 data, one row per scan, empty rows
+      for missing scans) and a boolean array indicating which scans have a mask.
     """
-    intersection = mask1.multiply(mask2).count_nonzero()
-    sum_masks = mask1.count_nonzero() + mask2.count_nonzero()
-    return 2.0 * intersection / sum_masks if sum_masks > 0 else np.nan
+    present = np.array([scan_id in masks for scan_id in scan_ids], dtype=bool)
+    n_voxels = next(iter(masks.values())).shape[1] if masks else 0
+    rows = [
+        masks[scan_id] if scan_id in masks else csr_matrix((1, n_voxels))
+        for scan_id in scan_ids
+    ]
+    if not rows:
+        return csr_matrix((0, n_voxels), dtype=np.int32), present
+    stacked = vstack(rows, format="csr")
+    # Binarize such that the matrix product counts overlapping voxels
+    stacked.eliminate_zeros()
+    stacked.data = np.ones(stacked.nnz, dtype=np.int32)
+    return stacked, present
 
 
-def calculate_dice_scores(subject_ids, masks):
+def stack_bundle_masks(subject_ids, masks):
     """
-    Calculate Dice scores for each pair of masks.
+    Stacks the loaded masks of one bundle in matrix order (see stack_masks) and empties the
+    dictionary of per-scan masks, so that only the stacked copy is alive while the Dice
+    scores are computed (see get_tile_size).
 
     Args:
       subject_ids: List of subject IDs.
-      masks: Dictionary containing preloaded masks with (subject_id, run) as keys.
+      masks: Dictionary containing preloaded masks with (subject_id, run) as keys. It is
+      cleared once the masks are stacked.
 
     Returns:
-      A DataFrame containing Dice scores for each pair of masks.
-    """
-    sbj_ids_duplicated = []
-    runs = []
-    for id in subject_ids:
-        sbj_ids_duplicated.append(id)
-        runs.append("run-01")
-        sbj_ids_duplicated.append(id)
-        runs.append("run-02")
-
-    dice_array = np.zeros([len(subject_ids * 2), len(subject_ids * 2)]) - 1
-    indexes_header = []
-    for i, sbj_run_1 in enumerate(zip(sbj_ids_duplicated, runs)):
-        sbj_id_1 = sbj_run_1[0]
-        run_1 = sbj_run_1[1]
-        indexes_header.append(sbj_id_1 + "_" + run_1)
-        if (sbj_run_1 in masks) == False:
-            dice_array[i, :] = np.nan
-            continue
-        mask1 = masks[sbj_run_1]
-        for j, sbj_run_2 in enumerate(zip(sbj_ids_duplicated, runs)):
-            if dice_array[i, j] != -1 and dice_array[j, i] != -1:
-                continue
-            if (sbj_run_2 in masks) == False:
-                dice_array[i, j] = np.nan
-                dice_array[j, i] = np.nan
-            else:
-                mask2 = masks[sbj_run_2]
-                dice_coefficient = dice_coefficient_numpy(mask1, mask2)
-                dice_array[i, j] = dice_coefficient
-                dice_array[j, i] = dice_coefficient
-    dice_df = pd.DataFrame(index=indexes_header, columns=indexes_header)
-    for i in range(dice_array.shape[0]):
-        dice_df.loc[indexes_header[i]] = dice_array[i, :]
-    return dice_df
+      Same as stack_masks.
+    """
+    stacked, present = stack_masks(get_scan_ids(subject_ids), masks)
+    masks.clear()
+    return stacked, present
+
+
+def dice_between_blocks(rows_1, present_1, rows_2, present_2):
+    """
+    Calculate the Dice coefficients between every row of one block of stacked masks
+    and every row of another block.
+
+    All intersections are obtained from a single sparse matrix product and the Dice
+    coefficients from a broadcast over the number of voxels per mask.
+
+    Args:
+      rows_1: Sparse binary matrix of shape scans_1 x voxels.
+      present_1: Boolean array marking the scans of rows_1 that have a mask.
+      rows_2: Sparse binary matrix of shape scans_2 x voxels.
+      present_2: Boolean array marking the scans of rows_2 that have a mask.
+
+    Returns:
+      Dense NumPy array of shape scans_1 x scans_2 containing Dice coefficients.
+      Rows and columns of scans without a mask are NaN.
+    """
+    intersections = (rows_1 @ rows_2.T).toarray()
+    sum_masks = np.diff(rows_1.indptr)[:, None] + np.diff(rows_2.indptr)[None, :]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dice_array = np.where(
+            sum_masks > 0, 2.0 * intersections / sum_masks, np.nan)
+    dice_array[~present_1, :] = np.nan
+    dice_array[:, ~present_2] = np.nan
+    return dice_array
+
+
+def dice_from_stacked_masks(stacked, present):
+    """
+    Calculate the Dice coefficients between all rows of a stacked mask matrix.
+
+    Args:
+      stacked: Sparse binary matrix of shape scans x voxels.
+      present: Boolean array marking scans that have a mask. Rows and columns of
+      scans without a mask are set to NaN.
+
+    Returns:
+      Dense NumPy array of shape scans x scans containing Dice coefficients.
+    """
+    return dice_between_blocks(stacked, present, stacked, present)
+
+
+def get_tile_size(stacked, max_memory):
+    """
+    Determine the number of scans per tile such that the tiled Dice computation stays
+    within the given memory budget.
+
+    Args:
+      stacked: Sparse binary matrix of shape scans x voxels.
+      max_memory: Memory budget in GB.
+
+    Returns:
+      Number of scans (rows and columns) per tile.
+    """
+    # Besides the stacked masks, each tile entry holds the sparse and dense
+    # intersection counts, the summed voxel counts and the float64 Dice values
+    bytes_per_entry = 40
+    stacked_bytes = stacked.data.nbytes + \
+        stacked.indices.nbytes + stacked.indptr.nbytes
+    available_bytes = max_memory * 1024**3 - 2 * stacked_bytes
+    if available_bytes <= 0:
+        raise ValueError(
+            f"A memory budget of {max_memory} GB does not fit the stacked masks.")
+    tile_size = int(np.sqrt(available_bytes / bytes_per_entry))
+    return max(1, min(tile_size, stacked.shape[0]))
+
+
+def calculate_dice_scores_tiled(stacked, present, output_path, max_memory):
+    """
+    Calculate Dice scores tile by tile and write them to an on-disk float32 memmap.
+
+    Only tiles in the upper triangle are computed. The memmap stores the upper triangle
+    (including the diagonal) of the scans x scans Dice matrix packed row by row, such
+    that memory no longer grows quadratically with the number of scans.
+
+    Args:
+      stacked: Sparse binary matrix of shape scans x voxels.
+      present: Boolean array marking scans that have a mask.
+      output_path: Path of the .npy file the packed upper triangle is written to.
+      max_memory: Memory budget in GB.
+
+    Returns:
+      The memory-mapped packed upper triangle.
+    """
+    n_scans = stacked.shape[0]
+    offsets = triu_row_offsets(n_scans)
+    packed = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=np.float32, shape=(int(offsets[-1]),))
+    tile_size = get_tile_size(stacked, max_memory)
+    for row_start in range(0, n_scans, tile_size):
+        row_stop = min(row_start + tile_size, n_scans)
+        rows_1 = stacked[row_start:row_stop]
+        for col_start in range(row_start, n_scans, tile_size):
+            col_stop = min(col_start + tile_size, n_scans)
+            tile = dice_between_blocks(
+                rows_1, present[row_start:row_stop],
+                stacked[col_start:col_stop], present[col_start:col_stop])
+            write_tile(packed, offsets, tile, row_start, col_start)
+        packed.flush()
+    return packed
+
+
+def write_tile(packed, offsets, tile, row_start, col_start):
+    """Writes the entries of a tile of the Dice matrix that lie in the upper triangle
+    (including the diagonal) to the packed upper triangle."""
+    for i in range(row_start, row_start + tile.shape[0]):
+        first_col = max(col_start, i)
+        col_stop = col_start + tile.shape[1]
+        if first_col < col_stop:
+            packed[offsets[i] + first_col - i:offsets[i] + col_stop - i] = \
+                tile[i - row_start, first_col - col_start:]
+    return
+
+
+def dice_for_pairs(stacked, present, rows_1, rows_2):
+    """
+    Calculate the Dice coefficients of selected pairs of scans only.
+
+    Args:
+      stacked: Sparse binary matrix of shape scans x voxels.
+      present: Boolean array marking scans that have a mask.
+      rows_1: Integer array with the row of the first scan of each pair.
+      rows_2: Integer array with the row of the second scan of each pair.
+
+    Returns:
+      NumPy array with one Dice coefficient per pair. NaN if one of the scans has no mask.
+    """
+    intersections = np.asarray(
+        stacked[rows_1].multiply(stacked[rows_2]).sum(axis=1)).ravel()
+    n_voxels = np.diff(stacked.indptr)
+    sum_masks = n_voxels[rows_1] + n_voxels[rows_2]
+    with np.errstate(divide="ignore", invalid="ignore"):
+        dice = np.where(sum_masks > 0, 2.0 * intersections / sum_masks, np.nan)
+    dice[~present[rows_1] | ~present[rows_2]] = np.nan
+    return dice
+
+
+def sample_between_subject_pairs(n_subjects, n_pairs_per_scan, seed=0):
+    """
+    Randomly sample pairs of scans from different subjects.
+
+    Rows are in the order of get_scan_ids, i.e. the scans of subject i are rows 2i and 2i + 1.
+    Partners are drawn uniformly (with replacement) from the scans of all other subjects.
+
+    Args:
+      n_subjects: Number of subjects.
+      n_pairs_per_scan: Number of between-subject pairs sampled for each scan.
+      seed: Seed of the random number generator.
+
+    Returns:
+      A tuple of two integer arrays with the rows of the first and second scan of each pair.
+    """
+    n_scans = 2 * n_subjects
+    if n_subjects < 2 or n_pairs_per_scan <= 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    rng = np.random.default_rng(seed)
+    rows_1 = np.repeat(np.arange(n_scans), n_pairs_per_scan)
+    # Draw among the n_scans - 2 scans of other subjects and skip the two scans of the own subject
+    rows_2 = rng.integers(0, n_scans - 2, size=len(rows_1))
+    rows_2 += 2 * (rows_2 >= rows_1 - rows_1 % 2)
+    return rows_1, rows_2
+
+
+def calculate_pair_dice_scores(subject_ids, stacked, present, bundle, n_between_pairs=0, seed=0):
+    """
+    Calculate only the within-subject (run-01 vs. run-02) Dice scores and optionally a random
+    sample of between-subject Dice scores instead of the full scans x scans matrix.
+
+    Args:
+      subject_ids: List of subject IDs.
+      stacked: Sparse binary matrix of shape scans x voxels in the order of get_scan_ids
+      (see stack_bundle_masks).
+      present: Boolean array marking the scans that have a mask.
+      bundle: Bundle name without underscores and dashes.
+      n_between_pairs: Number of random between-subject pairs per scan (see
+      sample_between_subject_pairs).
+      seed: Seed used to sample the between-subject pairs.
+
+    Returns:
+      A long-format DataFrame with columns subject_id, bundle, comparison, scan_1, scan_2 and dice.
+      Pairs in which one of the scans has no mask are dropped.
+    """
+    scan_names = ScanIndex.from_subjects(subject_ids).scan_names
+
+    within_1 = np.arange(0, len(scan_names), 2)
+    between_1, between_2 = sample_between_subject_pairs(
+        len(subject_ids), n_between_pairs, seed)
+    rows_1 = np.concatenate([within_1, between_1])
+    rows_2 = np.concatenate([within_1 + 1, between_2])
+    comparison = np.array(["within subject"] * len(within_1) +
+                          ["between subjects"] * len(between_1))
+
+    pair_df = pd.DataFrame({
+        "subject_id": np.array(subject_ids)[rows_1 // 2] if len(rows_1) else [],
+        "bundle": bundle,
+        "comparison": comparison,
+        "scan_1": scan_names[rows_1],
+        "scan_2": scan_names[rows_2],
+        "dice": dice_for_pairs(stacked, present, rows_1, rows_2) if len(rows_1) else [],
+    })
+    return pair_df[present[rows_1] & present[rows_2]].reset_index(drop=True)
+
+
+def save_pair_dice_scores(subject_ids, stacked, present, output_root, bundle, n_between_pairs=0, seed=0):
+    """Calculate the within-subject (and sampled between-subject) Dice scores of one bundle
+    and save them as <bundle>_pairs.csv (see calculate_pair_dice_scores)."""
+    pair_df = calculate_pair_dice_scores(
+        subject_ids, stacked, present, bundle, n_between_pairs, seed)
+    pair_df.to_csv(os.path.join(output_root, bundle + "_pairs.csv"), index=False)
+    return
+
+
+def get_mask_checksums(stacked):
+    """
+    Returns the CRC32 checksum of the voxel indices of every row of the stacked masks. They are
+    saved with a Dice matrix to detect masks that were regenerated since it was computed.
+    Empty rows (scans without a mask) have checksum 0.
+    """
+    stacked.sort_indices()
+    return np.array([
+        zlib.crc32(stacked.indices[start:stop].astype(np.int64).tobytes())
+        for start, stop in zip(stacked.indptr[:-1], stacked.indptr[1:])
+    ], dtype=np.uint32)
+
+
+def get_packed_present(packed, n_scans):
+    """
+    Determines which scans of a packed Dice matrix had a mask (i.e. their row is not all NaN)
+    by reading the packed upper triangle row by row, without unpacking it.
+    """
+    offsets = triu_row_offsets(n_scans)
+    present = np.zeros(n_scans, dtype=bool)
+    for i in range(n_scans):
+        finite = ~np.isnan(packed[offsets[i]:offsets[i + 1]])
+        # Row i holds the entries (i, i), ..., (i, n_scans - 1), i.e. also column i of the later rows
+        present[i] |= finite.any()
+        present[i:] |= finite
+    return present
+
+
+def update_dice_scores(
+    stacked, present, scan_names, old_packed, old_scan_names, output_path, max_memory=None,
+    checksums=None, old_checksums=None
+):
+    """
+    Update an existing Dice matrix after scans were added or excluded.
+
+    Rows and columns of scans that are no longer listed are dropped. Only the entries involving
+    scans that are new, whose mask appeared or disappeared, or whose mask changed (if the
+    checksums of the existing matrix are known, see get_mask_checksums) are calculated. All
+    other entries are copied from the existing matrix. The updated matrix is written tile by
+    tile to an on-disk float32 memmap of the packed upper triangle, like
+    calculate_dice_scores_tiled, so the memory budget also holds for updates.
+
+    Args:
+      stacked: Sparse binary matrix of shape scans x voxels of the current scans.
+      present: Boolean array marking the current scans that have a mask.
+      scan_names: List of current scan names in matrix order.
+      old_packed: Packed upper triangle of the existing Dice matrix (see dice_matrix.py).
+      old_scan_names: Array of scan names of the existing Dice matrix.
+      output_path: Path of the .npy file the packed upper triangle is written to. Must differ
+      from the file of old_packed.
+      max_memory: Optional memory budget in GB (see get_tile_size). Without a budget, the
+      matrix is updated as a single tile.
+      checksums: Optional mask checksums of the current scans.
+      old_checksums: Optional mask checksums saved with the existing matrix.
+
+    Returns:
+      The number of recalculated rows.
+    """
+    n_scans = len(scan_names)
+    old_offsets = triu_row_offsets(len(old_scan_names))
+    old_present = get_packed_present(old_packed, len(old_scan_names))
+    old_positions = ScanIndex.from_scan_names(old_scan_names).positions(scan_names)
+    kept = old_positions >= 0
+    kept[kept] = old_present[old_positions[kept]] == present[kept]
+    if checksums is not None and old_checksums is not None:
+        kept[kept] = old_checksums[old_positions[kept]] == checksums[kept]
+
+    offsets = triu_row_offsets(n_scans)
+    packed = np.lib.format.open_memmap(
+        output_path, mode="w+", dtype=np.float32, shape=(int(offsets[-1]),))
+    tile_size = get_tile_size(stacked, max_memory) if max_memory is not None else max(1, n_scans)
+    for row_start in range(0, n_scans, tile_size):
+        row_stop = min(row_start + tile_size, n_scans)
+        rows = np.arange(row_start, row_stop)
+        for col_start in range(row_start, n_scans, tile_size):
+            col_stop = min(col_start + tile_size, n_scans)
+            cols = np.arange(col_start, col_stop)
+            tile = np.full((len(rows), len(cols)), np.nan, dtype=np.float32)
+            kept_rows, kept_cols = kept[rows], kept[cols]
+            # Entries between kept scans are read from the existing packed upper triangle
+            if kept_rows.any() and kept_cols.any():
+                old_rows = old_positions[rows[kept_rows]][:, None]
+                old_cols = old_positions[cols[kept_cols]][None, :]
+                first, second = np.minimum(old_rows, old_cols), np.maximum(old_rows, old_cols)
+                tile[np.ix_(kept_rows, kept_cols)] = old_packed[old_offsets[first] + second - first]
+            # Entries involving stale scans are calculated
+            stale_rows, stale_cols = rows[~kept_rows], cols[~kept_cols]
+            if len(stale_rows) > 0:
+                tile[~kept_rows, :] = dice_between_blocks(
+                    stacked[stale_rows], present[stale_rows], stacked[cols], present[cols])
+            if len(stale_cols) > 0 and kept_rows.any():
+                tile[np.ix_(kept_rows, ~kept_cols)] = dice_between_blocks(
+                    stacked[rows[kept_rows]], present[rows[kept_rows]],
+                    stacked[stale_cols], present[stale_cols])
+            write_tile(packed, offsets, tile, row_start, col_start)
+        packed.flush()
+    del packed
+    return int(np.count_nonzero(~kept))
+
+
+def save_bundle_dice_scores(
+    subject_ids, stacked, present, output_root, bundle, max_memory=None, export_csv=False, incremental=False
+):
+    """
+    Calculate the Dice matrix of one bundle and save it in the binary format
+    (see dice_matrix.py).
+
+    Args:
+      subject_ids: List of subject IDs.
+      stacked: Sparse binary matrix of shape scans x voxels in the order of get_scan_ids
+      (see stack_bundle_masks).
+      present: Boolean array marking the scans that have a mask.
+      output_root: Directory the Dice matrices of this reconstruction are saved to.
+      bundle: Bundle name without underscores and dashes.
+      max_memory: Optional memory budget in GB. If given, the tiled computation is used.
+      export_csv: Additionally export the Dice matrix as a human-readable CSV.
+      incremental: If True and a Dice matrix of this bundle exists, only the rows of new
+      or changed scans are calculated (see update_dice_scores), within max_memory.
+    """
+    scan_names = ScanIndex.from_subjects(subject_ids).scan_names
+    checksums = get_mask_checksums(stacked)
+    npy_path, ids_path = get_dice_paths(output_root, bundle)
+    if incremental and os.path.exists(npy_path) and os.path.exists(ids_path):
+        old_packed, old_scan_names = read_packed_dice_matrix(
+            output_root, bundle)
+        old_checksums = read_mask_checksums(output_root, bundle)
+        if old_checksums is None:
+            print(f"{bundle}: no mask checksums saved with the existing matrix, "
+                  "regenerated masks are not detected")
+        # Write next to the existing matrix and replace it once complete
+        temporary_path = npy_path[:-len(".npy")] + f".{os.getpid()}.tmp.npy"
+        n_updated = update_dice_scores(
+            stacked, present, scan_names, old_packed, old_scan_names, temporary_path,
+            max_memory, checksums, old_checksums)
+        del old_packed
+        os.replace(temporary_path, npy_path)
+        write_scan_ids(output_root, bundle, scan_names)
+        print(f"{bundle}: recalculated {n_updated} of {len(scan_names)} rows")
+    elif max_memory is not None:
+        calculate_dice_scores_tiled(stacked, present, npy_path, max_memory)
+        write_scan_ids(output_root, bundle, scan_names)
+    else:
+        save_dice_matrix(output_root, bundle,
+                         dice_from_stacked_masks(stacked, present), scan_names)
+    write_mask_checksums(output_root, bundle, checksums)
+
+    # Optionally save a human-readable csv
+    if export_csv:
+        export_dice_csv(np.load(npy_path, mmap_mode="r"), scan_names, os.path.join(
+            output_root, bundle + ".csv"))
+    return
+
+
+def load_bundle_masks(qsirecon_root, subject_ids, bundle, mask_store=None, mask_paths=None,
+                      io_workers=1, bounding_box=None):
+    """
+    Loads the masks of a bundle from the mask store or the NIfTI masks, cropped to the bundle's
+    bounding box if one is given. If a mask extends beyond the bounding box (e.g. because the box
+    was computed before the mask was added), the masks are loaded again without cropping.
+
+    Args:
+      qsirecon_root: Path to the qsirecon output directory of one reconstruction.
+      subject_ids: List of subject IDs.
+      bundle: Name of the bundle.
+      mask_store: Optional mask store directory to read the masks from.
+      mask_paths: Optional dictionary of the NIfTI mask paths of the bundle (see
+      list_all_bundle_masks). Listed if not given.
+      io_workers: Number of threads reading NIfTI masks.
+      bounding_box: Optional bounding box the masks are cropped to.
+
+    Returns:
+      Dictionary of sparse masks per (subject, run), as returned by read_masks.
+    """
+    try:
+        if mask_store is not None:
+            return load_masks_from_store(mask_store, subject_ids, bundle, bounding_box)
+        if mask_paths is None:
+            return load_masks_as_numpy(qsirecon_root, subject_ids, bundle, io_workers, bounding_box)
+        return read_masks(mask_paths, io_workers, bounding_box)
+    except BoundingBoxError:
+        if bounding_box is None:
+            raise
+        print(f"{bundle}: masks extend beyond the bounding box, calculating the Dice scores "
+              "without cropping. Recompute the bounding boxes with the current subject list.")
+    return load_bundle_masks(qsirecon_root, subject_ids, bundle, mask_store, mask_paths, io_workers)
+
+
+def _bundle_dice_job(
+    bundle, subject_ids, mask_paths, mask_store, output_root, max_memory, export_csv, incremental,
+    io_workers, bounding_box, pairs, n_between_pairs
+):
+    """Loads the masks of one bundle and saves its Dice matrix (or its within-subject
+    Dice scores if pairs is "within"). Run in a worker process."""
+    masks = load_bundle_masks(None, subject_ids, bundle, mask_store,
+                              mask_paths, io_workers, bounding_box)
+    stacked, present = stack_bundle_masks(subject_ids, masks)
+    if pairs == "within":
+        save_pair_dice_scores(subject_ids, stacked, present, output_root,
+                              bundle, n_between_pairs)
+    else:
+        save_bundle_dice_scores(subject_ids, stacked, present, output_root,
+                                bundle, max_memory, export_csv, incremental)
+    return bundle
+
+
+def calculate_all_bundle_dice_scores(
+    qsirecon_root, subject_ids, bundles, output_root, workers,
+    mask_store=None, max_memory=None, export_csv=False, incremental=False, io_workers=1,
+    bounding_boxes=None, pairs="all", n_between_pairs=0
+):
+    """
+    Calculate the Dice matrices of all bundles of one reconstruction in a single process.
+
+    The MNI directory of each subject is listed only once for all bundles, and the bundles
+    are distributed over a pool of worker processes.
+
+    Args:
+      qsirecon_root: Root directory where subject folders are stored.
+      subject_ids: List of subject IDs.
+      bundles: List of bundle names without underscores and dashes.
+      output_root: Directory the Dice matrices of this reconstruction are saved to.
+      workers: Number of worker processes.
+      mask_store: Optional mask store directory to read the masks from.
+      max_memory: Optional memory budget in GB shared by all workers.
+      export_csv: Additionally export the Dice matrices as human-readable CSVs.
+      incremental: Only update existing Dice matrices (see update_dice_scores).
+      io_workers: Number of threads used to list directories and read masks.
+      bounding_boxes: Optional dictionary of per-bundle bounding boxes the masks are cropped to
+      (see overlay_maps/bounding_boxes.py).
+      pairs: "all" for the full Dice matrices or "within" for the within-subject Dice scores only.
+      n_between_pairs: Number of random between-subject pairs per scan added with pairs="within".
+    """
+    if bounding_boxes is None:
+        bounding_boxes = {}
+    if mask_store is None:
+        mask_paths = list_all_bundle_masks(
+            qsirecon_root, subject_ids, io_workers)
+    else:
+        mask_paths = {}
+    worker_memory = max_memory / workers if max_memory is not None else None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [
+            executor.submit(
+                _bundle_dice_job, bundle, subject_ids, mask_paths.get(bundle, {}),
+                mask_store, output_root, worker_memory, export_csv, incremental, io_workers,
+                bounding_boxes.get(bundle), pairs, n_between_pairs)
+            for bundle in bundles
+        ]
+        for future in futures:
+            print(future.result())
+    return
 
 
 if __name__ == "__main__":
@@ -134,12 +689,77 @@ if __name__ == "__main__":
         required=True,
         help="Reconstruction method (e.g., GQIautotrack)",
     )
-    parser.add_argument(
+    bundle_group = parser.add_mutually_exclusive_group(required=True)
+    bundle_group.add_argument(
         "--bundle",
         type=str,
-        required=True,
         help="Name of the bundle considered for dice score calculation",
     )
+    bundle_group.add_argument(
+        "--all_bundles",
+        "--all-bundles",
+        action="store_true",
+        help="Calculate the dice scores of all bundles in one process",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Num CPUs used to process bundles in parallel with --all_bundles",
+    )
+    parser.add_argument(
+        "--io_workers",
+        type=int,
+        default=8,
+        help="Num threads used to list subject directories and read the NIfTI masks",
+    )
+    parser.add_argument(
+        "--mask_store",
+        type=str,
+        default=None,
+        help="Optional mask store directory of this reconstruction to read the masks from",
+    )
+    parser.add_argument(
+        "--bounding_boxes",
+        type=str,
+        default=None,
+        help="Optional csv of per-bundle bounding boxes (overlay_maps/bounding_boxes.py) "
+        "to crop the masks to when loading them",
+    )
+    parser.add_argument(
+        "--pairs",
+        type=str,
+        choices=["all", "within"],
+        default="all",
+        help="Calculate the Dice scores of all pairs of scans (default) or only the within-subject "
+        "(run-01 vs. run-02) Dice scores, written as a long-format <bundle>_pairs.csv",
+    )
+    parser.add_argument(
+        "--between_pairs",
+        type=int,
+        default=0,
+        help="Number of random between-subject pairs per scan added with --pairs within",
+    )
+    parser.add_argument(
+        "--export_csv",
+        action="store_true",
+        help="Additionally export the Dice matrix as a human-readable CSV",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Update existing Dice matrices, only calculating rows of added or changed scans. "
+        "Regenerated masks are detected from the mask checksums saved with the matrices; matrices "
+        "computed before checksums were saved need a full run after masks were regenerated",
+    )
+    parser.add_argument(
+        "--max_memory",
+        "--max-memory",
+        type=float,
+        default=None,
+        help="Optional memory budget in GB. If given, Dice scores are computed tile by tile "
+        "into an on-disk float32 memmap",
+    )
     args = parser.parse_args()
 
     QSIRECON_SUFFIX = args.recon_suffix
@@ -149,6 +769,7 @@ if __name__ == "__main__":
         + QSIRECON_SUFFIX
     )
     EXCLUDED_SBJ_LIST = "/cbica/projects/clinical_dmri_benchmark/clinical_dmri_benchmark/analysis/data_processing/subject_lists/excluded_subjects.txt"
+    BUNDLE_NAMES = "/cbica/projects/clinical_dmri_benchmark/clinical_dmri_benchmark/data/bundle_names.txt"
     OUTPUT_ROOT = (
         "/cbica/projects/clinical_dmri_benchmark/results/dices/"
         + QSIRECON_SUFFIX
@@ -158,12 +779,32 @@ if __name__ == "__main__":
     # Get ids of reconstructed subjects
     sbj_ids = get_subject_ids(ROOT_QSIRECON, EXCLUDED_SBJ_LIST)
 
-    # Preload masks to RAM as NumPy arrays
-    masks = load_masks_as_numpy(ROOT_QSIRECON, sbj_ids, BUNDLE_NAME)
+    # Bounding boxes to crop the masks to
+    bounding_boxes = {}
+    if args.bounding_boxes is not None:
+        bounding_boxes = load_bounding_boxes(args.bounding_boxes)
+
+    if args.all_bundles:
+        with open(BUNDLE_NAMES, "r") as f:
+            bundles = f.read().splitlines()
+        for i, bundle in enumerate(bundles):
+            bundles[i] = bundle.replace("_", "").replace("-", "")
+        calculate_all_bundle_dice_scores(
+            ROOT_QSIRECON, sbj_ids, bundles, OUTPUT_ROOT, args.workers,
+            args.mask_store, args.max_memory, args.export_csv, args.incremental,
+            args.io_workers, bounding_boxes, args.pairs, args.between_pairs)
+    else:
+        # Preload masks to RAM as sparse arrays
+        masks = load_bundle_masks(ROOT_QSIRECON, sbj_ids, BUNDLE_NAME, args.mask_store,
+                                  io_workers=args.io_workers,
+                                  bounding_box=bounding_boxes.get(BUNDLE_NAME))
 
-    # Calculate Dice scores using preloaded masks
-    dice_df = calculate_dice_scores(sbj_ids, masks)
+        stacked, present = stack_bundle_masks(sbj_ids, masks)
 
-    # save df as csv
-    csv_name = os.path.join(OUTPUT_ROOT, BUNDLE_NAME + ".csv")
-    dice_df.to_csv(csv_name)
+        # Calculate Dice scores using preloaded masks
+        if args.pairs == "within":
+            save_pair_dice_scores(sbj_ids, stacked, present, OUTPUT_ROOT,
+                                  BUNDLE_NAME, args.between_pairs)
+        else:
+            save_bundle_dice_scores(sbj_ids, stacked, present, OUTPUT_ROOT, BUNDLE_NAME,
+                                    args.max_memory, args.export_csv, args.incremental)
@@ -30,7 +30,7 @@ source /cbica/projects/clinical_dmri_benchmark/micromamba/etc/profile.d/micromam
 
 micromamba activate clinical_dmri_benchmark
 
-python3 ${PYTHON_HELPER_SCRIPT} --recon_suffix ${RECON_SUFFIX} --bundle ${bundle}
+python3 ${PYTHON_HELPER_SCRIPT} --recon_suffix ${RECON_SUFFIX} --bundle ${bundle} --max_memory 4
 
 micromamba deactivate
 
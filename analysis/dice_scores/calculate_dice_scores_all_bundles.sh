@@ -0,0 +1,31 @@
+#!/bin/bash
+#SBATCH --nodes=1
+#SBATCH --ntasks-per-node=1
+#SBATCH --cpus-per-task=16
+#SBATCH --mem=64G
+#SBATCH --time=05:00:00
+#SBATCH --output=../logs/pnc_dice_all_bundles-%A_%a.log
+
+[ -z "${JOB_ID}" ] && JOB_ID=TEST
+
+if [[ ! -z "${SLURM_JOB_ID}" ]]; then
+    echo SLURM detected
+    JOB_ID="${SLURM_JOB_ID}"
+    NSLOTS="${SLURM_JOB_CPUS_PER_NODE}"
+fi
+
+# fail whenever something is fishy, use -x to get verbose logfiles
+set -e -u -x
+
+RECON_SUFFIX=$1
+PYTHON_HELPER_SCRIPT="${HOME}/clinical_dmri_benchmark/analysis/dice_scores/calculate_dice_scores.py"
+
+source /cbica/projects/clinical_dmri_benchmark/micromamba/etc/profile.d/micromamba.sh
+
+micromamba activate clinical_dmri_benchmark
+
+python3 ${PYTHON_HELPER_SCRIPT} --recon_suffix ${RECON_SUFFIX} --all_bundles --workers ${SLURM_CPUS_PER_TASK} --max_memory 60
+
+micromamba deactivate
+
+echo SUCCESS
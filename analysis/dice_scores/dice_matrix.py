@@ -0,0 +1,160 @@
+import os
+import numpy as np
+import pandas as pd
+
+DICE_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/dices"
+
+
+def triu_row_offsets(n_scans: int) -> np.ndarray:
+    """
+    Returns the position of the first element of each row in a row-major packed upper
+    triangle (including the diagonal) of an n_scans x n_scans matrix.
+    The last element is the total length of the packed upper triangle.
+    """
+    rows = np.arange(n_scans + 1, dtype=np.int64)
+    return rows * n_scans - rows * (rows - 1) // 2
+
+
+def pack_triu(dice_array: np.ndarray) -> np.ndarray:
+    """Packs the upper triangle (including the diagonal) of a square matrix row by row as float32."""
+    return dice_array[np.triu_indices(dice_array.shape[0])].astype(np.float32)
+
+
+def unpack_triu(packed: np.ndarray, n_scans: int) -> np.ndarray:
+    """Restores the full symmetric float32 matrix from a row-major packed upper triangle."""
+    dice_array = np.empty((n_scans, n_scans), dtype=np.float32)
+    rows, cols = np.triu_indices(n_scans)
+    dice_array[rows, cols] = packed
+    dice_array[cols, rows] = packed
+    return dice_array
+
+
+def get_dice_paths(output_root: str, bundle: str) -> tuple:
+    """Returns the paths of the packed Dice matrix (.npy) and the scan ID index (.txt) of a bundle."""
+    return (
+        os.path.join(output_root, bundle + ".npy"),
+        os.path.join(output_root, bundle + "_ids.txt"),
+    )
+
+
+def write_scan_ids(output_root: str, bundle: str, scan_names: list):
+    """Writes the scan ID index (one "<subject_id>_<run>" per line) of a bundle's Dice matrix."""
+    with open(get_dice_paths(output_root, bundle)[1], "w") as f:
+        f.write("\n".join(scan_names) + "\n")
+    return
+
+
+def get_checksum_path(output_root: str, bundle: str) -> str:
+    """Returns the path of the mask checksums (.npy) saved with a bundle's Dice matrix."""
+    return os.path.join(output_root, bundle + "_checksums.npy")
+
+
+def write_mask_checksums(output_root: str, bundle: str, checksums: np.ndarray):
+    """Writes the checksums of the masks (one per scan, in matrix order) a bundle's Dice matrix
+    was computed from, used to detect regenerated masks when updating it."""
+    np.save(get_checksum_path(output_root, bundle), checksums)
+    return
+
+
+def read_mask_checksums(output_root: str, bundle: str):
+    """Reads the mask checksums of a bundle's Dice matrix. None if they were not saved."""
+    checksum_path = get_checksum_path(output_root, bundle)
+    if not os.path.exists(checksum_path):
+        return None
+    return np.load(checksum_path)
+
+
+def save_dice_matrix(output_root: str, bundle: str, dice_array: np.ndarray, scan_names: list):
+    """
+    Saves a Dice matrix in the binary format: the float32 upper triangle packed row by
+    row as <bundle>.npy and the scan IDs as <bundle>_ids.txt.
+
+    Args:
+      output_root: Directory of the Dice matrices of one reconstruction.
+      bundle: Bundle name without underscores and dashes.
+      dice_array: Symmetric scans x scans array of Dice scores.
+      scan_names: List of scan names ("<subject_id>_<run>") in matrix order.
+    """
+    np.save(get_dice_paths(output_root, bundle)[0], pack_triu(dice_array))
+    write_scan_ids(output_root, bundle, scan_names)
+    return
+
+
+def load_packed_dice_matrix(recon: str, bundle: str, dice_root: str = DICE_ROOT):
+    """
+    Loads the packed upper triangle of a bundle's Dice matrix without unpacking it.
+
+    Args:
+      recon: Reconstruction method (e.g., GQIautotrack).
+      bundle: Bundle name without underscores and dashes.
+      dice_root: Directory containing one folder of Dice matrices per reconstruction.
+
+    Returns:
+      A tuple of the memory-mapped packed upper triangle and an array of scan names.
+    """
+    return read_packed_dice_matrix(os.path.join(dice_root, recon), bundle)
+
+
+def read_packed_dice_matrix(output_root: str, bundle: str):
+    """Same as load_packed_dice_matrix for the Dice directory of a single reconstruction."""
+    npy_path, ids_path = get_dice_paths(output_root, bundle)
+    with open(ids_path, "r") as f:
+        scan_names = np.array(f.read().splitlines())
+    return np.load(npy_path, mmap_mode="r"), scan_names
+
+
+def load_dice_matrix(recon: str, bundle: str, dice_root: str = DICE_ROOT, distances: bool = True):
+    """
+    Loads a bundle's Dice matrix without a text parse.
+
+    Falls back to the CSV written by earlier versions of calculate_dice_scores.py if no
+    binary matrix exists.
+
+    Args:
+      recon: Reconstruction method (e.g., GQIautotrack).
+      bundle: Bundle name without underscores and dashes.
+      dice_root: Directory containing one folder of Dice matrices per reconstruction.
+      distances: If True (default), returns distances (1 - Dice) instead of Dice scores.
+
+    Returns:
+      A tuple of the full scans x scans float32 matrix and an array of scan names
+      ("<subject_id>_<run>"). Rows and columns of scans without a mask are NaN.
+    """
+    npy_path = get_dice_paths(os.path.join(dice_root, recon), bundle)[0]
+    if os.path.exists(npy_path):
+        packed, scan_names = load_packed_dice_matrix(recon, bundle, dice_root)
+        dice_array = unpack_triu(packed, len(scan_names))
+    else:
+        dice_df = pd.read_csv(
+            os.path.join(dice_root, recon, bundle + ".csv"), index_col=0, na_values=[""])
+        dice_array = dice_df.values.astype(np.float32)
+        scan_names = dice_df.columns.values.astype(str)
+    if distances:
+        return 1 - dice_array, scan_names
+    return dice_array, scan_names
+
+
+def export_dice_csv(packed: np.ndarray, scan_names: list, csv_path: str, rows_per_chunk: int = 256):
+    """
+    Export a packed upper triangle Dice matrix as a full symmetric CSV, chunk by chunk.
+
+    Args:
+      packed: Row-major packed upper triangle (see pack_triu).
+      scan_names: List of scan names used as index and header of the CSV.
+      csv_path: Path of the CSV file.
+      rows_per_chunk: Number of rows converted to a DataFrame at once.
+    """
+    scan_names = list(scan_names)
+    n_scans = len(scan_names)
+    offsets = triu_row_offsets(n_scans)
+    for chunk_start in range(0, n_scans, rows_per_chunk):
+        chunk_stop = min(chunk_start + rows_per_chunk, n_scans)
+        chunk = np.empty((chunk_stop - chunk_start, n_scans), dtype=np.float32)
+        for i in range(chunk_start, chunk_stop):
+            # Entries left of the diagonal are stored in the rows above
+            chunk[i - chunk_start, :i] = packed[offsets[:i] + i - np.arange(i)]
+            chunk[i - chunk_start, i:] = packed[offsets[i]:offsets[i + 1]]
+        pd.DataFrame(
+            chunk, index=scan_names[chunk_start:chunk_stop], columns=scan_names
+        ).to_csv(csv_path, mode="w" if chunk_start == 0 else "a", header=chunk_start == 0)
+    return
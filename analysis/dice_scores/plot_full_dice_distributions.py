@@ -1,5 +1,5 @@
-# This script requires the csv files containing the dice sores between any two scans
-# These csvs are generated using the following script: analysis/dice_scores/calculate_dice_scores.sh
+# This script requires the binary matrices containing the dice sores between any two scans
+# These matrices are generated using the following script: analysis/dice_scores/calculate_dice_scores.sh
 # Since there are very many dice scores per bundle per reconstruction method,
 # this script takes quite long to run and requires a lot (~55GB) of memory
 
@@ -8,6 +8,7 @@ import seaborn as sns
 import pandas as pd
 import matplotlib as mpl
 from matplotlib import pyplot as plt
+from dice_matrix import load_dice_matrix
 
 DICE_ROOT = "/Users/amelie/Datasets/clinical_dmri_benchmark/dice_scores"
 
@@ -45,11 +46,9 @@ sep = "_"
 intra_dice_list, inter_dice_list = [], []
 for bundle_name in bundle_names:
     bundle_name_short = bundle_name.split(sep=sep, maxsplit=1)[1]
-    bundle_file = f"{DICE_ROOT}/{RECONSTRUCTION}/" + \
-        bundle_name.replace("_", "").replace("-", "") + ".csv"
-
-    # Load CSV as numpy array for efficiency
-    bundle_array = pd.read_csv(bundle_file, index_col=0, na_values=[""]).values
+    # Load the binary dice matrix as numpy array for efficiency
+    bundle_array, _ = load_dice_matrix(
+        RECONSTRUCTION, bundle_name.replace("_", "").replace("-", ""), DICE_ROOT, distances=False)
 
     # Process intra-dices
     intra_dices = np.diag(bundle_array, k=1)[::2]
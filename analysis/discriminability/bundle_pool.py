@@ -0,0 +1,99 @@
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import shared_memory
+import numpy as np
+
+
+def to_shared_memory(array: np.ndarray):
+    """
+    Copies an array into a new shared memory block.
+
+    Returns:
+      A tuple of the SharedMemory object (to be unlinked by the caller) and a picklable
+      descriptor (name, shape, dtype) to attach to the array from another process.
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, (shm.name, array.shape, array.dtype.str)
+
+
+def from_shared_memory(descriptor: tuple):
+    """Attaches to an array in shared memory. Returns the SharedMemory object (to be closed
+    after use) and the array, which is only valid while the shared memory is open."""
+    name, shape, dtype = descriptor
+    shm = shared_memory.SharedMemory(name=name)
+    return shm, np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+
+
+def _run_shared_job(bundle_job, bundle, descriptors, job_kwargs):
+    """Runs a bundle job in a worker process on distance matrices passed through shared memory."""
+    attached = [from_shared_memory(descriptor) for descriptor in descriptors]
+    shms = [shm for shm, _ in attached]
+    arrays = [array for _, array in attached]
+    del attached
+    try:
+        return bundle_job(bundle, *arrays, **job_kwargs)
+    finally:
+        # The array views have to be released before the shared memory can be closed
+        del arrays
+        for shm in shms:
+            shm.close()
+
+
+def run_bundle_jobs(bundles: list, load_bundle, bundle_job, bundle_workers: int, max_pending: int = None) -> list:
+    """
+    Runs an independent test per bundle on a process pool.
+
+    Bundles are loaded one after another in the main process. Their distance matrices are
+    handed to the workers through shared memory instead of being pickled, and at most
+    max_pending bundles are held in memory at a time.
+
+    Args:
+      bundles: List of bundle names.
+      load_bundle: Function mapping a bundle name to a tuple of (list of arrays, dict of further
+      keyword arguments of the job), or None to skip the bundle.
+      bundle_job: Picklable function called as bundle_job(bundle, *arrays, **kwargs) in a worker
+      process. Returns a dictionary (one row of the results) or None.
+      bundle_workers: Number of worker processes.
+      max_pending: Maximum number of loaded bundles waiting or running. Defaults to twice the
+      number of workers.
+
+    Returns:
+      List of the non-None results in the order of the bundles.
+    """
+    if max_pending is None:
+        max_pending = 2 * bundle_workers
+    results = {}
+    pending = {}
+
+    def collect(done):
+        for future in done:
+            bundle, shms = pending.pop(future)
+            for shm in shms:
+                shm.close()
+                shm.unlink()
+            results[bundle] = future.result()
+
+    with ProcessPoolExecutor(max_workers=bundle_workers) as executor:
+        try:
+            for bundle in bundles:
+                loaded = load_bundle(bundle)
+                if loaded is None:
+                    continue
+                arrays, job_kwargs = loaded
+                shared = [to_shared_memory(array) for array in arrays]
+                del arrays, loaded
+                future = executor.submit(
+                    _run_shared_job, bundle_job, bundle,
+                    [descriptor for _, descriptor in shared], job_kwargs)
+                pending[future] = (bundle, [shm for shm, _ in shared])
+                if len(pending) >= max_pending:
+                    collect(wait(pending, return_when=FIRST_COMPLETED).done)
+            while pending:
+                collect(wait(pending, return_when=FIRST_COMPLETED).done)
+        finally:
+            for _, shms in pending.values():
+                for shm in shms:
+                    shm.close()
+                    shm.unlink()
+    return [results[bundle] for bundle in bundles if results.get(bundle) is not None]
@@ -1,12 +1,49 @@
 import pandas as pd
-import os
 import numpy as np
-import re
-from hyppo.discrim import DiscrimOneSample
 import argparse
+from functools import partial
+from distance_loader import DISTANCE_CACHE_ROOT, get_subject_labels, load_distances
+from discriminability import bootstrap_discriminability, discrim_one_sample, percentile_ci
+from bundle_pool import run_bundle_jobs
 
 
-def get_discrim_one_sample(dice_root: str, bundle_names: list, output_path: str):
+def load_one_sample_bundle(dice_root: str, recon_suffix: str, cache_root: str, bundle: str):
+    """
+    Loads the distance matrix (1 - Dice) of a bundle without rows and columns of scans the
+    bundle couldn't be reconstructed for (see distance_loader.py).
+
+    Returns:
+      A tuple of the list of arrays and the keyword arguments passed to one_sample_bundle_job.
+    """
+    print(bundle)
+    distances, scan_ids, _ = load_distances(
+        recon_suffix, bundle, dice_root, cache_root)
+    return [distances], {"subject_ids": get_subject_labels(scan_ids)}
+
+
+def one_sample_bundle_job(bundle: str, distances: np.ndarray, subject_ids: np.ndarray, workers: int = 1,
+                          n_bootstrap: int = 0, bootstrap_workers: int = 1) -> dict:
+    """Runs the one sample discriminability test of one bundle and optionally a subject-level
+    bootstrap of its discriminability. Run in a worker process."""
+    one_sample_output = discrim_one_sample(distances, subject_ids, workers=workers)
+    df_row = {
+        "bundle": bundle,
+        "discriminability": one_sample_output.stat,
+        "p-value": one_sample_output.pvalue,
+        "null_distr": one_sample_output.null_dist,
+    }
+    if n_bootstrap > 0:
+        bootstrap_dist = bootstrap_discriminability(
+            [distances], subject_ids, n_bootstrap, workers=bootstrap_workers)
+        df_row["ci_lower"], df_row["ci_upper"] = percentile_ci(
+            bootstrap_dist[:, 0])
+    print(df_row)
+    return df_row
+
+
+def get_discrim_one_sample(dice_root: str, recon_suffix: str, bundle_names: list, output_path: str,
+                           workers: int = 1, bundle_workers: int = 1, cache_root: str = DISTANCE_CACHE_ROOT,
+                           n_bootstrap: int = 0, bootstrap_workers: int = None):
     """
     Calculate discriminability scores for a set of bundles and save the results to a CSV file.
 
@@ -14,50 +51,49 @@ def get_discrim_one_sample(dice_root: str, bundle_names: list, output_path: str)
     distance matrices derived from dice scores (1 - dice similarity). For each bundle, it loads 
     the dice score matrix, transforms it to a distance matrix, removes rows and columns with 
     only NaN values (indicating missing data), and performs a one-sample discriminability test 
-    using the hyppo `DiscrimOneSample` function. The results for each bundle are stored in a 
+    using `discrim_one_sample` (see discriminability.py). Bundles are tested in parallel on a
+    process pool (see bundle_pool.py), each using workers // bundle_workers threads for the
+    permutations. The results of all bundles are collected into one
     DataFrame and then saved to a specified CSV file.
 
     Parameters:
     ----------
     dice_root : str
-        The root directory containing dice score CSV files for each bundle. Each file should 
-        be named as "{bundle}.csv" and contain a matrix of dice scores with subjects as columns 
-        and rows.
+        The root directory containing one folder of dice score matrices per reconstruction
+        (see dice_scores/dice_matrix.py).
+    recon_suffix : str
+        Reconstruction method (e.g., GQIautotrack).
     bundle_names : list of str
         List of bundle names to process. Each bundle name corresponds to a CSV file in `dice_root`.
     output_path : str
         Path to save the resulting CSV file containing the discriminability scores, p-values, 
         and null distribution for each bundle.
+    workers : int
+        Total number of CPUs.
+    bundle_workers : int
+        Number of bundles tested in parallel.
+    cache_root : str
+        Directory of the cache of parsed distance matrices (see distance_loader.py).
+    n_bootstrap : int
+        Number of subject-level bootstrap replicates. If positive, the 95% percentile confidence
+        interval of the discriminability is added (columns ci_lower and ci_upper).
+    bootstrap_workers : int
+        Number of processes per bundle the bootstrap replicates are distributed over. Defaults
+        to workers // bundle_workers.
     """
-    df = pd.DataFrame(
-        columns=["bundle", "discriminability", "p-value", "null_distr"])
-    for bundle in bundle_names:
-        print(bundle)
-        dice_path = os.path.join(dice_root, bundle + ".csv")
-        dices = pd.read_csv(dice_path, index_col=0, na_values=[""]).values
-        distances = 1 - dices
-        subject_ids = pd.read_csv(dice_path, nrows=0).columns.values[1:]
-        subject_ids = np.array(
-            [re.sub(r"sub-|\_run-\d+", "", col) for col in subject_ids]
-        )
-
-        # Remove rows and columns from the distance matrix that only contain NaNs
-        # This will exclude runs that the bundle of interest couldn't be reconstructed for
-        rows_to_keep = ~np.isnan(distances).all(axis=1)
-        distances = distances[rows_to_keep]
-        distances = distances[:, rows_to_keep]
-        # Remove these rows from the ID-list as well
-        subject_ids = subject_ids[rows_to_keep]
-        one_sample_output = DiscrimOneSample(
-            is_dist=True).test(distances, subject_ids)
-        df_row = {
-            "bundle": bundle,
-            "discriminability": one_sample_output.stat,
-            "p-value": one_sample_output.pvalue,
-            "null_distr": one_sample_output.null_dist,
-        }
-        print(df_row)
-        df = pd.concat([df, pd.DataFrame([df_row])], ignore_index=True)
+    bundle_cpus = max(1, workers // bundle_workers)
+    if bootstrap_workers is None:
+        bootstrap_workers = bundle_cpus
+    rows = run_bundle_jobs(
+        bundle_names, partial(load_one_sample_bundle,
+                              dice_root, recon_suffix, cache_root),
+        partial(one_sample_bundle_job, workers=bundle_cpus, n_bootstrap=n_bootstrap,
+                bootstrap_workers=bootstrap_workers),
+        bundle_workers)
+    columns = ["bundle", "discriminability", "p-value", "null_distr"]
+    if n_bootstrap > 0:
+        columns += ["ci_lower", "ci_upper"]
+    df = pd.DataFrame(rows, columns=columns)
     df.to_csv(output_path, index=False)
     return
 
@@ -70,11 +106,39 @@ if __name__ == "__main__":
         required=True,
         help="Reconstruction method (e.g., GQIautotrack)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Num CPUs available for testing bundles and permutations in parallel",
+    )
+    parser.add_argument(
+        "--bundle_workers",
+        type=int,
+        default=1,
+        help="Num bundles tested in parallel, each using workers // bundle_workers CPUs for the permutations",
+    )
+    parser.add_argument(
+        "--cache_root",
+        type=str,
+        default=DISTANCE_CACHE_ROOT,
+        help="Directory of the cache of parsed distance matrices shared by the discriminability scripts",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Num subject-level bootstrap replicates for percentile confidence intervals (0: no bootstrap)",
+    )
+    parser.add_argument(
+        "--bootstrap_workers",
+        type=int,
+        default=None,
+        help="Num CPUs per bundle used for the bootstrap replicates (default: workers // bundle_workers)",
+    )
     args = parser.parse_args()
     QSIRECON_SUFFIX = args.recon_suffix
-    DICE_ROOT = (
-        "/cbica/projects/clinical_dmri_benchmark/results/dices/" + QSIRECON_SUFFIX
-    )
+    DICE_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/dices/"
     BUNDLE_NAMES = "/cbica/projects/clinical_dmri_benchmark/clinical_dmri_benchmark/data/bundle_names.txt"
     OUTPUT_PATH = (
         "/cbica/projects/clinical_dmri_benchmark/results/discriminability/one_sample_"
@@ -87,4 +151,6 @@ if __name__ == "__main__":
     for i, bundle in enumerate(bundles):
         bundles[i] = bundle.replace("_", "").replace("-", "")
 
-    get_discrim_one_sample(DICE_ROOT, bundles, OUTPUT_PATH)
+    get_discrim_one_sample(DICE_ROOT, QSIRECON_SUFFIX,
+                           bundles, OUTPUT_PATH, args.workers, args.bundle_workers, args.cache_root,
+                           args.bootstrap, args.bootstrap_workers)
@@ -1,91 +1,104 @@
 import pandas as pd
 import os
+import sys
 import numpy as np
-import re
-from hyppo.discrim import DiscrimTwoSample
 import argparse
+from functools import partial
+from distance_loader import DISTANCE_CACHE_ROOT, load_distances
+from discriminability import discrim_two_sample
+from bundle_pool import run_bundle_jobs
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "data_processing"))
+from scan_index import ScanIndex, align_matrices  # noqa: E402
 
-def get_discrim_two_sample(dice_root: str, recon_suffix_1: str, recon_suffix_2: str, bundle_names: list, output_path: str):
-    """
 
-    Parameters:
-    ----------
+def load_two_sample_bundle(dice_root: str, recon_suffix_1: str, recon_suffix_2: str, cache_root: str, bundle: str):
+    """
+    Loads the distance matrices (1 - Dice) of a bundle for both reconstructions (see
+    distance_loader.py), restricted to the scans present in both and without isolates.
 
+    Returns:
+      A tuple of the list of arrays and the keyword arguments passed to two_sample_bundle_job.
     """
-    df = pd.DataFrame(columns=[
-                      "bundle", "discrim_" + recon_suffix_1, "discrim_" + recon_suffix_2, "null_distr"])
-    for bundle in bundle_names:
-        print(bundle)
-        dice_path_1 = os.path.join(dice_root, recon_suffix_1, bundle + ".csv")
-        dices_1 = pd.read_csv(dice_path_1, index_col=0, na_values=[""]).values
-        distances_1 = 1 - dices_1
-        subject_ids_1 = pd.read_csv(dice_path_1, nrows=0).columns.values[1:]
-        subject_ids_1 = np.array(
-            [re.sub(r"sub-", "", col) for col in subject_ids_1]
-        )
+    print(bundle)
+    # Rows and columns of runs that the bundle of interest couldn't be reconstructed for are
+    # already removed by the loader
+    distances_1, subject_ids_1, _ = load_distances(
+        recon_suffix_1, bundle, dice_root, cache_root)
+    distances_2, subject_ids_2, _ = load_distances(
+        recon_suffix_2, bundle, dice_root, cache_root)
 
-        dice_path_2 = os.path.join(dice_root, recon_suffix_2, bundle + ".csv")
-        dices_2 = pd.read_csv(dice_path_2, index_col=0, na_values=[""]).values
-        distances_2 = 1 - dices_2
-        subject_ids_2 = pd.read_csv(dice_path_2, nrows=0).columns.values[1:]
-        subject_ids_2 = np.array(
-            [re.sub(r"sub-", "", col) for col in subject_ids_2]
-        )
+    # Keep the subID-run combos present in both distance matrices, without isolates
+    (filtered_distances_1, filtered_distances_2), common_index = align_matrices(
+        [distances_1, distances_2],
+        [ScanIndex.from_scan_names(subject_ids_1), ScanIndex.from_scan_names(subject_ids_2)])
+    return [filtered_distances_1, filtered_distances_2], {"subject_ids": common_index.subject_ids}
 
-        # Remove rows and columns from the distance matrix that only contain NaNs
-        # This will exclude runs that the bundle of interest couldn't be reconstructed for
-        rows_to_keep_1 = ~np.isnan(distances_1).all(axis=1)
-        distances_1 = distances_1[rows_to_keep_1]
-        distances_1 = distances_1[:, rows_to_keep_1]
-        subject_ids_1 = subject_ids_1[rows_to_keep_1]
-        rows_to_keep_2 = ~np.isnan(distances_2).all(axis=1)
-        distances_2 = distances_2[rows_to_keep_2]
-        distances_2 = distances_2[:, rows_to_keep_2]
-        subject_ids_2 = subject_ids_2[rows_to_keep_2]
 
-        # Remove all subID-run combos that are not present in both vectors / distance matrices
-        # Step 1: Find the common subject-run combinations
-        common_subids = np.intersect1d(subject_ids_1, subject_ids_2)
-        # Step 2: Find indices of common combinations in both vectors
-        indices1 = [i for i, sub in enumerate(
-            subject_ids_1) if sub in common_subids]
-        indices2 = [i for i, sub in enumerate(
-            subject_ids_2) if sub in common_subids]
-        filtered_subids_1 = subject_ids_1[indices1]
-        filtered_subids_2 = subject_ids_2[indices2]
-        print((filtered_subids_1 == filtered_subids_2).all())
-        # Step 3: Filter matrices accordingly
-        filtered_distances_1 = distances_1[np.ix_(indices1, indices1)]
-        filtered_distances_2 = distances_2[np.ix_(indices2, indices2)]
-        common_subids = np.array(
-            [re.sub(r"\_run-\d+", "", col) for col in common_subids]
-        )
+def two_sample_bundle_job(bundle: str, distances_1: np.ndarray, distances_2: np.ndarray, subject_ids: np.ndarray,
+                          recon_suffix_1: str, recon_suffix_2: str, workers: int = 1, reps: int = 1000,
+                          alpha: float = None, batch_reps: int = 100) -> dict:
+    """Runs the two sample discriminability test of one bundle. Run in a worker process."""
+    two_sample_output = discrim_two_sample(
+        distances_1, distances_2, subject_ids, reps=reps, workers=workers, alpha=alpha, batch_reps=batch_reps)
+    df_row = {
+        "bundle": bundle,
+        "discrim_" + recon_suffix_1: two_sample_output.d1,
+        "discrim_" + recon_suffix_2: two_sample_output.d2,
+        "p-value": two_sample_output.pvalue,
+        "n_permutations": two_sample_output.n_permutations,
+        "mc_error": two_sample_output.mc_error
+    }
+    print(df_row)
+    return df_row
 
-        # remove isolates
-        # Step 1: Identify entries that appear more than once
-        (unique, counts) = np.unique(common_subids, return_counts=True)
-        # Only keep entries appearing more than once
-        repeated_entries = unique[counts > 1]
 
-        # Step 2: Create a mask for entries to keep
-        mask = np.isin(common_subids, repeated_entries)
+def get_discrim_two_sample(dice_root: str, recon_suffix_1: str, recon_suffix_2: str, bundle_names: list, output_path: str,
+                           workers: int = 1, bundle_workers: int = 1, cache_root: str = DISTANCE_CACHE_ROOT,
+                           reps: int = 1000, alpha: float = None, batch_reps: int = 100):
+    """
+    Calculate the two sample discriminability test between two reconstructions for a set of
+    bundles and save the results to a CSV file.
 
-        # Step 3: Filter the array and matrices
-        common_subids = common_subids[mask]
-        filtered_distances_1 = filtered_distances_1[np.ix_(mask, mask)]
-        filtered_distances_2 = filtered_distances_2[np.ix_(mask, mask)]
+    Bundles are tested in parallel on a process pool (see bundle_pool.py), each using
+    workers // bundle_workers threads for the permutations.
 
-        two_sample_output = DiscrimTwoSample(is_dist=True).test(
-            filtered_distances_1, filtered_distances_2, common_subids)
-        df_row = {
-            "bundle": bundle,
-            "discrim_" + recon_suffix_1: two_sample_output.d1,
-            "discrim_" + recon_suffix_2: two_sample_output.d2,
-            "p-value": two_sample_output.pvalue
-        }
-        print(df_row)
-        df = pd.concat([df, pd.DataFrame([df_row])], ignore_index=True)
+    Parameters:
+    ----------
+    dice_root : str
+        Root directory containing one folder of dice score matrices per reconstruction.
+    recon_suffix_1 : str
+        Suffix for the first reconstruction.
+    recon_suffix_2 : str
+        Suffix for the second reconstruction.
+    bundle_names : list
+        List of bundle names.
+    output_path : str
+        Path to save the output CSV file.
+    workers : int
+        Total number of CPUs.
+    bundle_workers : int
+        Number of bundles tested in parallel.
+    cache_root : str
+        Directory of the cache of parsed distance matrices (see distance_loader.py).
+    reps : int
+        Number of permutations (maximum number if alpha is given).
+    alpha : float
+        Optional significance level. If given, the permutations of a bundle stop as soon as its
+        p-value is decisively above or below alpha (see discriminability.discrim_two_sample).
+    batch_reps : int
+        Number of permutations added per step of the sequential test.
+    """
+    rows = run_bundle_jobs(
+        bundle_names, partial(load_two_sample_bundle,
+                              dice_root, recon_suffix_1, recon_suffix_2, cache_root),
+        partial(two_sample_bundle_job, recon_suffix_1=recon_suffix_1, recon_suffix_2=recon_suffix_2,
+                workers=max(1, workers // bundle_workers), reps=reps, alpha=alpha, batch_reps=batch_reps),
+        bundle_workers)
+    df = pd.DataFrame(rows, columns=[
+                      "bundle", "discrim_" + recon_suffix_1, "discrim_" + recon_suffix_2, "p-value",
+                      "n_permutations", "mc_error"])
     df.to_csv(output_path, index=False)
     return
 
@@ -104,6 +117,43 @@ if __name__ == "__main__":
         required=True,
         help="Reconstruction method (e.g., GQIautotrack)",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Num CPUs available for testing bundles and permutations in parallel",
+    )
+    parser.add_argument(
+        "--bundle_workers",
+        type=int,
+        default=1,
+        help="Num bundles tested in parallel, each using workers // bundle_workers CPUs for the permutations",
+    )
+    parser.add_argument(
+        "--cache_root",
+        type=str,
+        default=DISTANCE_CACHE_ROOT,
+        help="Directory of the cache of parsed distance matrices shared by the discriminability scripts",
+    )
+    parser.add_argument(
+        "--reps",
+        type=int,
+        default=1000,
+        help="Num permutations (maximum number with --alpha)",
+    )
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=None,
+        help="Optional significance level. If given, permutations stop as soon as the p-value's "
+        "confidence interval lies entirely above or below alpha",
+    )
+    parser.add_argument(
+        "--batch_reps",
+        type=int,
+        default=100,
+        help="Num permutations added per step of the sequential test with --alpha",
+    )
     args = parser.parse_args()
     QSIRECON_SUFFIX_1 = args.recon_suffix_1
     QSIRECON_SUFFIX_2 = args.recon_suffix_2
@@ -121,4 +171,5 @@ if __name__ == "__main__":
         bundles[i] = bundle.replace("_", "").replace("-", "")
 
     get_discrim_two_sample(DICE_ROOT, QSIRECON_SUFFIX_1,
-                           QSIRECON_SUFFIX_2, bundles, OUTPUT_PATH)
+                           QSIRECON_SUFFIX_2, bundles, OUTPUT_PATH, args.workers, args.bundle_workers,
+                           args.cache_root, args.reps, args.alpha, args.batch_reps)
@@ -1,62 +1,75 @@
 import pandas as pd
 import os
+import sys
 import numpy as np
-import re
-from hyppo.discrim import DiscrimTwoSample
 import argparse
+from functools import partial
+from distance_loader import DISTANCE_CACHE_ROOT, load_distances
+from discriminability import bootstrap_discriminability, discrim_two_sample, percentile_ci
+from bundle_pool import run_bundle_jobs
 
-# Helper function to load reconstruction data
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "data_processing"))
+from scan_index import ScanIndex, align_matrices  # noqa: E402
 
 
-def load_reconstruction_data(dice_root, recon_suffix, bundle):
-    dice_path = os.path.join(dice_root, recon_suffix, bundle + ".csv")
-    dices = pd.read_csv(dice_path, index_col=0, na_values=[""]).values
-    distances = 1 - dices
-    subject_ids = pd.read_csv(dice_path, nrows=0).columns.values[1:]
-    subject_ids = np.array([re.sub(r"sub-", "", col) for col in subject_ids])
-    rows_to_keep = ~np.isnan(distances).all(axis=1)
-    distances = distances[rows_to_keep]
-    distances = distances[:, rows_to_keep]
-    subject_ids = subject_ids[rows_to_keep]
-    return distances, subject_ids
-
-# Helper function to filter for common subject IDs
-
-
-def filter_common(subject_ids, distances, common_subids):
-    indices = [i for i, sub in enumerate(subject_ids) if sub in common_subids]
-    filtered_subject_ids = subject_ids[indices]
-    filtered_distances = distances[np.ix_(indices, indices)]
-    return filtered_subject_ids, filtered_distances
-
-# Helper function to filter isolates from the common subject IDs
-
-
-def filter_isolates(common_subids):
-    # Simplify subject IDs to exclude run-specific information
-    simplified_subids = np.array(
-        [re.sub(r"\_run-\d+", "", sub) for sub in common_subids])
-
-    # Identify entries that appear more than once
-    unique, counts = np.unique(simplified_subids, return_counts=True)
-    repeated_entries = unique[counts > 1]
-
-    # Create a mask for common_subids
-    mask = np.isin(simplified_subids, repeated_entries)
-    return mask
-
-# Helper function to apply an isolate mask
-
+def load_filtered_bundle(dice_root: str, recon_suffix_1: str, recon_suffix_2: str, recon_suffix_3: str, cache_root: str,
+                         bundle: str):
+    """
+    Loads the distance matrices of a bundle for the first two reconstructions, restricted to the
+    scans present in all three reconstructions and without isolates.
 
-def apply_isolate_mask(subject_ids, distances, mask):
-    subject_ids = subject_ids[mask]
-    distances = distances[np.ix_(mask, mask)]
-    return subject_ids, distances
+    Returns:
+      A tuple of the list of arrays and the keyword arguments passed to filtered_bundle_job.
+    """
+    print(bundle)
+
+    # Load data for all three reconstructions
+    distances, indices = [], []
+    for recon_suffix in [recon_suffix_1, recon_suffix_2, recon_suffix_3]:
+        recon_distances, scan_ids, _ = load_distances(
+            recon_suffix, bundle, dice_root, cache_root)
+        distances.append(recon_distances)
+        indices.append(ScanIndex.from_scan_names(scan_ids))
+
+    # Keep the scans present in all three reconstructions, without isolates. The third
+    # reconstruction only restricts the common scans.
+    (distances_1, distances_2), common_index = align_matrices(
+        distances[:2], indices)
+    return [distances_1, distances_2], {"subject_ids": common_index.subject_ids}
+
+
+def filtered_bundle_job(bundle: str, distances_1: np.ndarray, distances_2: np.ndarray, subject_ids: np.ndarray,
+                        recon_suffix_1: str, recon_suffix_2: str, workers: int = 1, reps: int = 1000,
+                        alpha: float = None, batch_reps: int = 100, n_bootstrap: int = 0) -> dict:
+    """Computes the two sample discriminability test of one bundle and optionally paired
+    subject-level bootstrap confidence intervals of both methods. Run in a worker process."""
+    two_sample_output = discrim_two_sample(
+        distances_1, distances_2, subject_ids, reps=reps, workers=workers, alpha=alpha, batch_reps=batch_reps)
+    df_row = {
+        "bundle": bundle,
+        "discrim_" + recon_suffix_1: two_sample_output.d1,
+        "discrim_" + recon_suffix_2: two_sample_output.d2,
+        "p-value": two_sample_output.pvalue,
+        "n_permutations": two_sample_output.n_permutations,
+        "mc_error": two_sample_output.mc_error
+    }
+    if n_bootstrap > 0:
+        bootstrap_dist = bootstrap_discriminability(
+            [distances_1, distances_2], subject_ids, n_bootstrap, workers=workers)
+        ci = percentile_ci(bootstrap_dist)
+        for k, recon_suffix in enumerate([recon_suffix_1, recon_suffix_2]):
+            df_row["ci_lower_" + recon_suffix] = ci[0, k]
+            df_row["ci_upper_" + recon_suffix] = ci[1, k]
+    print(df_row)
+    return df_row
 
 # Main function
 
 
-def get_discrim_two_sample(dice_root: str, recon_suffix_1: str, recon_suffix_2: str, recon_suffix_3: str, bundle_names: list, output_path: str, workers: int):
+def get_discrim_two_sample(dice_root: str, recon_suffix_1: str, recon_suffix_2: str, recon_suffix_3: str, bundle_names: list, output_path: str, workers: int,
+                           bundle_workers: int = 1, cache_root: str = DISTANCE_CACHE_ROOT,
+                           reps: int = 1000, alpha: float = None, batch_reps: int = 100, n_bootstrap: int = 0):
     """
     Parameters:
     ----------
@@ -72,54 +85,37 @@ def get_discrim_two_sample(dice_root: str, recon_suffix_1: str, recon_suffix_2:
         List of bundle names.
     output_path : str
         Path to save the output CSV file.
+    workers : int
+        Total number of CPUs.
+    bundle_workers : int
+        Number of bundles tested in parallel on a process pool (see bundle_pool.py), each using
+        workers // bundle_workers threads for the permutations.
+    cache_root : str
+        Directory of the cache of parsed distance matrices (see distance_loader.py).
+    reps : int
+        Number of permutations (maximum number if alpha is given).
+    alpha : float
+        Optional significance level. If given, the permutations of a bundle stop as soon as its
+        p-value is decisively above or below alpha (see discriminability.discrim_two_sample).
+    batch_reps : int
+        Number of permutations added per step of the sequential test.
+    n_bootstrap : int
+        Number of subject-level bootstrap replicates. If positive, 95% percentile confidence
+        intervals of the discriminability of both methods are added.
     """
-    df = pd.DataFrame(columns=[
-                      "bundle", "discrim_" + recon_suffix_1, "discrim_" + recon_suffix_2, "p-value"])
-    for bundle in bundle_names:
-        print(bundle)
-
-        # Load data for all three reconstructions
-        distances_1, subject_ids_1 = load_reconstruction_data(
-            dice_root, recon_suffix_1, bundle)
-        distances_2, subject_ids_2 = load_reconstruction_data(
-            dice_root, recon_suffix_2, bundle)
-        distances_3, subject_ids_3 = load_reconstruction_data(
-            dice_root, recon_suffix_3, bundle)
-
-        # Find common subject IDs across all three reconstructions
-        common_subids = np.intersect1d(
-            np.intersect1d(subject_ids_1, subject_ids_2), subject_ids_3
-        )
-
-        # Filter distance matrices and subject IDs for common combinations
-        subject_ids_1, distances_1 = filter_common(
-            subject_ids_1, distances_1, common_subids)
-        subject_ids_2, distances_2 = filter_common(
-            subject_ids_2, distances_2, common_subids)
-        subject_ids_3, distances_3 = filter_common(
-            subject_ids_3, distances_3, common_subids)
-
-        # Remove isolates
-        isolate_mask = filter_isolates(common_subids)
-        subject_ids_1, distances_1 = apply_isolate_mask(
-            subject_ids_1, distances_1, isolate_mask)
-        subject_ids_2, distances_2 = apply_isolate_mask(
-            subject_ids_2, distances_2, isolate_mask)
-        subject_ids_1 = np.array([re.sub(r"\_run-\d+", "", sub)
-                                 for sub in subject_ids_1])
-
-        # Compute discriminability for the first two reconstructions
-        two_sample_output = DiscrimTwoSample(is_dist=True).test(
-            distances_1, distances_2, subject_ids_1, workers=workers)
-        df_row = {
-            "bundle": bundle,
-            "discrim_" + recon_suffix_1: two_sample_output.d1,
-            "discrim_" + recon_suffix_2: two_sample_output.d2,
-            "p-value": two_sample_output.pvalue,
-        }
-        print(df_row)
-        df = pd.concat([df, pd.DataFrame([df_row])], ignore_index=True)
-
+    rows = run_bundle_jobs(
+        bundle_names, partial(load_filtered_bundle, dice_root,
+                              recon_suffix_1, recon_suffix_2, recon_suffix_3, cache_root),
+        partial(filtered_bundle_job, recon_suffix_1=recon_suffix_1, recon_suffix_2=recon_suffix_2,
+                workers=max(1, workers // bundle_workers), reps=reps, alpha=alpha, batch_reps=batch_reps,
+                n_bootstrap=n_bootstrap),
+        bundle_workers)
+    columns = ["bundle", "discrim_" + recon_suffix_1, "discrim_" + recon_suffix_2, "p-value",
+               "n_permutations", "mc_error"]
+    if n_bootstrap > 0:
+        columns += ["ci_lower_" + recon_suffix_1, "ci_upper_" + recon_suffix_1,
+                    "ci_lower_" + recon_suffix_2, "ci_upper_" + recon_suffix_2]
+    df = pd.DataFrame(rows, columns=columns)
     df.to_csv(output_path, index=False)
     return
 
@@ -148,7 +144,44 @@ if __name__ == "__main__":
         "--workers",
         type=int,
         required=True,
-        help="Num CPUs available for permutation testing",
+        help="Num CPUs available for testing bundles and permutations in parallel",
+    )
+    parser.add_argument(
+        "--bundle_workers",
+        type=int,
+        default=1,
+        help="Num bundles tested in parallel, each using workers // bundle_workers CPUs for the permutations",
+    )
+    parser.add_argument(
+        "--cache_root",
+        type=str,
+        default=DISTANCE_CACHE_ROOT,
+        help="Directory of the cache of parsed distance matrices shared by the discriminability scripts",
+    )
+    parser.add_argument(
+        "--reps",
+        type=int,
+        default=1000,
+        help="Num permutations (maximum number with --alpha)",
+    )
+    parser.add_argument(
+        "--alpha",
+        type=float,
+        default=None,
+        help="Optional significance level. If given, permutations stop as soon as the p-value's "
+        "confidence interval lies entirely above or below alpha",
+    )
+    parser.add_argument(
+        "--batch_reps",
+        type=int,
+        default=100,
+        help="Num permutations added per step of the sequential test with --alpha",
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=0,
+        help="Num subject-level bootstrap replicates for percentile confidence intervals (0: no bootstrap)",
     )
     args = parser.parse_args()
     QSIRECON_SUFFIX_1 = args.recon_suffix_1
@@ -171,4 +204,5 @@ if __name__ == "__main__":
         bundles[i] = bundle.replace("_", "").replace("-", "")
 
     get_discrim_two_sample(DICE_ROOT, QSIRECON_SUFFIX_1, QSIRECON_SUFFIX_2,
-                           QSIRECON_SUFFIX_3, bundles, OUTPUT_PATH, WORKERS)
+                           QSIRECON_SUFFIX_3, bundles, OUTPUT_PATH, WORKERS, args.bundle_workers,
+                           args.cache_root, args.reps, args.alpha, args.batch_reps, args.bootstrap)
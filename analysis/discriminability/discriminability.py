@@ -0,0 +1,486 @@
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import numpy as np
+from scipy.sparse import csr_matrix
+from scipy.stats import norm, rankdata
+
+DiscrimOneSampleOutput = namedtuple(
+    "DiscrimOneSampleOutput", ["stat", "pvalue", "null_dist"])
+DiscrimTwoSampleOutput = namedtuple(
+    "DiscrimTwoSampleOutput", ["d1", "d2", "pvalue", "n_permutations", "mc_error"])
+
+
+def check_inputs(distance_matrices: list, labels: np.ndarray):
+    """
+    Checks the inputs of the discriminability tests and removes isolates, following the
+    input conditioning of hyppo's discriminability tests.
+
+    Args:
+      distance_matrices: List of n x n distance matrices sharing the same rows.
+      labels: Array of n subject IDs, matched to the rows of the distance matrices.
+
+    Returns:
+      A tuple of the float64 distance matrices and the labels without isolates
+      (subjects with a single scan).
+
+    Raises:
+      ValueError: If the inputs contain NaNs, have too few samples or only a single subject.
+    """
+    labels = np.asarray(labels)
+    n_samples = len(labels)
+    uniques, counts = np.unique(labels, return_counts=True)
+    if (counts != 1).sum() <= 1:
+        raise ValueError(
+            "You have passed a vector containing only a single unique sample id.")
+    keep = np.isin(labels, uniques[counts != 1])
+    checked = []
+    for distances in distance_matrices:
+        distances = np.asarray(distances, dtype=np.float64)
+        if distances.shape != (n_samples, n_samples):
+            raise ValueError(
+                "The distance matrices must be square and match the number of labels.")
+        if np.isnan(distances).any():
+            raise ValueError("The distance matrix contains NaNs.")
+        if n_samples <= 10:
+            raise ValueError("Number of samples is too low")
+        checked.append(distances[np.ix_(keep, keep)])
+    return checked, labels[keep]
+
+
+def _repeat_within_groups(group_starts: np.ndarray, group_sizes: np.ndarray):
+    """For each element with a group starting at group_starts and of size group_sizes, lists
+    all positions of its group. Returns the element of each entry and the listed position."""
+    element = np.repeat(np.arange(len(group_starts)), group_sizes)
+    offset = np.arange(len(element)) - np.repeat(
+        np.cumsum(group_sizes) - group_sizes, group_sizes)
+    return element, group_starts[element] + offset
+
+
+class _PairLayout:
+    """
+    Index templates of all same-subject pairs, with the scans sorted by subject.
+
+    Permuting the labels does not change the group sizes, so the same templates are reused for
+    every permutation by mapping sorted positions to different rows of the distance matrix.
+    """
+
+    def __init__(self, labels: np.ndarray):
+        self.n_samples = len(labels)
+        self.order = np.argsort(labels, kind="stable")
+        _, group_index, group_sizes = np.unique(
+            labels[self.order], return_inverse=True, return_counts=True)
+        group_starts = np.cumsum(group_sizes) - group_sizes
+        position_starts = group_starts[group_index]
+        position_sizes = group_sizes[group_index]
+
+        # Ordered pairs (a, b) of different scans of the same subject
+        a, b = _repeat_within_groups(position_starts, position_sizes)
+        distinct = a != b
+        self.a, self.b = a[distinct], b[distinct]
+        # Number of distances to other subjects in the row of a
+        self.n_other = self.n_samples - position_sizes[self.a]
+
+        # All scans k of the subject of a, used to remove same-subject distances from the
+        # counts over the full row. Grouped by pair such that they can be summed with reduceat
+        pair, self.k = _repeat_within_groups(
+            position_starts[self.a], position_sizes[self.a])
+        self.triple_a = self.a[pair]
+        self.triple_pair = pair
+        self.pair_starts = np.cumsum(
+            position_sizes[self.a]) - position_sizes[self.a]
+
+        # Position of each pair in the padded rdf array of hyppo's _discr_rdf
+        self.column = self.b - position_starts[self.a] - (self.b > self.a)
+        self.max_len = position_sizes.max() - 1
+
+    def rdfs_from_counts(self, less: np.ndarray, equal: np.ndarray) -> np.ndarray:
+        """Reliability density values from the number of smaller and equal other-subject distances."""
+        return 1 - (less + 0.5 * equal) / self.n_other
+
+    def padded_rdfs(self, rdfs: np.ndarray) -> np.ndarray:
+        """Arranges the rdf values of the unpermuted labels as the NaN padded array of hyppo."""
+        out = np.full((self.n_samples, self.max_len), np.nan)
+        out[self.order[self.a], self.column] = rdfs
+        return out
+
+
+def rank_rows(distances: np.ndarray):
+    """
+    Ranks every row of a distance matrix once.
+
+    Returns:
+      A tuple of two int32 matrices: the number of entries in the same row that are smaller
+      than and equal to each entry.
+    """
+    min_rank = rankdata(distances, method="min", axis=1).astype(np.int32)
+    max_rank = rankdata(distances, method="max", axis=1).astype(np.int32)
+    return min_rank - 1, max_rank - min_rank + 1
+
+
+def _ranked_rdfs(distances, less_all, equal_all, layout, members):
+    """
+    Reliability density values of all same-subject pairs from precomputed row ranks.
+
+    Args:
+      distances: n x n float64 distance matrix.
+      less_all, equal_all: Row ranks of the distance matrix (see rank_rows).
+      layout: _PairLayout of the labels.
+      members: Array of shape (..., n) mapping sorted positions to rows of the matrix.
+
+    Returns:
+      Array of shape (..., pairs) with the rdf values.
+    """
+    i, j = members[..., layout.a], members[..., layout.b]
+    triple_i, triple_k = members[..., layout.triple_a], members[..., layout.k]
+    pair_distance = distances[i, j][..., layout.triple_pair]
+    same_subject = distances[triple_i, triple_k]
+    less = less_all[i, j] - np.add.reduceat(
+        same_subject < pair_distance, layout.pair_starts, axis=-1, dtype=np.int64)
+    equal = equal_all[i, j] - np.add.reduceat(
+        same_subject == pair_distance, layout.pair_starts, axis=-1, dtype=np.int64)
+    return layout.rdfs_from_counts(less, equal)
+
+
+def _direct_rdfs(distances, layout):
+    """
+    Reliability density values of all same-subject pairs of the unpermuted labels, counting
+    smaller and equal distances over each pair's row with a single vectorized comparison.
+    Used for matrices that are only evaluated once, such as the convex combinations of the
+    two sample null.
+    """
+    i, j = layout.order[layout.a], layout.order[layout.b]
+    pair_distance = distances[i, j]
+    rows = distances[i]
+    less = (rows < pair_distance[:, None]).sum(axis=1)
+    equal = (rows == pair_distance[:, None]).sum(axis=1)
+    pair_distance = pair_distance[layout.triple_pair]
+    same_subject = distances[layout.order[layout.triple_a], layout.order[layout.k]]
+    less -= np.add.reduceat(same_subject < pair_distance, layout.pair_starts, dtype=np.int64)
+    equal -= np.add.reduceat(same_subject == pair_distance, layout.pair_starts, dtype=np.int64)
+    return layout.rdfs_from_counts(less, equal)
+
+
+def discriminability(distances: np.ndarray, labels: np.ndarray) -> float:
+    """
+    Calculates the discriminability statistic of a distance matrix.
+
+    The result is identical to hyppo's DiscrimOneSample(is_dist=True).statistic, as the
+    rdf values are computed with the same floating point operations and averaged over
+    the same NaN padded array.
+
+    Args:
+      distances: n x n distance matrix without isolates.
+      labels: Array of n subject IDs.
+
+    Returns:
+      The discriminability statistic.
+    """
+    layout = _PairLayout(np.asarray(labels))
+    return float(np.nanmean(layout.padded_rdfs(_direct_rdfs(
+        np.asarray(distances, dtype=np.float64), layout))))
+
+
+def discrim_one_sample(
+    distances: np.ndarray, labels: np.ndarray, reps: int = 1000, batch_size: int = 100,
+    random_state=None, workers: int = 1
+) -> DiscrimOneSampleOutput:
+    """
+    One sample discriminability test with a label permutation null.
+
+    Each row of the distance matrix is ranked once. A permutation of the labels then only
+    changes which pairs are same-subject pairs, so the rdf values of a batch of permutations
+    are looked up from the shared ranks at once instead of re-ranking every row. The batches are
+    distributed over threads; the permutations are drawn in the same order for any number of
+    workers, so the null distribution only depends on random_state.
+
+    Args:
+      distances: n x n distance matrix (e.g., 1 - Dice).
+      labels: Array of n subject IDs. Isolates are removed.
+      reps: Number of label permutations.
+      batch_size: Number of permutations evaluated at once.
+      random_state: Seed of the random number generator.
+      workers: Number of threads the batches of permutations are distributed over.
+
+    Returns:
+      DiscrimOneSampleOutput with the statistic, the p-value and the null distribution.
+    """
+    (distances,), labels = check_inputs([distances], labels)
+    layout = _PairLayout(labels)
+    stat = float(np.nanmean(layout.padded_rdfs(_direct_rdfs(distances, layout))))
+
+    less_all, equal_all = rank_rows(distances)
+    rng = np.random.default_rng(random_state)
+    batch_starts = range(0, reps, batch_size)
+    members = [
+        rng.permuted(np.tile(np.arange(layout.n_samples),
+                             (min(batch_size, reps - batch_start), 1)), axis=1)
+        for batch_start in batch_starts
+    ]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        null_dist = np.concatenate([np.zeros(0)] + list(executor.map(
+            lambda batch_members: _ranked_rdfs(
+                distances, less_all, equal_all, layout, batch_members).mean(axis=1),
+            members)))
+    pvalue = (1 + (null_dist >= stat).sum()) / (1 + reps)
+    return DiscrimOneSampleOutput(stat, pvalue, null_dist)
+
+
+def _convex_combination_stats(distance_matrices, layout, seed):
+    """Discriminability of random convex combinations of the rows of each distance matrix,
+    drawn with the same row indices and weights for all matrices from one generator seeded
+    with seed."""
+    rng = np.random.default_rng(seed)
+    n_samples = layout.n_samples
+    q1 = rng.choice(n_samples, n_samples)
+    q2 = rng.choice(n_samples, n_samples)
+    lamda = rng.uniform(size=n_samples)[:, None]
+    stats = []
+    for distances in distance_matrices:
+        # lamda * distances[q1] + (1 - lamda) * distances[q2] without further temporary matrices
+        combination = distances[q1]
+        combination *= lamda
+        second = distances[q2]
+        second *= 1 - lamda
+        combination += second
+        del second
+        stats.append(_direct_rdfs(combination, layout).mean())
+    return stats
+
+
+def diff_null_pvalue(null_1: np.ndarray, null_2: np.ndarray, observed_diff: float, alt: str = "neq",
+                     rows_per_chunk: int = 1024) -> float:
+    """
+    P-value of the difference in discriminability against the null distribution of all
+    differences null_1[i] - null_2[j] and null_2[j] - null_1[i] with i < j, as in hyppo's
+    DiscrimTwoSample, without materializing the reps^2 differences.
+
+    Args:
+      null_1, null_2: Null distributions of the two discriminability statistics.
+      observed_diff: Observed difference of the two statistics.
+      alt: Alternative hypothesis, "greater", "less" or "neq".
+      rows_per_chunk: Number of i processed at once.
+
+    Returns:
+      The p-value. 1 / reps if no difference under the null is more extreme.
+    """
+    if alt not in ["greater", "less", "neq"]:
+        raise ValueError("You have not entered a valid alternative.")
+    reps = len(null_1)
+    count = 0
+    for chunk_start in range(0, reps, rows_per_chunk):
+        chunk_stop = min(chunk_start + rows_per_chunk, reps)
+        diff = null_1[chunk_start:chunk_stop, None] - null_2[None, :]
+        upper = np.arange(reps)[None, :] > np.arange(
+            chunk_start, chunk_stop)[:, None]
+        diff = diff[upper]
+        if alt == "greater":
+            count += (diff > observed_diff).sum() + (-diff > observed_diff).sum()
+        elif alt == "less":
+            count += (diff < observed_diff).sum() + (-diff < observed_diff).sum()
+        else:
+            count += 2 * (abs(diff) > abs(observed_diff)).sum()
+    pvalue = count / (reps * (reps - 1))
+    if pvalue == 0:
+        pvalue = 1 / reps
+    return pvalue
+
+
+def monte_carlo_error(pvalue: float, reps: int) -> float:
+    """Monte Carlo standard error of a permutation p-value estimated from reps replications."""
+    return float(np.sqrt(pvalue * (1 - pvalue) / reps))
+
+
+def discrim_two_sample(
+    distances_1: np.ndarray, distances_2: np.ndarray, labels: np.ndarray, reps: int = 1000,
+    alt: str = "neq", workers: int = 1, random_state=None, alpha: float = None,
+    batch_reps: int = 100, confidence: float = 0.99
+) -> DiscrimTwoSampleOutput:
+    """
+    Two sample discriminability test with the convex combination null of hyppo's
+    DiscrimTwoSample, using a vectorized statistic.
+
+    If alpha is given, the null distribution is grown sequentially in batches of batch_reps
+    replications and the test stops as soon as the confidence interval of the p-value
+    (p +- z * Monte Carlo error) lies entirely above or below alpha, or after reps replications.
+
+    Args:
+      distances_1, distances_2: n x n distance matrices of the two methods, matched row by row.
+      labels: Array of n subject IDs. Isolates are removed.
+      reps: Number of replications of the null distribution (maximum number if alpha is given).
+      alt: Alternative hypothesis, "greater", "less" or "neq".
+      workers: Number of threads the replications are distributed over.
+      random_state: Seed of the random number generator.
+      alpha: Optional significance level for sequential early stopping.
+      batch_reps: Number of replications added per step of the sequential test.
+      confidence: Confidence level of the p-value interval used to decide on early stopping.
+
+    Returns:
+      DiscrimTwoSampleOutput with both discriminability statistics, the p-value, the number of
+      replications used and the Monte Carlo standard error of the p-value.
+    """
+    distance_matrices, labels = check_inputs([distances_1, distances_2], labels)
+    layout = _PairLayout(labels)
+    d1, d2 = [
+        float(np.nanmean(layout.padded_rdfs(_direct_rdfs(distances, layout))))
+        for distances in distance_matrices
+    ]
+
+    if alpha is None:
+        batch_reps = reps
+    batch_reps = max(2, batch_reps)
+    z = norm.ppf(1 - (1 - confidence) / 2)
+    rng = np.random.default_rng(random_state)
+    null_dist = np.zeros((0, 2))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        while len(null_dist) < reps:
+            seeds = rng.integers(np.iinfo(np.int32).max,
+                                 size=min(batch_reps, reps - len(null_dist)))
+            null_dist = np.concatenate([null_dist, np.array(list(executor.map(
+                lambda seed: _convex_combination_stats(distance_matrices, layout, seed), seeds)))])
+            pvalue = diff_null_pvalue(
+                null_dist[:, 0], null_dist[:, 1], d1 - d2, alt)
+            mc_error = monte_carlo_error(pvalue, len(null_dist))
+            if alpha is not None and (pvalue - z * mc_error > alpha or pvalue + z * mc_error < alpha):
+                break
+    return DiscrimTwoSampleOutput(d1, d2, pvalue, len(null_dist), mc_error)
+
+
+def bootstrap_counts(distances: np.ndarray, labels: np.ndarray, pairs_per_chunk: int = 512) -> dict:
+    """
+    Precomputes the rank structure the subject-level bootstrap reindexes.
+
+    For every same-subject pair (i, j), the number of distances in row i that are smaller than
+    and equal to d(i, j) is counted separately for every other subject. The weighted counts of a
+    bootstrap sample (subjects drawn with replacement) are then a matrix product of these counts
+    with the subject weights, without re-ranking any row.
+
+    Args:
+      distances: n x n distance matrix without isolates.
+      labels: Array of n subject IDs.
+      pairs_per_chunk: Number of pairs whose rows are compared at once.
+
+    Returns:
+      Dictionary with the float32 pairs x subjects matrices "less" and "equal", the subject of each
+      pair ("pair_subject") and the number of scans per subject ("scans_per_subject").
+    """
+    distances = np.asarray(distances, dtype=np.float64)
+    layout = _PairLayout(labels)
+    _, subject_index = np.unique(labels, return_inverse=True)
+    n_subjects = subject_index.max() + 1
+    membership = csr_matrix(
+        (np.ones(len(labels), dtype=np.float32), (np.arange(len(labels)), subject_index)),
+        shape=(len(labels), n_subjects))
+    i, j = layout.order[layout.a], layout.order[layout.b]
+    pair_subject = subject_index[i]
+    less = np.empty((len(i), n_subjects), dtype=np.float32)
+    equal = np.empty((len(i), n_subjects), dtype=np.float32)
+    for chunk_start in range(0, len(i), pairs_per_chunk):
+        chunk = slice(chunk_start, min(chunk_start + pairs_per_chunk, len(i)))
+        rows = distances[i[chunk]]
+        pair_distance = distances[i[chunk], j[chunk]][:, None]
+        less[chunk] = (membership.T @ (rows < pair_distance).T.astype(np.float32)).T
+        equal[chunk] = (membership.T @ (rows == pair_distance).T.astype(np.float32)).T
+    # Distances to the own subject never count as other-subject distances
+    less[np.arange(len(i)), pair_subject] = 0
+    equal[np.arange(len(i)), pair_subject] = 0
+    return {
+        "less": less,
+        "equal": equal,
+        "pair_subject": pair_subject,
+        "scans_per_subject": np.bincount(subject_index).astype(np.float32),
+    }
+
+
+def weighted_discriminability(counts: dict, weights: np.ndarray) -> np.ndarray:
+    """
+    Discriminability of bootstrap samples given as subject weights.
+
+    A subject drawn k times contributes its same-subject pairs k times and its distances to
+    the scans of other subjects k times. Copies of the own subject are not counted as other
+    subjects. With all weights equal to one, this is the discriminability statistic.
+
+    Args:
+      counts: Rank structure of a distance matrix (see bootstrap_counts).
+      weights: Array of shape subjects x replicates with the multiplicity of each subject.
+
+    Returns:
+      Array with the discriminability of each replicate.
+    """
+    weights = weights.astype(np.float32)
+    pair_weights = weights[counts["pair_subject"]]
+    n_other = (counts["scans_per_subject"] @ weights)[None, :] - \
+        counts["scans_per_subject"][counts["pair_subject"], None] * pair_weights
+    with np.errstate(divide="ignore", invalid="ignore"):
+        rdfs = 1 - (counts["less"] @ weights + 0.5 *
+                    (counts["equal"] @ weights)) / n_other
+        return (pair_weights * rdfs).sum(axis=0) / pair_weights.sum(axis=0)
+
+
+def _bootstrap_batch(counts_list: list, seed: int, n_reps: int) -> np.ndarray:
+    """Draws n_reps subject-level bootstrap samples and evaluates them for every distance matrix."""
+    rng = np.random.default_rng(seed)
+    n_subjects = len(counts_list[0]["scans_per_subject"])
+    draws = rng.integers(n_subjects, size=(n_reps, n_subjects))
+    weights = np.zeros((n_subjects, n_reps))
+    np.add.at(weights, (draws, np.arange(n_reps)[:, None]), 1)
+    return np.stack([weighted_discriminability(counts, weights) for counts in counts_list], axis=1)
+
+
+_WORKER_COUNTS = None
+
+
+def _init_bootstrap_worker(counts_list):
+    """Stores the rank structures once per worker process."""
+    global _WORKER_COUNTS
+    _WORKER_COUNTS = counts_list
+
+
+def _bootstrap_batch_worker(seed: int, n_reps: int) -> np.ndarray:
+    return _bootstrap_batch(_WORKER_COUNTS, seed, n_reps)
+
+
+def bootstrap_discriminability(
+    distance_matrices: list, labels: np.ndarray, n_boot: int = 1000, batch_size: int = 100,
+    workers: int = 1, random_state=None
+) -> np.ndarray:
+    """
+    Subject-level bootstrap of the discriminability of one or more distance matrices.
+
+    Subjects (with all their scans) are drawn with replacement. The same draws are used for all
+    distance matrices, such that the replicates of different methods are paired.
+
+    Args:
+      distance_matrices: List of n x n distance matrices, matched row by row.
+      labels: Array of n subject IDs. Isolates are removed.
+      n_boot: Number of bootstrap replicates.
+      batch_size: Number of replicates evaluated at once.
+      workers: Number of processes the batches are distributed over.
+      random_state: Seed of the random number generator.
+
+    Returns:
+      Array of shape n_boot x len(distance_matrices) with the bootstrap distributions.
+    """
+    distance_matrices, labels = check_inputs(distance_matrices, labels)
+    counts_list = [bootstrap_counts(distances, labels)
+                   for distances in distance_matrices]
+    del distance_matrices
+    batch_sizes = [min(batch_size, n_boot - start)
+                   for start in range(0, n_boot, batch_size)]
+    seeds = np.random.default_rng(random_state).integers(
+        np.iinfo(np.int32).max, size=len(batch_sizes))
+    if workers == 1:
+        batches = [_bootstrap_batch(counts_list, seed, n_reps)
+                   for seed, n_reps in zip(seeds, batch_sizes)]
+    else:
+        with ProcessPoolExecutor(
+            max_workers=workers, initializer=_init_bootstrap_worker, initargs=(counts_list,)
+        ) as executor:
+            batches = list(executor.map(
+                _bootstrap_batch_worker, seeds, batch_sizes))
+    return np.concatenate(batches)
+
+
+def percentile_ci(bootstrap_dist: np.ndarray, confidence: float = 0.95) -> np.ndarray:
+    """Percentile confidence interval(s) (lower, upper) of bootstrap distributions along axis 0."""
+    return np.percentile(
+        bootstrap_dist, [50 * (1 - confidence), 50 * (1 + confidence)], axis=0)
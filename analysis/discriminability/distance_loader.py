@@ -0,0 +1,92 @@
+import hashlib
+import os
+import re
+import sys
+import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "dice_scores"))
+from dice_matrix import DICE_ROOT, get_dice_paths, load_dice_matrix  # noqa: E402
+
+DISTANCE_CACHE_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/discriminability/distance_cache"
+
+
+def get_dice_source(recon: str, bundle: str, dice_root: str = DICE_ROOT) -> tuple:
+    """
+    Returns the files a bundle's Dice matrix is read from (see dice_matrix.load_dice_matrix):
+    the packed binary matrix and its scan IDs, or the CSV of earlier versions.
+    """
+    npy_path, ids_path = get_dice_paths(os.path.join(dice_root, recon), bundle)
+    if os.path.exists(npy_path):
+        return npy_path, ids_path
+    return (os.path.join(dice_root, recon, bundle + ".csv"),)
+
+
+def get_cache_path(source_paths: tuple, cache_root: str) -> str:
+    """Returns the cache file of a Dice matrix, named by a hash of its source path."""
+    digest = hashlib.sha1(os.path.abspath(
+        source_paths[0]).encode()).hexdigest()
+    return os.path.join(cache_root, digest + ".npz")
+
+
+def get_source_mtimes(source_paths: tuple) -> np.ndarray:
+    """Returns the modification times (ns) of the source files of a Dice matrix."""
+    return np.array([os.stat(path).st_mtime_ns for path in source_paths], dtype=np.int64)
+
+
+def clean_scan_ids(scan_names: np.ndarray) -> np.ndarray:
+    """Removes the "sub-" prefix from scan names ("sub-<id>_run-<run>" -> "<id>_run-<run>")."""
+    return np.array([re.sub(r"sub-", "", name) for name in scan_names])
+
+
+def get_subject_labels(scan_ids: np.ndarray) -> np.ndarray:
+    """Removes the run from cleaned scan IDs ("<id>_run-<run>" -> "<id>")."""
+    return np.array([re.sub(r"\_run-\d+", "", scan_id) for scan_id in scan_ids])
+
+
+def _parse_distances(recon: str, bundle: str, dice_root: str):
+    """Parses a Dice matrix and removes rows and columns of scans without a mask."""
+    distances, scan_names = load_dice_matrix(recon, bundle, dice_root)
+    rows_to_keep = ~np.isnan(distances).all(axis=1)
+    distances = distances[np.ix_(rows_to_keep, rows_to_keep)]
+    return distances.astype(np.float32), clean_scan_ids(scan_names[rows_to_keep]), rows_to_keep
+
+
+def load_distances(recon: str, bundle: str, dice_root: str = DICE_ROOT, cache_root: str = DISTANCE_CACHE_ROOT):
+    """
+    Loads the distance matrix (1 - Dice) of a bundle for the discriminability tests.
+
+    Parsed matrices are cached on disk, keyed by the path and modification time of the Dice
+    file, such that each Dice file is parsed at most once across all discriminability scripts.
+
+    Args:
+      recon: Reconstruction method (e.g., GQIautotrack).
+      bundle: Bundle name without underscores and dashes.
+      dice_root: Directory containing one folder of Dice matrices per reconstruction.
+      cache_root: Directory of the cache. None disables caching.
+
+    Returns:
+      A tuple of the float32 distance matrix without rows and columns of scans the bundle
+      couldn't be reconstructed for, the cleaned scan IDs ("<id>_run-<run>") of the remaining
+      rows and the boolean mask of the remaining rows in the Dice matrix.
+    """
+    if cache_root is None:
+        return _parse_distances(recon, bundle, dice_root)
+
+    source_paths = get_dice_source(recon, bundle, dice_root)
+    cache_path = get_cache_path(source_paths, cache_root)
+    mtimes = get_source_mtimes(source_paths)
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if np.array_equal(cached["mtimes"], mtimes):
+                return cached["distances"], cached["scan_ids"], cached["rows_to_keep"]
+
+    distances, scan_ids, rows_to_keep = _parse_distances(
+        recon, bundle, dice_root)
+    os.makedirs(cache_root, exist_ok=True)
+    # Write to a temporary file first such that concurrent jobs never read a partial cache file
+    temporary_path = cache_path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+    np.savez(temporary_path, distances=distances, scan_ids=scan_ids,
+             rows_to_keep=rows_to_keep, mtimes=mtimes)
+    os.replace(temporary_path, cache_path)
+    return distances, scan_ids, rows_to_keep
@@ -1,16 +1,60 @@
 import os
+import re
+import sys
+import numpy as np
 import pandas as pd
-import glob
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "data_processing"))
+from scan_index import ScanIndex  # noqa: E402
+from inventory import RECONSTRUCTIONS, query_files, query_subjects  # noqa: E402
+
+STREAMLINES_PATTERN = re.compile(
+    r"^(?P<subject_id>sub-[^_]+)_ses-PNC1(?:_[^_]+)*?_(?P<run>run-\d+)"
+    r"_space-T1w_bundle-(?P<bundle>[^_]+)_streamlines\.tck\.gz$"
+)
+
+
+def list_reconstructed_bundles(data_root: str, subject: str) -> list:
+    """Lists the reconstructed bundles of a subject with a single scan of its dwi directory.
+
+    Returns:
+      List of (run, bundle) tuples of all streamline files of the subject.
+    """
+    dwi_dir = os.path.join(data_root, subject, "ses-PNC1", "dwi")
+    if not os.path.isdir(dwi_dir):
+        return []
+    found = []
+    with os.scandir(dwi_dir) as entries:
+        for entry in entries:
+            match = STREAMLINES_PATTERN.match(entry.name)
+            if match and match["subject_id"] == subject:
+                found.append((match["run"], match["bundle"]))
+    return found
+
+
+def scatter_reconstructed(scan_index: ScanIndex, bundles: list, subject_ids, runs, found_bundles) -> np.ndarray:
+    """Builds the boolean scans x bundles matrix from the (subject, run, bundle) of all found
+    streamline files in one allocation. Files of other scans or bundles are ignored."""
+    rows = scan_index.positions(np.char.add(np.char.add(
+        np.asarray(subject_ids, dtype=str), "_"), np.asarray(runs, dtype=str)))
+    columns = pd.Index(bundles).get_indexer(np.asarray(found_bundles, dtype=str))
+    found = (rows >= 0) & (columns >= 0)
+    reconstructed = np.zeros((len(scan_index), len(bundles)), dtype=bool)
+    reconstructed[rows[found], columns[found]] = True
+    return reconstructed
 
 
 def get_reconstructed_bundles(
-    data_root: str, bundles: list, output_path: str, excluded_subjects: list = None
+    data_root: str, bundles: list, output_path: str, excluded_subjects: list = None, workers: int = 8
 ):
     """
     Generates a DataFrame of reconstructed bundles for each subject and saves it to a CSV file.
 
-    This function iterates through subject directories within the specified `data_root` directory, checking for the presence of bundle reconstruction files for each specified bundle in each subject's directory.
+    This function lists each subject directory within the specified `data_root` directory once (on a thread pool) and checks which bundle reconstruction files of the specified bundles it contains.
     The function builds a DataFrame with each row representing a subject and run, and each column indicating the presence (1) or absence (0) of a specific bundle's reconstruction.
     It then saves this DataFrame to the specified `output_path` as a CSV file.
 
@@ -23,6 +67,7 @@ def get_reconstructed_bundles(
                            The CSV will contain a binary indicator (1 or 0) for the presence of each bundle in each run for each subject.
         excluded_subjects (list, optional): List of subject IDs to exclude from the analysis.
                                             If provided, these subjects will not be included in the output CSV file.
+        workers (int, optional): Number of threads used to list the subject directories.
 
     Returns:
         None: This function does not return any value. It saves the result as a CSV file at the specified `output_path`.
@@ -39,31 +84,56 @@ def get_reconstructed_bundles(
             if subject in subjects:
                 subjects.remove(subject)
 
-    columns = bundles.copy()
-    columns.insert(0, "subject_id")
-    columns.insert(1, "run")
-
-    df = pd.DataFrame(columns=columns)
-
-    for subject in subjects:
-        print(subject)
-        for run in ["run-01", "run-02"]:
-            df_row = [subject, run]
-            for bundle in bundles:
-                bundle_path = os.path.join(
-                    ROOT_QSIRECON,
-                    subject,
-                    "ses-PNC1",
-                    "dwi",
-                    f"{subject}_ses-PNC1_*{run}_space-T1w_bundle-{bundle}_streamlines.tck.gz",
-                )
-                matching_files = glob.glob(bundle_path)
-                if matching_files:
-                    df_row.append(1)
-                else:
-                    df_row.append(0)
-            df.loc[(len(df))] = df_row
-    df.to_csv(output_path)
+    # One listing per subject directory
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = list(executor.map(partial(list_reconstructed_bundles, data_root), subjects))
+    found = [(subject, run, bundle)
+             for subject, listing in zip(subjects, listings) for run, bundle in listing]
+    subject_ids, runs, found_bundles = zip(*found) if found else ([], [], [])
+
+    # One row per (subject, run)
+    scan_index = ScanIndex.from_subjects(subjects)
+    reconstructed = scatter_reconstructed(scan_index, bundles, subject_ids, runs, found_bundles)
+    to_reconstructed_bundles_df(scan_index, reconstructed, bundles).to_csv(output_path)
+    return
+
+
+def to_reconstructed_bundles_df(scan_index: ScanIndex, reconstructed: np.ndarray, bundles: list) -> pd.DataFrame:
+    """Converts a boolean scans x bundles array to the DataFrame of reconstructed bundles (1 or 0)."""
+    df = pd.DataFrame(reconstructed.astype(np.uint8), columns=bundles)
+    df.insert(0, "subject_id", scan_index.subject_ids)
+    df.insert(1, "run", scan_index.runs)
+    return df
+
+
+def get_reconstructed_bundles_from_inventory(
+    inventory_path: str, data_root: str, bundles: list, output_path: str, excluded_subjects: list = None
+):
+    """
+    Same as get_reconstructed_bundles, but based on the inventory of the outputs (see
+    data_processing/inventory.py) instead of one glob per subject, run and bundle.
+
+    All streamline files of the reconstruction are fetched with one query and scattered into the
+    scans x bundles table (see scatter_reconstructed).
+
+    Args:
+        inventory_path (str): Path of the inventory database, which has to be up to date.
+        data_root (str): Path to the qsirecon output directory of one reconstruction.
+        bundles (list): List of bundle names to check for each subject.
+        output_path (str): File path for the output CSV file.
+        excluded_subjects (list, optional): List of subject IDs to exclude from the analysis.
+    """
+    subjects = query_subjects(inventory_path, data_root)
+    if excluded_subjects is not None:
+        subjects = [subject for subject in subjects if subject not in excluded_subjects]
+    files = query_files(inventory_path, data_root, session="PNC1", space="T1w",
+                        suffix="streamlines", extension=".tck.gz")
+    files = files[files["directory"] == files["subject_id"] + "/ses-PNC1/dwi"]
+
+    scan_index = ScanIndex.from_subjects(subjects)
+    reconstructed = scatter_reconstructed(
+        scan_index, bundles, files["subject_id"], files["run"], files["bundle"])
+    to_reconstructed_bundles_df(scan_index, reconstructed, bundles).to_csv(output_path)
     return
 
 
@@ -72,20 +142,23 @@ if __name__ == "__main__":
     parser.add_argument(
         "--recon_suffix",
         type=str,
-        required=True,
-        help="Reconstruction method (e.g., GQIautotrack)",
+        nargs="+",
+        default=RECONSTRUCTIONS,
+        help="Reconstruction method(s) (e.g., GQIautotrack). Defaults to all three autotrack reconstructions",
     )
-    args = parser.parse_args()
-    QSIRECON_SUFFIX = args.recon_suffix
-    ROOT_QSIRECON = os.path.join(
-        "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs",
-        "qsirecon-" + QSIRECON_SUFFIX,
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        default=None,
+        help="Optional inventory of the outputs (data_processing/inventory.py) to query instead of listing directories",
     )
-    OUTPUT_PATH = (
-        "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs/reconstructed_bundles_"
-        + QSIRECON_SUFFIX
-        + ".csv"
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=8,
+        help="Num threads used to list the subject directories",
     )
+    args = parser.parse_args()
     BUNDLE_NAMES = "../../data/bundle_names.txt"
     EXCLUDED_SBJ_LIST = "../data_processing/subject_lists/excluded_subjects.txt"
 
@@ -96,6 +169,23 @@ if __name__ == "__main__":
     with open(EXCLUDED_SBJ_LIST, "r") as f:
         excluded_subjects = f.read().splitlines()
 
-    get_reconstructed_bundles(
-        ROOT_QSIRECON, bundles, OUTPUT_PATH, excluded_subjects
-    )
+    for QSIRECON_SUFFIX in args.recon_suffix:
+        print(QSIRECON_SUFFIX)
+        ROOT_QSIRECON = os.path.join(
+            "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs",
+            "qsirecon-" + QSIRECON_SUFFIX,
+        )
+        OUTPUT_PATH = (
+            "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs/reconstructed_bundles_"
+            + QSIRECON_SUFFIX
+            + ".csv"
+        )
+
+        if args.inventory is not None:
+            get_reconstructed_bundles_from_inventory(
+                args.inventory, ROOT_QSIRECON, bundles, OUTPUT_PATH, excluded_subjects
+            )
+        else:
+            get_reconstructed_bundles(
+                ROOT_QSIRECON, bundles, OUTPUT_PATH, excluded_subjects, args.workers
+            )
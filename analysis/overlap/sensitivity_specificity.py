@@ -2,16 +2,40 @@ import os
 import SimpleITK as sitk
 import pandas as pd
 import numpy as np
+import argparse
 import sys
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "data_processing"))
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "overlay_maps"))
+from mask_store import get_scan_voxels  # noqa: E402
+from bounding_boxes import get_bounding_box, to_slices  # noqa: E402
 
 BUNDLE_MASK_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/qsirecon_outputs"
 ATLAS_MASK_ROOT = "/cbica/projects/clinical_dmri_benchmark/data/atlas_bundles"
 POPULATION_MAP_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/overlay_maps"
 OUTPUT_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/overlap/"
+UNION_CACHE_ROOT = os.path.join(OUTPUT_ROOT, "union_cache")
+RECONSTRUCTIONS = ["GQIautotrack", "CSDautotrack", "SS3Tautotrack"]
 os.makedirs(OUTPUT_ROOT, exist_ok=True)
 
 # Identify dataset from system argument
-reconstruction = sys.argv[1]
+parser = argparse.ArgumentParser(description="Reconstruction method")
+parser.add_argument("reconstructions", type=str, nargs="+",
+                    help="Reconstruction method(s) (e.g., GQIautotrack). Several reconstructions are "
+                    "evaluated in one run, sharing the bundle unions")
+parser.add_argument("--mask_store", type=str, nargs="+", default=None,
+                    help="Optional mask store directory of each reconstruction (same order) to read the masks from")
+parser.add_argument("--union_cache", type=str, default=UNION_CACHE_ROOT,
+                    help="Directory of the cached bundle unions shared by all reconstructions")
+parser.add_argument("--workers", type=int, default=len(os.sched_getaffinity(0)),
+                    help="Num threads used to read the subject masks")
+args = parser.parse_args()
+reconstructions = args.reconstructions
+if args.mask_store is not None and len(args.mask_store) != len(reconstructions):
+    parser.error("--mask_store needs one directory per reconstruction")
 
 # List of connections to compute overlap measures for
 tract_names_file = "../../data/bundle_names.txt"
@@ -20,69 +44,144 @@ with open(tract_names_file, 'r') as f:
 # Function to compute sensitivity and specificity values for each subject-specific connection based on atlas connection overlap
 
 
-def compute_sensitivity_specificity(sub_mask, template_mask, union):
-    pred_np = sitk.GetArrayFromImage(sub_mask)[union]
-    truth_np = template_mask[union]
-    TP = np.sum((pred_np == 1) & (truth_np == 1))
-    FP = np.sum((pred_np == 1) & (truth_np == 0))
-    TN = np.sum((pred_np == 0) & (truth_np == 0))
-    FN = np.sum((pred_np == 0) & (truth_np == 1))
-    sensitivity = TP / (TP + FN) if (TP + FN) > 0 else np.nan
-    specificity = TN / (TN + FP) if (TN + FP) > 0 else np.nan
+# The union is cropped to its bounding box (union_slices), voxels outside of it are never evaluated.
+# Returns the values of a subject mask at the union voxels, or None if the mask doesn't exist
+def read_union_values(mask_path, union, union_slices):
+    if not os.path.exists(mask_path):
+        return None
+    mask = sitk.ReadImage(mask_path, sitk.sitkUInt8)
+    return sitk.GetArrayViewFromImage(mask)[union_slices][union] != 0
+
+
+# Same as above for a subject mask given as sorted flat voxel indices (mask store)
+def union_values_from_voxels(voxel_indices, union_indices):
+    return np.isin(union_indices, voxel_indices, assume_unique=True)
+
+
+# Compute sensitivity and specificity of all scans of a bundle at once. pred is a scans x union voxels
+# boolean matrix and truth the boolean atlas vector over the same voxels. True positives and the number
+# of predicted voxels of every scan are obtained with one matrix product against [truth, 1].
+def sensitivity_specificity_batch(pred, truth):
+    counts = pred.view(np.uint8) @ np.stack(
+        [truth, np.ones_like(truth)], axis=1).astype(np.int32)
+    TP, n_pred = counts[:, 0], counts[:, 1]
+    n_truth = np.count_nonzero(truth)
+    FP = n_pred - TP
+    FN = n_truth - TP
+    TN = len(truth) - n_truth - FP
+    with np.errstate(invalid="ignore", divide="ignore"):
+        sensitivity = np.where(TP + FN > 0, TP / (TP + FN), np.nan)
+        specificity = np.where(TN + FP > 0, TN / (TN + FP), np.nan)
     return sensitivity, specificity
 
 
+# Gather the union voxel values of all scans of a bundle into one compact boolean matrix, reading
+# the masks on a thread pool. Returns the scans that have a mask and their rows
+def load_union_matrix(load_scan, scans, workers):
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        values = list(executor.map(load_scan, scans))
+    present = [scan for scan, scan_values in zip(scans, values) if scan_values is not None]
+    rows = [scan_values for scan_values in values if scan_values is not None]
+    if not rows:
+        return present, None
+    return present, np.stack(rows)
+
+
+# The union of a bundle only depends on the population maps of all three methods and the atlas mask,
+# so it is computed once and cached as flat voxel indices (int32) together with the atlas values at
+# these voxels. The cache is reused as long as the modification times of these inputs are unchanged
+def get_union_inputs(tract_name, tract_name_short):
+    return [os.path.join(POPULATION_MAP_ROOT, method, tract_name_short + ".nii.gz")
+            for method in RECONSTRUCTIONS] + [f"{ATLAS_MASK_ROOT}/{tract_name}_MNIc.nii.gz"]
+
+
+def compute_union(input_paths):
+    # Read probabilistic maps for all three methods (binarized) and the template (atlas) tract mask
+    prob_maps = [sitk.GetArrayFromImage(sitk.ReadImage(path)) > 0 for path in input_paths[:-1]]
+    atlas_mask = sitk.GetArrayFromImage(
+        sitk.ReadImage(input_paths[-1], sitk.sitkUInt8))
+    # calculate union between population maps and atlas tract to use as mask when calculating subject specific specificity
+    # and sensitivity. Due to large amounts of background around the WM tracts, specificity would always be close to 1 without cropping to the union.
+    union = np.logical_or.reduce(prob_maps + [atlas_mask != 0])
+    union_indices = np.flatnonzero(union).astype(np.int32)
+    return union_indices, atlas_mask.ravel()[union_indices] != 0, np.array(union.shape)
+
+
+def load_union(tract_name, tract_name_short, cache_root):
+    input_paths = get_union_inputs(tract_name, tract_name_short)
+    mtimes = np.array([os.stat(path).st_mtime_ns for path in input_paths], dtype=np.int64)
+    cache_path = os.path.join(cache_root, tract_name_short + "_union.npz")
+    if os.path.exists(cache_path):
+        with np.load(cache_path) as cached:
+            if np.array_equal(cached["mtimes"], mtimes):
+                return cached["union_indices"], cached["truth"], tuple(cached["shape"])
+    union_indices, truth, shape = compute_union(input_paths)
+    os.makedirs(cache_root, exist_ok=True)
+    # Write to a temporary file first such that concurrent runs never read a partial cache file
+    temporary_path = cache_path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+    np.savez(temporary_path, union_indices=union_indices,
+             truth=truth, shape=shape, mtimes=mtimes)
+    os.replace(temporary_path, cache_path)
+    return union_indices, truth, tuple(shape)
+
+
 # Output
-overlap_results = []
+overlap_results = {reconstruction: [] for reconstruction in reconstructions}
 
 # Identify all subject-specific tract masks in template space
-subject_masks_path = f"{BUNDLE_MASK_ROOT}/qsirecon-{reconstruction}"
-subids = os.listdir(subject_masks_path)
+subject_masks_paths = {reconstruction: f"{BUNDLE_MASK_ROOT}/qsirecon-{reconstruction}"
+                       for reconstruction in reconstructions}
+subids = {reconstruction: os.listdir(subject_masks_paths[reconstruction])
+          for reconstruction in reconstructions}
 runs = ["run-01", "run-02"]
 
 for tract_name in tract_names:
     print(tract_name)
     tract_name_short = tract_name.replace("_", "").replace("-", "")
 
-    # Read probabilistic maps for all three methods
-    prob_map_gqi = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(
-        POPULATION_MAP_ROOT, "GQIautotrack", tract_name_short + ".nii.gz")))
-    prob_map_csd = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(
-        POPULATION_MAP_ROOT, "CSDautotrack", tract_name_short + ".nii.gz")))
-    prob_map_ss3t = sitk.GetArrayFromImage(sitk.ReadImage(os.path.join(
-        POPULATION_MAP_ROOT, "SS3Tautotrack", tract_name_short + ".nii.gz")))
-    prob_map_gqi[prob_map_gqi > 0] = 1
-    prob_map_csd[prob_map_csd > 0] = 1
-    prob_map_ss3t[prob_map_ss3t > 0] = 1
-
-    # Read in template (atlas) tract mask
-    atlas_mask_path = f"{ATLAS_MASK_ROOT}/{tract_name}_MNIc.nii.gz"
-    atlas_mask = sitk.GetArrayFromImage(
-        sitk.ReadImage(atlas_mask_path, sitk.sitkUInt8))
+    union_indices, truth, shape = load_union(
+        tract_name, tract_name_short, args.union_cache)
+    # Crop the union to its bounding box, so that subject masks only have to be indexed on this
+    # compact local grid
+    union = np.zeros(shape, dtype=bool)
+    union.flat[union_indices] = True
+    union_slices = to_slices(get_bounding_box(union))
+    union_cropped = union[union_slices]
 
-    # calculate union between population maps and atlas tract to use as mask when calculating subject specific specificity
-    # and sensitivity. Due to large amounts of background around the WM tracts, specificity would always be close to 1 without cropping to the union.
-    union = np.logical_or.reduce(
-        [prob_map_gqi != 0, prob_map_csd != 0, prob_map_ss3t != 0, atlas_mask != 0])
-    
-    for subid in subids:
-        for run in runs:
-            mask_name = subid + "_ses-PNC1_" + run + \
-                "_space-MNI152NLin2009cAsym_bundle-" + tract_name_short + "_mask.nii.gz"
-            mask_path = os.path.join(
-                subject_masks_path, subid, "ses-PNC1", "dwi", "MNI", mask_name)
-            if os.path.exists(mask_path):
-                mask = sitk.ReadImage(mask_path, sitk.sitkUInt8)
-                sensitivity, specificity = compute_sensitivity_specificity(
-                    mask, atlas_mask, union)
-                overlap_results.append({
-                    "subject_id": subid,
-                    "bundle": tract_name,
-                    "run": run,
-                    "sensitivity": sensitivity,
-                    "specificity": specificity
-                })
-
-overlap_results_df = pd.DataFrame(overlap_results)
-overlap_results_df.to_csv(
-    OUTPUT_ROOT + reconstruction + "_overlap.csv", index=False)
+    for k, reconstruction in enumerate(reconstructions):
+        scans = [(subid, run) for subid in subids[reconstruction] for run in runs]
+        if args.mask_store is not None:
+            scan_voxels = get_scan_voxels(args.mask_store[k], tract_name_short)
+
+            def load_scan(scan):
+                if scan not in scan_voxels:
+                    return None
+                return union_values_from_voxels(scan_voxels[scan], union_indices)
+        else:
+            subject_masks_path = subject_masks_paths[reconstruction]
+
+            def load_scan(scan):
+                subid, run = scan
+                mask_name = subid + "_ses-PNC1_" + run + \
+                    "_space-MNI152NLin2009cAsym_bundle-" + tract_name_short + "_mask.nii.gz"
+                mask_path = os.path.join(
+                    subject_masks_path, subid, "ses-PNC1", "dwi", "MNI", mask_name)
+                return read_union_values(mask_path, union_cropped, union_slices)
+
+        present, pred = load_union_matrix(load_scan, scans, args.workers)
+        if pred is None:
+            continue
+        sensitivities, specificities = sensitivity_specificity_batch(pred, truth)
+        for (subid, run), sensitivity, specificity in zip(present, sensitivities, specificities):
+            overlap_results[reconstruction].append({
+                "subject_id": subid,
+                "bundle": tract_name,
+                "run": run,
+                "sensitivity": sensitivity,
+                "specificity": specificity
+            })
+
+for reconstruction in reconstructions:
+    overlap_results_df = pd.DataFrame(overlap_results[reconstruction])
+    overlap_results_df.to_csv(
+        OUTPUT_ROOT + reconstruction + "_overlap.csv", index=False)
@@ -1,7 +1,7 @@
 #!/bin/bash
 #SBATCH --nodes=1
 #SBATCH --ntasks-per-node=1
-#SBATCH --cpus-per-task=1
+#SBATCH --cpus-per-task=8
 #SBATCH --mem=5G
 #SBATCH --time=08:00:00
 #SBATCH --output=../logs/pnc_sens_spec-%A_%a.log
@@ -18,14 +18,15 @@ fi
 # fail whenever something is fishy, use -x to get verbose logfiles
 set -e -u -x
 
-RECON_SUFFIX=$1
+# One or more reconstructions, e.g. GQIautotrack CSDautotrack SS3Tautotrack to share the bundle unions
+RECON_SUFFIXES="$@"
 PYTHON_HELPER_SCRIPT="/cbica/projects/clinical_dmri_benchmark/clinical_dmri_benchmark/analysis/overlap/sensitivity_specificity.py"
 
 source /cbica/projects/clinical_dmri_benchmark/micromamba/etc/profile.d/micromamba.sh
 
 micromamba activate clinical_dmri_benchmark
 
-python3 ${PYTHON_HELPER_SCRIPT} ${RECON_SUFFIX}
+python3 ${PYTHON_HELPER_SCRIPT} ${RECON_SUFFIXES} --workers ${SLURM_CPUS_PER_TASK}
 
 micromamba deactivate
 
@@ -0,0 +1,159 @@
+import os
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+AXES = ["z", "y", "x"]
+
+
+class BoundingBoxError(ValueError):
+    """Raised when a mask has voxels outside of its bundle's bounding box, e.g. because the
+    bounding boxes were computed before the mask was added."""
+
+
+def get_bounding_box(array: np.ndarray):
+    """Returns the bounding box of all nonzero voxels of a (z, y, x) array.
+
+    Args:
+      array: 3D NumPy array as returned by sitk.GetArrayFromImage
+
+    Returns:
+      A tuple of (start, stop) integer arrays in (z, y, x) order, with stop being exclusive.
+      None if the array contains no nonzero voxels.
+    """
+    nonzero = np.nonzero(array)
+    if len(nonzero[0]) == 0:
+        return None
+    start = np.array([axis.min() for axis in nonzero])
+    stop = np.array([axis.max() + 1 for axis in nonzero])
+    return start, stop
+
+
+def union_bounding_box(bounding_boxes: list):
+    """Returns the smallest bounding box containing all given bounding boxes (None entries are ignored)."""
+    bounding_boxes = [bbox for bbox in bounding_boxes if bbox is not None]
+    if not bounding_boxes:
+        return None
+    start = np.min([bbox[0] for bbox in bounding_boxes], axis=0)
+    stop = np.max([bbox[1] for bbox in bounding_boxes], axis=0)
+    return start, stop
+
+
+def to_slices(bounding_box) -> tuple:
+    """Converts a bounding box to a tuple of slices that crops a (z, y, x) array."""
+    start, stop = bounding_box
+    return tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+
+
+def crop_array(array: np.ndarray, bounding_box) -> np.ndarray:
+    """Crops a (z, y, x) array to a bounding box.
+
+    Raises:
+      BoundingBoxError: If nonzero voxels of the array lie outside the bounding box.
+    """
+    cropped = array[to_slices(bounding_box)]
+    if np.count_nonzero(cropped) != np.count_nonzero(array):
+        raise BoundingBoxError(
+            "Mask extends beyond its bundle's bounding box. Recompute the population maps "
+            "and bounding boxes with the current subject list.")
+    return cropped
+
+
+def crop_flat_indices(flat_indices: np.ndarray, full_shape: tuple, bounding_box) -> np.ndarray:
+    """Converts flat voxel indices of the full (z, y, x) grid to flat indices of the cropped grid.
+
+    Raises:
+      BoundingBoxError: If voxels lie outside the bounding box.
+    """
+    start, stop = bounding_box
+    coords = np.stack(np.unravel_index(flat_indices, full_shape)) - start[:, None]
+    if np.any(coords < 0) or np.any(coords >= (stop - start)[:, None]):
+        raise BoundingBoxError(
+            "Mask extends beyond its bundle's bounding box. Recompute the population maps "
+            "and bounding boxes with the current subject list.")
+    return np.ravel_multi_index(tuple(coords), tuple(stop - start))
+
+
+def uncrop_flat_indices(local_indices: np.ndarray, full_shape: tuple, bounding_box) -> np.ndarray:
+    """Maps flat indices of the cropped grid back to flat indices of the full MNI grid."""
+    start, stop = bounding_box
+    coords = np.stack(np.unravel_index(
+        local_indices, tuple(stop - start))) + start[:, None]
+    return np.ravel_multi_index(tuple(coords), full_shape)
+
+
+def get_bundle_bounding_box(population_map_root: str, bundle: str, recon_suffixes: list):
+    """Calculates the union bounding box of a bundle's population maps over all reconstructions.
+
+    Args:
+      population_map_root: Root directory with one folder of population maps per reconstruction.
+      bundle: Bundle name without underscores and dashes.
+      recon_suffixes: Reconstruction methods (e.g., GQIautotrack) to take the union over.
+
+    Returns:
+      Bounding box (start, stop) in (z, y, x) order or None if all population maps are empty.
+    """
+    bounding_boxes = []
+    for recon_suffix in recon_suffixes:
+        map_path = os.path.join(population_map_root, recon_suffix, bundle + ".nii.gz")
+        if os.path.exists(map_path):
+            population_map = sitk.GetArrayFromImage(sitk.ReadImage(map_path))
+            bounding_boxes.append(get_bounding_box(population_map > 0))
+    return union_bounding_box(bounding_boxes)
+
+
+def save_bounding_boxes(population_map_root: str, bundles: list, recon_suffixes: list, output_path: str):
+    """Writes the union bounding boxes of all bundles to a csv file.
+
+    Args:
+      population_map_root: Root directory with one folder of population maps per reconstruction.
+      bundles: List of bundle names without underscores and dashes.
+      recon_suffixes: Reconstruction methods (e.g., GQIautotrack) to take the union over.
+      output_path: Path of the csv file.
+    """
+    rows = []
+    for bundle in bundles:
+        print(bundle)
+        bounding_box = get_bundle_bounding_box(
+            population_map_root, bundle, recon_suffixes)
+        if bounding_box is None:
+            continue
+        row = {"bundle": bundle}
+        row.update({axis + "_start": int(value)
+                   for axis, value in zip(AXES, bounding_box[0])})
+        row.update({axis + "_stop": int(value)
+                   for axis, value in zip(AXES, bounding_box[1])})
+        rows.append(row)
+    pd.DataFrame(rows).to_csv(output_path, index=False)
+    return
+
+
+def load_bounding_boxes(bounding_box_path: str) -> dict:
+    """Reads the bounding boxes written by save_bounding_boxes.
+
+    Returns:
+      Dictionary with bundle names as keys and (start, stop) arrays in (z, y, x) order as values.
+    """
+    df = pd.read_csv(bounding_box_path)
+    return {
+        row["bundle"]: (
+            np.array([row[axis + "_start"] for axis in AXES]),
+            np.array([row[axis + "_stop"] for axis in AXES]),
+        )
+        for _, row in df.iterrows()
+    }
+
+
+if __name__ == "__main__":
+    POPULATION_MAP_ROOT = "/cbica/projects/clinical_dmri_benchmark/results/overlay_maps"
+    BUNDLE_NAMES = "/cbica/projects/clinical_dmri_benchmark/clinical_dmri_benchmark/data/bundle_names.txt"
+    OUTPUT_PATH = os.path.join(POPULATION_MAP_ROOT, "bounding_boxes.csv")
+    RECON_SUFFIXES = ["GQIautotrack", "CSDautotrack", "SS3Tautotrack"]
+
+    with open(BUNDLE_NAMES, "r") as f:
+        bundles = f.read().splitlines()
+    for i, bundle in enumerate(bundles):
+        bundles[i] = bundle.replace("_", "").replace("-", "")
+
+    save_bounding_boxes(POPULATION_MAP_ROOT, bundles,
+                        RECON_SUFFIXES, OUTPUT_PATH)
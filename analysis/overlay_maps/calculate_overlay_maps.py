@@ -1,61 +1,382 @@
 import SimpleITK as sitk
 import os
+import sys
 import argparse
-import glob
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
+sys.path.append(os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "data_processing"))
+from mask_store import (  # noqa: E402
+    RUNS, array_to_image, get_array_shape, get_geometry, open_bundle, read_geometry, scan_mni_masks)
+from inventory import query_subjects  # noqa: E402
 
-def get_statitistical_overlay_maps(
-    root_qsirecon: str, root_output: str,
-    excluded_subject_list: str, bundle: str
-):
-    bundle = bundle.replace("_", "").replace("-", "")
-    subjects = [
-        folder
-        for folder in os.listdir(root_qsirecon)
-        if os.path.isdir(os.path.join(root_qsirecon, folder))
-        and folder.startswith("sub")
-    ]
+
+def get_count_dtype(n_masks: int):
+    """Returns the smallest unsigned integer dtype that can count n_masks overlapping masks."""
+    return np.uint16 if n_masks <= np.iinfo(np.uint16).max else np.uint32
+
+
+def get_probability_map(counts: np.ndarray, n_masks: int) -> np.ndarray:
+    """Divides a count array by the number of masks into a float32 probability map."""
+    return np.divide(counts, n_masks, dtype=np.float32)
+
+
+def get_overlay_counts_from_store(store_root: str, subjects: list, bundle: str):
+    """Sums the masks of a bundle over all given subjects using a mask store.
+
+    Args:
+      store_root: Directory of the mask store of one reconstruction.
+      subjects: List of subject IDs to include.
+      bundle: Bundle name without underscores and dashes.
+
+    Returns:
+      A tuple of the (z, y, x) count array and the list of names ("<subject_id>_<run>") of
+      the summed masks.
+    """
+    geometry = read_geometry(store_root)
+    bundle_index, voxels = open_bundle(store_root, bundle)
+    bundle_index = bundle_index[bundle_index["subject_id"].isin(subjects)]
+    n_voxels = int(np.prod(geometry["size"]))
+    counts = np.zeros(n_voxels, dtype=get_count_dtype(len(bundle_index)))
+    for start, stop in bundle_index[["start", "stop"]].itertuples(index=False):
+        # Voxel indices are unique within a mask, so fancy-index increments are exact
+        counts[voxels[start:stop]] += 1
+    scan_names = (bundle_index["subject_id"] + "_" + bundle_index["run"]).tolist()
+    return counts.reshape(get_array_shape(geometry)), scan_names
+
+
+def list_bundle_masks(root_qsirecon: str, subjects: list, bundles: list) -> dict:
+    """Lists the MNI masks of the given bundles with one directory scan per subject.
+
+    Args:
+      root_qsirecon: Path to the qsirecon output directory of one reconstruction.
+      subjects: List of subject IDs.
+      bundles: List of bundle names without underscores and dashes.
+
+    Returns:
+      Dictionary mapping each bundle to a dictionary of scan names ("<subject_id>_<run>") and
+      mask paths. At most one mask per run and bundle is listed (the first in sorted order).
+    """
+    masks = {bundle: {} for bundle in bundles}
+    for subject in subjects:
+        mni_dir = os.path.join(root_qsirecon, subject, "ses-PNC1", "dwi", "MNI")
+        for _, run, bundle, path in sorted(scan_mni_masks(mni_dir)):
+            if run in RUNS and bundle in masks:
+                masks[bundle].setdefault(subject + "_" + run, path)
+    return masks
+
+
+def accumulate_masks(mask_jobs: list, dtype=np.uint16):
+    """Sums masks in place into one counter per key.
+
+    Args:
+      mask_jobs: List of (key, mask path) tuples. Masks with the same key are summed.
+      dtype: Integer dtype of the counts (see get_count_dtype).
+
+    Returns:
+      A tuple of a dictionary of (z, y, x) count arrays keyed like the jobs and the MNI
+      geometry of the masks (None if there were no jobs).
+    """
+    counts = {}
+    geometry = None
+    for key, path in mask_jobs:
+        bundle_image = sitk.ReadImage(path)
+        if geometry is None:
+            geometry = get_geometry(bundle_image)
+        bundle_array = sitk.GetArrayViewFromImage(bundle_image)
+        if key not in counts:
+            counts[key] = np.zeros(bundle_array.shape, dtype=dtype)
+        np.add(counts[key], bundle_array, out=counts[key], casting="unsafe")
+    return counts, geometry
+
+
+def get_mask_counts(mask_jobs: list, dtype=np.uint16, workers: int = 1):
+    """Sums masks on a process pool.
+
+    The jobs are grouped by key, so that every task accumulates the masks of a single key
+    (see accumulate_masks) and a worker never holds more than one counter. Keys with many
+    masks are split into several tasks if there are fewer keys than workers. The partial
+    counts are added up as the tasks finish.
+
+    Args:
+      mask_jobs: List of (key, mask path) tuples. Masks with the same key are summed.
+      dtype: Integer dtype of the counts (see get_count_dtype).
+      workers: Number of worker processes.
+
+    Returns:
+      Same as accumulate_masks.
+    """
+    key_jobs = {}
+    for key, path in mask_jobs:
+        key_jobs.setdefault(key, []).append((key, path))
+    splits = max(1, -(-workers // max(1, len(key_jobs))))
+    chunks = [jobs[i::splits] for jobs in key_jobs.values() for i in range(splits)]
+    chunks = [chunk for chunk in chunks if chunk]
+    if workers <= 1 or len(chunks) <= 1:
+        return accumulate_masks(mask_jobs, dtype)
+
+    counts = {}
+    geometry = None
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(accumulate_masks, chunk, dtype) for chunk in chunks}
+        for future in as_completed(futures):
+            # Drop the finished future so that its counts are freed once merged
+            futures.remove(future)
+            chunk_counts, chunk_geometry = future.result()
+            if geometry is None:
+                geometry = chunk_geometry
+            for key, chunk_count in chunk_counts.items():
+                if key in counts:
+                    counts[key] += chunk_count
+                else:
+                    counts[key] = chunk_count
+            del chunk_counts, future
+    return counts, geometry
+
+
+def get_state_path(root_output: str, bundle: str) -> str:
+    """Returns the file the counts behind a bundle's overlay map are saved to."""
+    return os.path.join(root_output, bundle + "_counts.npz")
+
+
+def get_mask_mtimes(mask_paths: dict) -> dict:
+    """Returns the modification times (ns) of masks, keyed like mask_paths."""
+    return {key: os.stat(path).st_mtime_ns for key, path in mask_paths.items()}
+
+
+def save_overlay_state(root_output: str, bundle: str, counts: np.ndarray, scan_names: list,
+                       mask_mtimes: dict = None):
+    """Saves the raw count volume, the number of scans, the names of the included scans and
+    optionally the modification times of their masks (see get_mask_mtimes) of a bundle's
+    overlay map next to it."""
+    state_path = get_state_path(root_output, bundle)
+    scan_names = sorted(scan_names)
+    arrays = {}
+    if mask_mtimes is not None:
+        arrays["mask_mtimes"] = np.array([mask_mtimes[scan_name] for scan_name in scan_names],
+                                         dtype=np.int64)
+    # Write to a temporary file first such that an interrupted job never leaves a partial state
+    temporary_path = state_path[:-len(".npz")] + f".{os.getpid()}.tmp.npz"
+    np.savez_compressed(temporary_path, counts=counts, n_scans=len(scan_names),
+                        scan_names=np.array(scan_names, dtype=str), **arrays)
+    os.replace(temporary_path, state_path)
+
+
+def load_overlay_state(root_output: str, bundle: str):
+    """Loads the count volume, the included scan names and the modification times of their
+    masks (None if they were not saved) saved with a bundle's overlay map.
+    Returns None if the map was computed without saving its counts."""
+    state_path = get_state_path(root_output, bundle)
+    if not os.path.exists(state_path):
+        return None
+    with np.load(state_path) as state:
+        scan_names = state["scan_names"].tolist()
+        mask_mtimes = None
+        if "mask_mtimes" in state.files:
+            mask_mtimes = dict(zip(scan_names, state["mask_mtimes"].tolist()))
+        return state["counts"], scan_names, mask_mtimes
+
+
+def update_overlay_counts(root_qsirecon: str, subjects: list, bundles: list, states: dict, workers: int = 1):
+    """Brings the counts of the given bundles up to date with the masks of the given subjects.
+
+    Only masks of scans that were added since a bundle's counts were saved are read and added,
+    and masks of scans that are no longer included are read and subtracted. Scan membership
+    alone is not used to decide what changed: the modification times of the masks are compared
+    with the saved ones, and a bundle with a regenerated mask is recomputed from all masks, as
+    the previous version of the mask can no longer be subtracted. Bundles without saved counts
+    are computed from all masks. If the mask of a removed scan is no longer on disk, the bundle
+    is recomputed from all masks. Regenerated masks are not detected for counts saved without
+    modification times.
+
+    Args:
+      root_qsirecon: Path to the qsirecon output directory of one reconstruction.
+      subjects: List of subject IDs to include.
+      bundles: List of bundle names without underscores and dashes.
+      states: Dictionary mapping bundles to their saved (counts, scan names, mask modification
+      times) (see load_overlay_state). Bundles that are not in it are computed from all masks.
+      workers: Number of processes the masks are distributed over (see get_mask_counts).
+
+    Returns:
+      A tuple of a dictionary mapping each changed bundle to its updated (counts, scan names,
+      mask modification times) and the MNI geometry of the masks (None if nothing changed).
+    """
+    states = dict(states)
+    current = list_bundle_masks(root_qsirecon, subjects, bundles)
+    mtimes = {bundle: get_mask_mtimes(current[bundle]) for bundle in bundles}
+    for bundle in list(states):
+        old_mtimes = states[bundle][2]
+        if old_mtimes is None:
+            print("No mask modification times saved for bundle " + bundle
+                  + ", regenerated masks are not detected.")
+            continue
+        regenerated = [scan_name for scan_name, mtime in mtimes[bundle].items()
+                       if scan_name in old_mtimes and old_mtimes[scan_name] != mtime]
+        if regenerated:
+            print(f"{len(regenerated)} masks of bundle {bundle} were regenerated. Recomputing.")
+            del states[bundle]
+    removed = {bundle: sorted(set(states[bundle][1]) - set(current[bundle]))
+               for bundle in bundles if bundle in states}
+    # Subjects that are no longer included are still on disk, so their masks can be subtracted
+    removed_subjects = sorted({scan_name.rsplit("_", 1)[0]
+                               for scan_names in removed.values() for scan_name in scan_names})
+    previous = list_bundle_masks(root_qsirecon, removed_subjects, list(removed))
+    for bundle in list(removed):
+        if any(scan_name not in previous[bundle] for scan_name in removed[bundle]):
+            print("Masks of removed scans of bundle " + bundle + " not found. Recomputing.")
+            del states[bundle], removed[bundle]
+
+    mask_jobs = []
+    n_max = 0
+    for bundle in bundles:
+        old_scans = set(states[bundle][1]) if bundle in states else set()
+        added = [scan_name for scan_name in current[bundle] if scan_name not in old_scans]
+        mask_jobs += [((bundle, 1), current[bundle][scan_name]) for scan_name in added]
+        mask_jobs += [((bundle, -1), previous[bundle][scan_name])
+                      for scan_name in removed.get(bundle, [])]
+        n_max = max(n_max, len(old_scans) + len(added))
+    print(f"Reading {len(mask_jobs)} masks")
+    dtype = get_count_dtype(n_max)
+    changes, geometry = get_mask_counts(mask_jobs, dtype, workers)
+
+    updated = {}
+    for bundle in bundles:
+        added, subtracted = changes.pop((bundle, 1), None), changes.pop((bundle, -1), None)
+        if added is None and subtracted is None and bundle in states:
+            continue
+        if bundle in states:
+            counts = states[bundle][0].astype(dtype)
+        elif added is not None:
+            counts = np.zeros_like(added)
+        else:
+            continue
+        # Unsigned arithmetic is exact as every subtracted mask was added before
+        if added is not None:
+            counts += added
+        if subtracted is not None:
+            counts -= subtracted
+        updated[bundle] = (counts, list(current[bundle]), mtimes[bundle])
+    return updated, geometry
+
+
+def get_subjects(root_qsirecon: str, excluded_subject_list: str, inventory_path: str = None) -> list:
+    """Lists the subject folders of a qsirecon output directory without excluded subjects.
+    If given, the (up to date) inventory of the outputs (see data_processing/inventory.py) is
+    queried instead of listing the directory."""
+    if inventory_path is not None:
+        subjects = query_subjects(inventory_path, root_qsirecon)
+    else:
+        subjects = [
+            folder
+            for folder in os.listdir(root_qsirecon)
+            if os.path.isdir(os.path.join(root_qsirecon, folder))
+            and folder.startswith("sub")
+        ]
     with open(excluded_subject_list, 'r') as f:
         excluded_subjects = f.read().splitlines()
     for subject in excluded_subjects:
         if subject in subjects:
             subjects.remove(subject)
+    return subjects
+
 
-    if os.path.exists(os.path.join(root_output, bundle + ".nii.gz")):
-        print("An overlay map already exists for bundle " + bundle + ". Skipping.")
+def write_overlay_map(root_output: str, bundle: str, counts: np.ndarray, scan_names: list, geometry: dict,
+                      mask_mtimes: dict = None):
+    """Writes the probability map of a bundle and saves the counts it was computed from (and
+    optionally the modification times of the masks, see save_overlay_state).
+
+    Without any scans, an existing map and its counts are removed, so no stale map is left.
+    """
+    if len(scan_names) == 0:
+        print("No masks found for bundle " + bundle + ". Skipping.")
+        for stale_path in [os.path.join(root_output, bundle + ".nii.gz"),
+                           get_state_path(root_output, bundle)]:
+            if os.path.exists(stale_path):
+                os.remove(stale_path)
+                print("Removed stale " + stale_path)
         return
-    counter = 0
-    for subject in subjects:
-        for run in ["run-01", "run-02"]:
-            mask_path = os.path.join(
-                root_qsirecon,
-                subject,
-                "ses-PNC1",
-                "dwi",
-                "MNI",
-                f"{subject}_ses-PNC1_*{run}_space-MNI152NLin2009cAsym_bundle-{bundle}_mask.nii.gz",
-            )
-            matching_files = glob.glob(mask_path)
-            if matching_files:
-                bundle_image = sitk.ReadImage(matching_files[0])
-                bundle_array = sitk.GetArrayFromImage(bundle_image)
-                if counter == 0:
-                    stats_overlap = bundle_array.astype(np.int64)
-                    counter += 1
-                else:
-                    stats_overlap = stats_overlap + bundle_array
-                    counter += 1
-            else:
-                continue
-    stats_overlap = stats_overlap / counter
-    print(stats_overlap.max())
-    stats_overlap_img = sitk.GetImageFromArray(stats_overlap)
-    stats_overlap_img.SetDirection(bundle_image.GetDirection())
-    stats_overlap_img.SetOrigin(bundle_image.GetOrigin())
-    stats_overlap_img.SetSpacing(bundle_image.GetSpacing())
-    sitk.WriteImage(stats_overlap_img, os.path.join(
-        root_output, bundle + ".nii.gz"))
+    save_overlay_state(root_output, bundle, counts, scan_names, mask_mtimes)
+    stats_overlap = get_probability_map(counts, len(scan_names))
+    print(bundle, len(scan_names), stats_overlap.max())
+    sitk.WriteImage(array_to_image(stats_overlap, geometry),
+                    os.path.join(root_output, bundle + ".nii.gz"))
+
+
+def get_all_bundle_overlay_maps(
+    root_qsirecon: str, root_output: str,
+    excluded_subject_list: str, bundles: list, mask_store: str = None, workers: int = 1,
+    update: bool = False, inventory_path: str = None
+):
+    """Calculates the population overlay maps of the given bundles in one process.
+
+    Every mask is read once (see list_bundle_masks and get_mask_counts) instead of running
+    one job per bundle. Next to each map (<bundle>.nii.gz), the raw counts, the number of
+    scans and the included scans are saved (<bundle>_counts.npz).
+
+    Args:
+      root_qsirecon: Path to the qsirecon output directory of one reconstruction.
+      root_output: Directory the overlay maps are written to.
+      excluded_subject_list: Path to a txt file of subject IDs to exclude.
+      bundles: List of bundle names.
+      mask_store: Optional mask store directory of this reconstruction to read the masks from.
+      workers: Number of processes the masks are distributed over (see get_mask_counts).
+      update: If False, bundles that already have an overlay map are skipped. If True, existing
+      maps are updated, only reading the masks of added or removed scans (see
+      update_overlay_counts). Maps without saved counts are recomputed. Not supported with
+      mask_store, whose maps are always recomputed.
+      inventory_path: Optional inventory of the outputs to list the subjects from (see get_subjects).
+
+    Raises:
+      ValueError: If update is combined with mask_store.
+    """
+    if update and mask_store is not None:
+        raise ValueError("Updates are not supported with a mask store, maps are recomputed from the store.")
+    bundles = [bundle.replace("_", "").replace("-", "") for bundle in bundles]
+    if not update:
+        existing = [bundle for bundle in bundles
+                    if os.path.exists(os.path.join(root_output, bundle + ".nii.gz"))]
+        if existing:
+            print("Overlay maps already exist for bundles " + ", ".join(existing) + ". Skipping.")
+        bundles = [bundle for bundle in bundles if bundle not in existing]
+    if not bundles:
+        return
+    subjects = get_subjects(root_qsirecon, excluded_subject_list, inventory_path)
+
+    if mask_store is not None:
+        # The mask store holds each bundle's masks contiguously, so maps are always recomputed
+        geometry = read_geometry(mask_store)
+        for bundle in bundles:
+            counts, scan_names = get_overlay_counts_from_store(
+                mask_store, subjects, bundle)
+            write_overlay_map(root_output, bundle, counts, scan_names, geometry)
+        return
+
+    states = {}
+    if update:
+        for bundle in bundles:
+            state = load_overlay_state(root_output, bundle)
+            if state is not None:
+                states[bundle] = state
+    updated, geometry = update_overlay_counts(
+        root_qsirecon, subjects, bundles, states, workers)
+    for bundle in bundles:
+        if bundle not in updated:
+            print("No changes for bundle " + bundle + ".")
+            continue
+        counts, scan_names, mask_mtimes = updated.pop(bundle)
+        write_overlay_map(root_output, bundle, counts, scan_names, geometry, mask_mtimes)
+    return
+
+
+def get_statitistical_overlay_maps(
+    root_qsirecon: str, root_output: str,
+    excluded_subject_list: str, bundle: str, mask_store: str = None, workers: int = 1,
+    update: bool = False, inventory_path: str = None
+):
+    """Calculates the population overlay map of a single bundle (see get_all_bundle_overlay_maps)."""
+    get_all_bundle_overlay_maps(root_qsirecon, root_output, excluded_subject_list, [bundle],
+                                mask_store, workers, update, inventory_path)
     return
 
 
@@ -68,13 +389,45 @@ if __name__ == "__main__":
         required=True,
         help="Reconstruction method (e.g., GQIautotrack)",
     )
-    parser.add_argument(
+    bundle_group = parser.add_mutually_exclusive_group(required=True)
+    bundle_group.add_argument(
         "--bundle",
         type=str,
-        required=True,
         help="Name of the considered bundle (e.g., CorpusCallosum)",
     )
+    bundle_group.add_argument(
+        "--all_bundles",
+        "--all-bundles",
+        action="store_true",
+        help="Calculate the overlay maps of all bundles in one pass over the subjects",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=len(os.sched_getaffinity(0)),
+        help="Num processes the subjects are distributed over",
+    )
+    parser.add_argument(
+        "--update",
+        action="store_true",
+        help="Update existing overlay maps from their saved counts, only reading the masks of "
+        "added or removed scans",
+    )
+    parser.add_argument(
+        "--mask_store",
+        type=str,
+        default=None,
+        help="Optional mask store directory of this reconstruction to read the masks from",
+    )
+    parser.add_argument(
+        "--inventory",
+        type=str,
+        default=None,
+        help="Optional inventory of the outputs (data_processing/inventory.py) to list the subjects from",
+    )
     args = parser.parse_args()
+    if args.update and args.mask_store is not None:
+        parser.error("--update is not supported with --mask_store, maps are recomputed from the store")
 
     QSIRECON_SUFFIX = args.recon_suffix
     qsirecon_suffix_options = ["GQIautotrack", "SS3Tautotrack", "CSDautotrack"]
@@ -93,6 +446,15 @@ if __name__ == "__main__":
     )
     os.makedirs(OUTPUT_ROOT, exist_ok=True)
     EXCLUDED_SBJ_LIST = "../data_processing/subject_lists/excluded_subjects.txt"
+    BUNDLE_NAMES = "../../data/bundle_names.txt"
 
-    get_statitistical_overlay_maps(
-        BUNDLE_ROOT, OUTPUT_ROOT, EXCLUDED_SBJ_LIST, BUNDLE)
+    if args.all_bundles:
+        with open(BUNDLE_NAMES, "r") as f:
+            bundles = f.read().splitlines()
+        get_all_bundle_overlay_maps(
+            BUNDLE_ROOT, OUTPUT_ROOT, EXCLUDED_SBJ_LIST, bundles, args.mask_store, args.workers,
+            args.update, args.inventory)
+    else:
+        get_statitistical_overlay_maps(
+            BUNDLE_ROOT, OUTPUT_ROOT, EXCLUDED_SBJ_LIST, BUNDLE, args.mask_store, args.workers,
+            args.update, args.inventory)